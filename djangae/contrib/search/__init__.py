@@ -1,11 +1,16 @@
 from django.utils.module_loading import autodiscover_modules
 
 from . import model_document
-from .index import Index  # noqa
+from .index import (  # noqa
+    Index,
+    get_index,
+    invalidate_index,
+)
 from .document import Document  # noqa
 from .model_document import (  # noqa
     ModelDocument,
     register,
+    warmup_indexes,
 )
 
 from .fields import (  # noqa
@@ -0,0 +1,147 @@
+"""
+    Index aliases, for rebuilding an index without downtime.
+
+    An alias is a name (e.g. the index name of a ModelDocument) which
+    resolves to an index. To replace the index, a new one is built under
+    another name (e.g. "ProductDocument@v2"). While it's being built,
+    documents are written to both indexes, but only the current one is
+    searched. Once it's complete, swap_alias() makes the new index the
+    one that's searched, and the previous index is dropped in the
+    background.
+
+    Names without an alias resolve to the index with the same name.
+"""
+
+import time
+
+from django.conf import settings
+from gcloudc.db import transaction
+
+from djangae.utils import retry
+
+from .index import drop_index
+
+# How long the resolution of an alias is cached by each process. After
+# a swap, other processes may search the previous index for this long.
+CACHE_TIME = getattr(settings, "DJANGAE_SEARCH_ALIAS_CACHE_TIME", 10)
+
+# Dropped indexes are deleted in tasks of this many batches
+_DROP_BATCHES_PER_TASK = 50
+
+# Maps alias names to (index_name, building_index_name, expiry)
+_aliases = {}
+
+
+def _lookup(name):
+    from .models import IndexAlias  # Prevent import too early
+
+    cached = _aliases.get(name)
+    if cached and cached[-1] > time.time():
+        return cached[:-1]
+
+    alias = IndexAlias.objects.filter(pk=name).first()
+    if alias:
+        result = (alias.index_name, alias.building_index_name)
+    else:
+        result = (name, None)
+
+    _aliases[name] = result + (time.time() + CACHE_TIME,)
+    return result
+
+
+def resolve_alias(name):
+    """
+        Returns the name of the index which is searched for the alias
+    """
+    return _lookup(name)[0]
+
+
+def resolve_alias_for_writing(name):
+    """
+        Returns the names of the indexes which documents should be written
+        to for the alias, the index that's searched first
+    """
+    index_name, building_index_name = _lookup(name)
+    if building_index_name and building_index_name != index_name:
+        return [index_name, building_index_name]
+    return [index_name]
+
+
+def start_build(name, index_name):
+    """
+        Starts building the index with index_name to replace the one that
+        the alias currently resolves to. From now on, documents written
+        to the alias are also written to the new index.
+    """
+    from .models import IndexAlias  # Prevent import too early
+
+    @transaction.atomic()
+    def update():
+        alias = IndexAlias.objects.filter(pk=name).first()
+        if alias is None:
+            # Until now, the name has resolved to the index with the same name
+            alias = IndexAlias(name=name, index_name=name)
+
+        if alias.index_name == index_name:
+            raise ValueError("Alias %s already resolves to %s" % (name, index_name))
+
+        alias.building_index_name = index_name
+        alias.save()
+
+    retry(update)
+    _aliases.pop(name, None)
+
+
+def swap_alias(name, drop_previous=True):
+    """
+        Makes the alias resolve to the index which is being built, and
+        returns the name of the index it previously resolved to. If
+        drop_previous is True, the previous index is deleted in deferred
+        tasks, once other processes have stopped using it.
+    """
+    from .models import IndexAlias  # Prevent import too early
+    from djangae.tasks.deferred import defer
+
+    previous = []
+
+    @transaction.atomic()
+    def update():
+        alias = IndexAlias.objects.filter(pk=name).first()
+        if alias is None or not alias.building_index_name:
+            raise ValueError("No index is being built for alias %s" % name)
+
+        previous[:] = [alias.index_name]
+
+        alias.index_name = alias.building_index_name
+        alias.building_index_name = None
+        alias.save()
+
+        if drop_previous:
+            defer(
+                _drop_index_task,
+                alias.name,
+                previous[0],
+                _countdown=CACHE_TIME * 2,
+                _transactional=True
+            )
+
+    retry(update)
+    _aliases.pop(name, None)
+    return previous[0]
+
+
+def _drop_index_task(name, index_name):
+    """
+        Deletes a batch of the index which an alias previously resolved
+        to, and defers another task if there's more to delete
+    """
+    from djangae.tasks.deferred import defer
+
+    _aliases.pop(name, None)
+
+    # The index was swapped back in before it was dropped
+    if index_name in resolve_alias_for_writing(name):
+        return
+
+    if not drop_index(index_name, batches=_DROP_BATCHES_PER_TASK):
+        defer(_drop_index_task, name, index_name)
@@ -0,0 +1,42 @@
+"""
+    A pool of threads, shared by the process, which runs independent
+    Datastore operations (e.g. the postings queries for the branches of
+    an OR query) concurrently.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from gcloudc.db import transaction
+
+# The number of threads in the pool. Set to 1 to
+# run everything one after another instead.
+CONCURRENCY = getattr(settings, "DJANGAE_SEARCH_CONCURRENCY", 4)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def map_concurrently(function, items):
+    """
+        Returns a list of function(item) for each of the items, in the
+        same order, running up to CONCURRENCY calls at a time.
+        function must not call map_concurrently itself.
+
+        Inside a transaction, the calls are run one after another, as
+        transactions are per-thread and other threads would read outside it.
+    """
+    global _executor
+
+    items = list(items)
+    if CONCURRENCY <= 1 or len(items) <= 1 or transaction.in_atomic_block():
+        return [function(x) for x in items]
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=CONCURRENCY, thread_name_prefix="search"
+            )
+
+    return list(_executor.map(function, items))
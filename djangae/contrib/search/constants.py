@@ -1,17 +1,18 @@
 # Puncuation list is taken from the list the App Engine search
 # API used: https://cloud.google.com/appengine/docs/standard/python/search
 
-PUNCTUATION = {
+PUNCTUATION = frozenset({
     "!", '"', "%", "(", ")", "*", ",", "-", "|", "/",
     "[", "]", "^", "`", ":", "=", ">", "?", "@", "{",
     "}", "~", "$", "."
-}
+})
 
 # These are the English stopwords generated by nltk. Ideally
 # we'd use nltk directly, but that involves some mechanism of
 # downloading/shipping the nltk data files. That's something
-# for the future.
-STOP_WORDS = [
+# for the future. This is a frozenset as it's only used
+# for membership checks.
+STOP_WORDS = frozenset([
     'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves',
     'you', "you're", "you've", "you'll", "you'd", 'your', 'yours',
     'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she',
@@ -36,7 +37,43 @@ STOP_WORDS = [
     "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn',
     "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't",
     'wouldn', "wouldn't"
-]
+])
 
 # Symbol used to seperate the parts of TokenFieldIndex keys
 WORD_DOCUMENT_JOIN_STRING = "|"
+
+# Symbol used to join adjacent words into phrase shingles. Spaces
+# always separate tokens, so a shingle can't clash with a word
+PHRASE_JOIN_STRING = " "
+
+# Edge n-grams (prefixes) of words are indexed with this symbol in front
+# of them. It's punctuation, so can't be the first character of a word
+PREFIX_TOKEN_MARKER = "^"
+
+# Prefixes longer than this aren't indexed, and are searched for by
+# scanning the tokens which start with them instead
+MAX_PREFIX_LENGTH = 20
+
+# Trigrams of words are indexed with this symbol in front of them, and
+# words are padded with TRIGRAM_PADDING so that the start and end of the
+# word have their own trigrams
+TRIGRAM_TOKEN_MARKER = "~"
+TRIGRAM_PADDING = "$"
+
+# Numbers and dates are also indexed as fixed width tokens which sort in the
+# same order as the values, so that ranges can be searched with a single
+# scan. These tokens start with this symbol, followed by the kind of value,
+# and then the field name and RANGE_FIELD_SEPARATOR, so that the scan only
+# covers the values of one field.
+RANGE_TOKEN_MARKER = "="
+NUMBER_RANGE_PREFIX = RANGE_TOKEN_MARKER + "n"
+DATE_RANGE_PREFIX = RANGE_TOKEN_MARKER + "d"
+RANGE_FIELD_SEPARATOR = ":"
+
+# The whole (normalized) values of AtomFields are indexed with this symbol in
+# front of them, so that the values of matching documents can be counted
+FACET_TOKEN_MARKER = "@"
+
+# The ways postings can be stored, see postings.py
+TOKEN_FIELD_INDEX_STORAGE = "token_field_index"
+POSTING_BLOCK_STORAGE = "posting_block"
@@ -0,0 +1,428 @@
+"""
+    Sharded counters for the statistics of an index.
+
+    Each counter is split across a number of CounterShard entities.
+    Every write to an index updates a randomly chosen shard, so that
+    concurrent writes rarely contend on the same entity. Reading a
+    counter sums its shards, and the total is cached briefly.
+
+    Counters are updated after the postings they count have been written.
+    A PendingCounterUpdate is created before the postings are written, and
+    deleted once the counters have been updated. If an update fails, or a
+    PendingCounterUpdate is abandoned (e.g. the process died), the counters
+    of the index are marked as invalid (see IndexStats.counters_valid), and
+    from then on they're counted from the records and postings of the index
+    instead, as they are for indexes populated before the counters were kept.
+
+    Document frequencies aren't kept for tokens derived from the words of
+    documents (see has_document_frequency), there are far too many of them
+    to update on every write. They're counted from the postings when read.
+"""
+
+import logging
+import random
+from collections import (
+    Counter,
+    namedtuple,
+)
+from datetime import timedelta
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from gcloudc.db import transaction
+
+from djangae.utils import retry
+
+from .constants import (
+    FACET_TOKEN_MARKER,
+    PHRASE_JOIN_STRING,
+    PREFIX_TOKEN_MARKER,
+    RANGE_TOKEN_MARKER,
+    TRIGRAM_TOKEN_MARKER,
+    WORD_DOCUMENT_JOIN_STRING,
+)
+
+logger = logging.getLogger(__name__)
+
+# The number of shards of each counter. This can be increased, but
+# not decreased, as shards beyond this number are never read.
+SHARD_COUNT = getattr(settings, "DJANGAE_SEARCH_COUNTER_SHARDS", 10)
+
+# How long the sum of the shards of a counter is cached for
+CACHE_TIME = getattr(settings, "DJANGAE_SEARCH_COUNTER_CACHE_TIME", 10)
+
+# The Datastore allows up to 500 entities to be written in a single
+# batch, and up to 1000 to be fetched
+_WRITE_BATCH_SIZE = 500
+_READ_BATCH_SIZE = 1000
+
+# When counters are counted from the postings of an index, the number of
+# documents containing a token is only counted up to this many
+_MAX_COUNTED_DOCUMENTS = 1000
+
+# A PendingCounterUpdate older than this has been abandoned, so the
+# counters may no longer match the postings
+_ABANDONED_UPDATE_AGE = timedelta(minutes=10)
+
+# The PendingCounterUpdate of a write, and the state
+# of the counters of the index when the write began
+_PendingUpdate = namedtuple("_PendingUpdate", ["pk", "counters_valid", "recounting"])
+
+# The number of documents in the index
+DOCUMENT_COUNT = "documents"
+
+_FIELD_PREFIX = "field"
+_TOKEN_PREFIX = "token"
+
+
+def field_token_count(field_name):
+    """
+        The name of the counter of the number of tokens indexed in the field
+    """
+    return WORD_DOCUMENT_JOIN_STRING.join([_FIELD_PREFIX, field_name])
+
+
+def document_frequency(token):
+    """
+        The name of the counter of the number of documents containing the token
+    """
+    return WORD_DOCUMENT_JOIN_STRING.join([_TOKEN_PREFIX, token])
+
+
+def has_document_frequency(token):
+    """
+        Returns False for tokens whose document frequencies aren't kept in
+        counters: range and facet tokens, whose frequencies are never read,
+        and tokens derived from words (prefixes, trigrams and phrase
+        shingles), whose frequencies are counted from the postings instead
+    """
+    return len(token) == 1 or not (
+        token.startswith((RANGE_TOKEN_MARKER, FACET_TOKEN_MARKER, PREFIX_TOKEN_MARKER, TRIGRAM_TOKEN_MARKER)) or
+        PHRASE_JOIN_STRING in token
+    )
+
+
+def _is_kept(name):
+    # False for counters which are always counted from the index
+    kind, _, value = name.partition(WORD_DOCUMENT_JOIN_STRING)
+    return kind != _TOKEN_PREFIX or has_document_frequency(value)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _cache_key(index_id, name):
+    # Tokens may contain spaces, so can't be used in cache keys directly
+    key = WORD_DOCUMENT_JOIN_STRING.join([str(index_id), name])
+    return "_SEARCH_COUNTER_{}".format(md5(key.encode("utf-8")).hexdigest())
+
+
+def _choose_shard():
+    return random.randrange(SHARD_COUNT)
+
+
+def _invalidate_counters(index):
+    """
+        Marks the counters of the index as invalid, so that they're
+        counted from the index from now on
+    """
+    from .models import IndexStats  # Prevent import too early
+
+    IndexStats.objects.filter(pk=index.id).update(counters_valid=False)
+    index.index.counters_valid = False
+
+
+def _count(index, name):
+    """
+        Returns the value of the counter, counted from the records
+        and postings of the index
+    """
+    from .models import DocumentRecord  # Prevent import too early
+
+    if name == DOCUMENT_COUNT:
+        return DocumentRecord.objects.filter(index_stats_id=index.id).count()
+
+    kind, value = name.split(WORD_DOCUMENT_JOIN_STRING, 1)
+    if kind == _FIELD_PREFIX:
+        return index.storage.count_field_postings(index, value)
+
+    document_ids = set()
+    for page in index.storage.iter_posting_pages(index, None, value):
+        document_ids.update(page)
+        if len(document_ids) >= _MAX_COUNTED_DOCUMENTS:
+            break
+
+    return min(len(document_ids), _MAX_COUNTED_DOCUMENTS)
+
+
+def begin_update(index):
+    """
+        Called before the postings of the index are written. Creates a
+        PendingCounterUpdate, and returns a value which must be passed
+        to update_counters() once the postings have been written.
+    """
+    from .models import (  # Prevent import too early
+        IndexStats,
+        PendingCounterUpdate,
+    )
+
+    # The marker is created before the state of the counters is read, so
+    # a recount which began after it was read always finds the marker
+    pk = PendingCounterUpdate.objects.create(index_stats_id=index.id).pk
+
+    # Another process may have invalidated or recounted the counters
+    state = IndexStats.objects.filter(pk=index.id).values_list("counters_valid", "recounting").first()
+    counters_valid, recounting = state or (False, False)
+
+    index.index.counters_valid = counters_valid
+    return _PendingUpdate(pk, counters_valid, recounting)
+
+
+def _has_abandoned_updates(index):
+    """
+        Returns True if a PendingCounterUpdate of the index has been
+        left behind, rather than being deleted by update_counters()
+    """
+    cutoff = timezone.now() - _ABANDONED_UPDATE_AGE
+    return any(created < cutoff for _, created in _pending_updates(index))
+
+
+def _pending_updates(index):
+    # The (pk, created) of the PendingCounterUpdates of the index
+    from .models import PendingCounterUpdate  # Prevent import too early
+
+    return list(PendingCounterUpdate.objects.filter(
+        index_stats_id=index.id
+    ).values_list("pk", "created")[:_READ_BATCH_SIZE])
+
+
+def _delete_pending_updates(keys):
+    from .models import PendingCounterUpdate  # Prevent import too early
+
+    for chunk in _chunks(list(keys), _WRITE_BATCH_SIZE):
+        PendingCounterUpdate.objects.filter(pk__in=chunk).delete()
+
+
+def update_counters(index, deltas, pending_update=None):
+    """
+        Adds the deltas to the counters, given a dictionary
+        of {counter_name: delta}, and deletes the PendingCounterUpdate
+        from begin_update(). If the counters of the index are invalid,
+        nothing is written.
+    """
+    counters_valid = index.index.counters_valid
+    if pending_update is not None:
+        counters_valid = counters_valid and pending_update.counters_valid
+
+    try:
+        _update_counters(index, deltas, counters_valid)
+    finally:
+        if pending_update is not None and not pending_update.recounting:
+            # Writes during a recount are left for recount_counters() to find
+            _delete_pending_updates([pending_update.pk])
+
+
+def _update_counters(index, deltas, counters_valid):
+    from .models import CounterShard  # Prevent import too early
+
+    names = [x for x, delta in deltas.items() if delta]
+
+    if not counters_valid:
+        # The statistics are counted from the index, which has changed
+        cache.delete_many([_cache_key(index.id, x) for x in names])
+        return
+
+    # All the counters of a single write go to the same shard, so
+    # concurrent writes are unlikely to touch the same entities
+    shard = _choose_shard()
+
+    for chunk in _chunks(names, _WRITE_BATCH_SIZE):
+        @transaction.atomic(independent=True)
+        def update():
+            keys = [CounterShard.generate_pk(index.id, x, shard) for x in chunk]
+            existing = {x.pk: x for x in CounterShard.objects.filter(pk__in=keys)}
+
+            for key, name in zip(keys, chunk):
+                counter = existing.get(key)
+                if counter is None:
+                    counter = CounterShard(pk=key, index_stats=index.index, name=name)
+
+                counter.count += deltas[name]
+                counter.save(force_insert=key not in existing)
+
+        try:
+            retry(update)
+        except Exception:
+            # The postings have already been written, so the counters
+            # would be wrong from now on
+            logger.exception("Unable to update the counters of index %s, they will be counted instead", index.id)
+            _invalidate_counters(index)
+            break
+
+    cache.delete_many([_cache_key(index.id, x) for x in names])
+
+
+def get_counters(index, names):
+    """
+        Returns a dictionary of {counter_name: total} for the counters.
+        Counters which have never been updated are 0. If the counters of
+        the index are invalid, they're counted from the index instead (and
+        document frequencies are only counted up to _MAX_COUNTED_DOCUMENTS),
+        as are the document frequencies of derived tokens.
+    """
+    from .models import (  # Prevent import too early
+        CounterShard,
+        IndexStats,
+    )
+
+    cache_keys = {x: _cache_key(index.id, x) for x in names}
+    cached = cache.get_many(list(cache_keys.values()))
+
+    result = {}
+    missing = []
+    for name, cache_key in cache_keys.items():
+        if cache_key in cached:
+            result[name] = cached[cache_key]
+        else:
+            missing.append(name)
+
+    totals = {x: _count(index, x) for x in missing if not _is_kept(x)}
+    missing = [x for x in missing if _is_kept(x)]
+
+    if missing and index.index.counters_valid:
+        # Another process may have marked the counters as invalid
+        index.index.counters_valid = IndexStats.objects.filter(
+            pk=index.id
+        ).values_list("counters_valid", flat=True).first() is not False
+
+        if index.index.counters_valid and _has_abandoned_updates(index):
+            logger.error("Counters of index %s weren't updated after a write, they will be counted instead", index.id)
+            _invalidate_counters(index)
+
+    if index.index.counters_valid:
+        totals.update({x: 0 for x in missing})
+
+        keys = [
+            CounterShard.generate_pk(index.id, name, shard)
+            for name in missing for shard in range(SHARD_COUNT)
+        ]
+
+        for chunk in _chunks(keys, _READ_BATCH_SIZE):
+            for name, count in CounterShard.objects.filter(pk__in=chunk).values_list("name", "count"):
+                totals[name] += count
+
+        for name, total in totals.items():
+            if total < 0:
+                # Writes of more than one batch aren't atomic, so this
+                # can happen briefly, but otherwise the counter is wrong
+                logger.warning("Counter %s of index %s is negative (%s)", name, index.id, total)
+                totals[name] = 0
+    else:
+        totals.update({x: _count(index, x) for x in missing})
+
+    if totals:
+        cache.set_many({cache_keys[x]: total for x, total in totals.items()}, CACHE_TIME)
+
+    result.update(totals)
+    return result
+
+
+def get_counter(index, name):
+    return get_counters(index, [name])[name]
+
+
+def _count_records(index):
+    """
+        Returns a Counter of {counter_name: total} for the counters
+        of the index, counted from its records
+    """
+    from .models import (  # Prevent import too early
+        DocumentRecord,
+        TokenFieldIndex,
+    )
+
+    totals = Counter()
+
+    last_pk = None
+    while True:
+        queryset = DocumentRecord.objects.filter(index_stats_id=index.id).order_by("pk")
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+
+        records = list(queryset[:_READ_BATCH_SIZE])
+        if not records:
+            break
+
+        for record in records:
+            keys = record.posting_keys()
+            tokens = set(TokenFieldIndex.token_from_pk(x) for x in keys)
+            totals.update(document_frequency(x) for x in tokens if has_document_frequency(x))
+            totals.update(field_token_count(TokenFieldIndex.field_name_from_pk(x)) for x in keys)
+
+        totals[DOCUMENT_COUNT] += len(records)
+        last_pk = records[-1].pk
+
+    return totals
+
+
+def recount_counters(index):
+    """
+        Counts the statistics of the index from its records, and replaces
+        its counters with them, so that they're used again if they were
+        invalid. Returns False if the index was written to while it was
+        being counted, then the counters are left invalid and the recount
+        can be tried again.
+    """
+    from .models import (  # Prevent import too early
+        CounterShard,
+        IndexStats,
+    )
+
+    IndexStats.objects.filter(pk=index.id).update(counters_valid=False, recounting=True)
+    index.index.counters_valid = False
+
+    # Writes which began before the recount may not have seen that it
+    # had, so they must have finished (or been abandoned) first
+    cutoff = timezone.now() - _ABANDONED_UPDATE_AGE
+    pending = _pending_updates(index)
+    _delete_pending_updates(pk for pk, created in pending if created < cutoff)
+
+    if any(created >= cutoff for _, created in pending):
+        logger.warning("Index %s is being written to, so can't be recounted", index.id)
+        IndexStats.objects.filter(pk=index.id).update(recounting=False)
+        return False
+
+    totals = _count_records(index)
+
+    existing = list(CounterShard.objects.filter(index_stats_id=index.id).values_list("pk", flat=True))
+    for chunk in _chunks(existing, _WRITE_BATCH_SIZE):
+        CounterShard.objects.filter(pk__in=chunk).delete()
+
+    shards = [
+        CounterShard(
+            pk=CounterShard.generate_pk(index.id, name, 0),
+            index_stats=index.index, name=name, count=count,
+        )
+        for name, count in totals.items() if count
+    ]
+    for chunk in _chunks(shards, _WRITE_BATCH_SIZE):
+        CounterShard.objects.bulk_create(chunk)
+
+    IndexStats.objects.filter(pk=index.id).update(counters_valid=True, recounting=False)
+
+    # Any writes which began during the recount (or just before the
+    # counters became valid) may not have been counted
+    pending = _pending_updates(index)
+    _delete_pending_updates(pk for pk, _ in pending)
+
+    if pending:
+        logger.warning("Index %s was written to while it was being recounted", index.id)
+        _invalidate_counters(index)
+        return False
+
+    index.index.counters_valid = True
+    return True
@@ -4,7 +4,36 @@ from .fields import (
 )
 
 
-class Document(object):
+class DocumentMeta(type):
+    """
+        Gathers the fields of a Document subclass once, when the class
+        is created. The fields stay on the class as attributes, and the
+        values of each document are set on the instance.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, "_fields", {}))
+
+        for attr_name, attr in attrs.items():
+            if isinstance(attr, Field):
+                attr.attname = attr_name
+                fields[attr_name] = attr
+
+        # Sorted by name, so fields are always in the same order
+        attrs["_fields"] = dict(sorted(fields.items()))
+
+        # The fields which are set from the init kwargs, see Document.__init__
+        attrs["_value_fields"] = tuple(
+            (attr_name, field) for attr_name, field in attrs["_fields"].items()
+            if attr_name != "id"
+        )
+
+        return super().__new__(mcs, name, bases, attrs)
+
+
+class Document(object, metaclass=DocumentMeta):
     # All documents have an 'id' property, if this is blank
     # when indexing, it will be populated with a generated one
     # This corresponds with the PK of the underlying DocumentRecord
@@ -22,39 +51,23 @@ class Document(object):
         else:
             self.id = kwargs.get("id")
 
-        self._fields = {}
+        for attr_name, field in self._value_fields:
+            # Apply any field values passed into the init, or
+            # the default if there was no value
+            setattr(self, attr_name, kwargs.get(attr_name, field.default))
 
-        klass = type(self)
+        # Throw an error if a kwarg doesn't match a field
+        unknown = kwargs.keys() - self._fields.keys()
+        if unknown:
+            raise ValueError("Unknown field: %s" % unknown.pop())
 
-        for attr_name in dir(klass):
-            attr = getattr(klass, attr_name)
+    @classmethod
+    def get_fields(cls):
+        return cls._fields
 
-            if isinstance(attr, Field):
-                attr.attname = attr_name
-                self._fields[attr_name] = attr
-
-                # We set the ID value above based on _record or 'id'
-                # and we don't want to wipe that
-                if attr_name == "id":
-                    continue
-
-                # Apply any field values passed into the init
-                if attr_name in kwargs:
-                    setattr(self, attr_name, kwargs[attr_name])
-                else:
-                    # Set default if there was no value
-                    setattr(self, attr_name, attr.default)
-
-        for key in kwargs.keys():
-            # Throw an error if the kwarg doesn't match a field
-            if key not in self._fields:
-                raise ValueError("Unknown field: %s" % key)
-
-    def get_fields(self):
-        return self._fields
-
-    def get_field(self, name):
-        return self._fields[name]
+    @classmethod
+    def get_field(cls, name):
+        return cls._fields[name]
 
     def __eq__(self, other):
         return self.pk == other.pk
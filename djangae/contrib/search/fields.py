@@ -4,7 +4,15 @@ from datetime import datetime
 from django.utils import dateparse
 
 from . import indexers as search_indexers
-from .tokens import tokenize_content
+from .tokens import (
+    date_range_token,
+    edge_ngrams,
+    facet_token,
+    number_range_token,
+    shingle_phrase,
+    tokenize_content,
+    tokenize_phrase,
+)
 
 
 class IntegrityError(ValueError):
@@ -76,6 +84,29 @@ class Field(object):
 
         return token
 
+    def range_token(self, value):
+        """
+            Returns a token for the (normalized) value which sorts in the same
+            order as the values, so the field can be searched with range queries
+            (e.g. price:<100). If None, range queries aren't supported.
+        """
+        return None
+
+    def facet_token(self, value):
+        """
+            Returns a token for the whole (normalized) value, which allows
+            counting the values of matching documents. If None, the field
+            can't be used as a facet.
+        """
+        return None
+
+    def derived_token_options(self):
+        """
+            Returns the options for derive_tokens() for this field, or
+            an empty dictionary if no tokens are derived for it
+        """
+        return {}
+
     def convert_from_index(self, value):
         """
             Convert a value returned from the index (these values)
@@ -86,23 +117,46 @@ class Field(object):
 
 
 class AtomField(Field):
-    pass
+    def facet_token(self, value):
+        return facet_token(str(value))
 
 
 class TextField(Field):
+    def __init__(self, default=None, null=True, index_phrases=False, index_prefixes=False, **kwargs):
+        """
+            index_phrases: If True, adjacent words are also indexed so that
+                the field can be searched for exact phrases (e.g. "tallest building")
+            index_prefixes: If True, the prefixes of words are also indexed so that
+                startswith searches are a lookup, rather than a scan of matching tokens
+        """
+        self.index_phrases = index_phrases
+        self.index_prefixes = index_prefixes
+        super().__init__(default=default, null=null, **kwargs)
+
     def normalize_value(self, value):
         if value is not None:
             value = str(value)
 
         return super().normalize_value(value)
 
+    def derived_token_options(self):
+        options = {}
+        if self.index_phrases:
+            options["phrases"] = True
+        if self.index_prefixes:
+            options["prefixes"] = True
+        return options
+
 
 class FuzzyTextField(TextField):
     DEFAULT_INDEXERS = (
         search_indexers.stemming,
     )
 
-    def __init__(self, default=None, null=True, indexers=None, min_index_length=3, **kwargs):
+    def __init__(
+        self, default=None, null=True, indexers=None,
+        min_index_length=search_indexers.DEFAULT_MIN_INDEX_LENGTH, **kwargs
+    ):
         """
             indexers: list of indexers to apply to the value for indexing
             min_index_length: resulting tokens less than this length will be ignored
@@ -124,6 +178,13 @@ class FuzzyTextField(TextField):
 
         return result
 
+    def derived_token_options(self):
+        options = super().derived_token_options()
+        if search_indexers.trigrams in self.indexers:
+            # The trigrams of the words are derived from the value
+            options["trigrams"] = self.options["min_index_length"]
+        return options
+
 
 class DateField(Field):
     def normalize_value(self, value):
@@ -148,6 +209,9 @@ class DateField(Field):
             value.strftime("%Y-%m-%d"),
         ]
 
+    def range_token(self, value):
+        return date_range_token(self.attname, value)
+
     def convert_from_index(self, value):
         if value is None:
             return value
@@ -169,3 +233,40 @@ class NumberField(Field):
 
     def tokenize_value(self, value):
         return [value]
+
+    def range_token(self, value):
+        return number_range_token(self.attname, value)
+
+
+def derive_tokens(value, tokens, options):
+    """
+        Returns the set of tokens which are derived from the stored value of
+        a TextField, and the other tokens indexed for it, given the options
+        from Field.derived_token_options(). These tokens aren't stored on
+        the DocumentRecord, as there can be many of them, but can always be
+        derived again from the document's data.
+    """
+    result = set()
+
+    # The value is normalized as it was when the tokens were indexed
+    field = TextField()
+    value = field.normalize_value(value)
+
+    if options.get("prefixes"):
+        # Index the prefixes of the words for startswith searches
+        result.update(x for token in tokens for x in edge_ngrams(token))
+
+    if options.get("phrases") and value is not None:
+        # Index the adjacent words so phrases can be matched
+        words = [field.clean_token(x) for x in tokenize_phrase(value)]
+        result.update(shingle_phrase([x for x in words if x]))
+
+    if options.get("trigrams") and value is not None:
+        # The trigrams indexer of FuzzyTextField, applied to each word
+        for word in field.tokenize_value(value):
+            for token in search_indexers.trigrams(word, min_index_length=options["trigrams"])[1:]:
+                token = field.clean_token(token)
+                if token and token.strip():
+                    result.add(token)
+
+    return result
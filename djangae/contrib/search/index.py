@@ -1,25 +1,224 @@
+import json
+import threading
+from collections import Counter
 from collections.abc import Iterable
 
 from gcloudc.db import transaction
-
+from gcloudc.db.models.fields.json import dumps as json_dumps
+
+from djangae.utils import retry
+
+from .constants import (
+    TOKEN_FIELD_INDEX_STORAGE,
+    WORD_DOCUMENT_JOIN_STRING,
+)
+from . import (
+    counters,
+    result_cache,
+)
+from .concurrency import map_concurrently
 from .document import Document
-from .fields import IntegrityError
+from .fields import (
+    AtomField,
+    IntegrityError,
+    derive_tokens,
+)
+from .postings import get_storage
 
 _DEFAULT_INDEX_NAME = "default"
 
+# The Datastore allows up to 500 entities to be written
+# in a single batch
+_WRITE_BATCH_SIZE = 500
+
+# Ranked search results are fetched in batches of this many
+# records, as they're iterated
+_READ_BATCH_SIZE = 100
+
+# Deleting instances looks up their related objects with an IN
+# query of their keys, and gcloudc allows up to 100 values in one
+_DELETE_BATCH_SIZE = 100
+
+
+# Index handles shared by the process, keyed by name. See get_index()
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _delete_by_key(model, keys):
+    """
+        Deletes the instances with the keys, in batches small enough
+        for the deletion collector's lookups of related objects.
+    """
+    for batch in _chunks(keys, _DELETE_BATCH_SIZE):
+        model.objects.filter(pk__in=batch).delete()
+
+
+def get_index(name, storage=None):
+    """
+        Returns the Index with the name (see Index.__init__). The Index is
+        shared by the process, so the index is only looked up (or created)
+        in the database the first time.
+    """
+    name = name or _DEFAULT_INDEX_NAME
+
+    index = _indexes.get(name)
+    if index is None:
+        index = Index(name=name, storage=storage)
+
+        with _indexes_lock:
+            index = _indexes.setdefault(name, index)
+
+    elif storage and index.index.storage != storage:
+        raise ValueError(
+            "Index %s uses %s storage, not %s" % (name, index.index.storage, storage)
+        )
+
+    return index
+
+
+def invalidate_index(name=None):
+    """
+        Discards the shared Index with the name (or all of them if name
+        is None), so it's looked up again by the next get_index()
+    """
+    with _indexes_lock:
+        if name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(name or _DEFAULT_INDEX_NAME, None)
+
+
+def drop_index(name, batches=None):
+    """
+        Deletes the index with the name, and everything in it, in batches.
+        If batches is set, at most that many batches are deleted, and
+        False is returned if there is more to delete.
+    """
+    from .models import (  # Prevent import too early
+        CounterShard,
+        DocumentRecord,
+        IndexStats,
+        PendingCounterUpdate,
+        PostingBlock,
+        TokenFieldIndex,
+    )
+
+    name = name or _DEFAULT_INDEX_NAME
+
+    # Postings first, so the records of documents are never
+    # deleted while their postings remain
+    for model in (TokenFieldIndex, PostingBlock, DocumentRecord, CounterShard, PendingCounterUpdate):
+        while True:
+            if batches is not None and batches <= 0:
+                return False
+
+            keys = list(
+                model.objects.filter(index_stats_id=name).values_list("pk", flat=True)[:_WRITE_BATCH_SIZE]
+            )
+            if not keys:
+                break
+
+            _delete_by_key(model, keys)
+
+            if batches is not None:
+                batches -= 1
+
+    _delete_by_key(IndexStats, [name])
+    result_cache.bump_generation(name)
+    invalidate_index(name)
+    return True
+
 
 class Index(object):
 
-    def __init__(self, name):
+    def __init__(self, name, storage=None):
+        """
+            name: The name of the index, it will be created if it doesn't exist
+            storage: How postings are stored for a new index, either
+                "token_field_index" (the default) or "posting_block". Existing
+                indexes keep the storage they were created with.
+        """
         from .models import IndexStats  # Prevent import too early
 
         name = name or _DEFAULT_INDEX_NAME
 
+        # Check the storage exists before an index is created with it
+        get_storage(storage)
+
         self.name = name
         self.index, created = IndexStats.objects.get_or_create(
-            name=name
+            name=name,
+            defaults={
+                "storage": storage or TOKEN_FIELD_INDEX_STORAGE,
+                "counters_valid": True,
+                "instance_ids_backfilled": True,
+                "unprefixed_fields": [],
+            }
+        )
+
+        if storage and self.index.storage != storage:
+            raise ValueError(
+                "Index %s uses %s storage, not %s" % (name, self.index.storage, storage)
+            )
+
+        self.storage = get_storage(self.index.storage)
+
+    def mark_instance_ids_backfilled(self):
+        """
+            Records that every DocumentRecord in the index has its
+            instance_id set, e.g. once the index has been rebuilt
+        """
+        from .models import IndexStats  # Prevent import too early
+
+        if not self.index.instance_ids_backfilled:
+            IndexStats.objects.filter(pk=self.id).update(instance_ids_backfilled=True)
+            self.index.instance_ids_backfilled = True
+
+    def mark_prefixes_indexed(self, document_class):
+        """
+            Records that every document in the index has been indexed as
+            the document class indexes it now (e.g. once the index has been
+            rebuilt), so the prefixes of its fields with index_prefixes=True
+            can be looked up. See IndexStats.unprefixed_fields
+        """
+        from .models import IndexStats  # Prevent import too early
+
+        unprefixed_fields = sorted(
+            field.attname for name, field in document_class.get_fields().items()
+            if name != "id" and field.index and not getattr(field, "index_prefixes", False)
         )
 
+        IndexStats.objects.filter(pk=self.id).update(unprefixed_fields=unprefixed_fields)
+        self.index.unprefixed_fields = unprefixed_fields
+
+    def _mark_unprefixed_fields(self, field_names):
+        """
+            Records that the fields have been indexed without the prefixes
+            of their words, so startswith searches must scan their tokens
+        """
+        from .models import IndexStats  # Prevent import too early
+
+        known = self.index.unprefixed_fields
+        if known is None or not set(field_names) - set(known):
+            # Already recorded (or no field is assumed to have prefixes)
+            return
+
+        @transaction.atomic(independent=True)
+        def update():
+            index = IndexStats.objects.get(pk=self.id)
+            if index.unprefixed_fields is not None:
+                index.unprefixed_fields = sorted(set(index.unprefixed_fields) | set(field_names))
+                index.save()
+            return index.unprefixed_fields
+
+        self.index.unprefixed_fields = retry(update)
+
     @property
     def id(self):
         return self.index.pk if self.index else None
@@ -58,90 +257,223 @@ class Index(object):
         # First-pass validation
         self._validate_documents(documents)
 
-        with transaction.atomic(independent=True):
-            for document in documents:
-                # We go through the document fields, pull out the values that have been set
-                # then we index them.
-                field_data = {
-                    f: getattr(document, document.get_field(f).attname)
-                    for f in document.get_fields() if f != "id"
-                }
-
-                record = document._record
-
-                created = False
-                if record is None:
-                    # Generate a database representation of this Document use
-                    # the passed ID if there is one
-                    record, created = DocumentRecord.objects.get_or_create(
-                        pk=document.id,
-                        defaults={
-                            "index_stats": self.index,
-                            "data": field_data
-                        }
-                    )
-                    document.id = record.id
-                    document._record = record
-
-                if created:
-                    added_document_ids.append(record.id)
-                else:
-                    record.data = field_data
-
-                assert(document.id)  # This should be a thing by now
-
-                for field_name, field in document.get_fields().items():
-                    if field_name == "id":
-                        continue
-
-                    if not field.index:
-                        # Some fields are just stored, not indexed
-                        continue
-
-                    # Get the field value, use the default if it's not set
-                    value = getattr(document, field.attname, None)
-                    value = field.default if value is None else value
-                    value = field.normalize_value(value)
+        # Records are created (and postings written) before the counters
+        # are updated, see counters.py
+        pending_update = counters.begin_update(self)
 
-                    # Tokenize the value, this will effectively mean lower-casing
-                    # removing punctuation etc. and returning a list of things
-                    # to index
-                    tokens = field.tokenize_value(value)
+        # Keys are deterministic, so we gather all the postings for all the
+        # documents first, and then write them in bulk. If a document
+        # was already indexed, we only write (or delete) the difference.
+        additions = {}
+        stale_keys = set()
+        records = []
 
-                    if tokens is None:
-                        # Nothing to index
-                        continue
+        # Changes to the statistics of the index, see counters.py
+        counter_deltas = Counter()
 
-                    tokens = set(tokens)  # Remove duplicates
+        # The fields indexed without their prefixes, see IndexStats.unprefixed_fields
+        unprefixed_fields = set()
 
-                    for token in tokens:
-                        token = field.clean_token(token)
-                        if token is None:
-                            continue
+        for document in documents:
+            # We go through the document fields, pull out the values that have been set
+            # then we index them.
+            field_data = {
+                f: getattr(document, f)
+                for f in document.get_fields() if f != "id"
+            }
+
+            record = document._record
+
+            created = False
+            if record is None:
+                # Generate a database representation of this Document use
+                # the passed ID if there is one
+                record, created = DocumentRecord.objects.get_or_create(
+                    pk=document.id,
+                    defaults={
+                        "index_stats": self.index,
+                        "data": field_data
+                    }
+                )
+                document.id = record.id
+                document._record = record
+
+            if created:
+                added_document_ids.append(record.id)
+
+            assert(document.id)  # This should be a thing by now
+
+            # Only the keys of the tokens that can't be derived from
+            # the data are stored on the record
+            stored_keys = set()
+            keys = set()
+            existing_keys = record.posting_keys()
+
+            field_tokens = self._tokenize_document(document)
+            derived_options = self._derived_token_options(document)
+
+            unprefixed_fields.update(
+                field.attname for name, field in document.get_fields().items()
+                if name != "id" and field.index and not derived_options.get(field.attname, {}).get("prefixes")
+            )
+
+            for field_name, tokens in field_tokens.items():
+                derived = derive_tokens(
+                    field_data.get(field_name), tokens, derived_options.get(field_name, {})
+                )
+
+                for token in tokens | derived:
+                    pk = TokenFieldIndex.generate_pk(self.index.pk, token, field_name, document.id)
+                    keys.add(pk)
+
+                    if token not in derived:
+                        stored_keys.add(pk)
+
+                    if pk not in existing_keys:
+                        additions[pk] = (token, field_name, document.id)
+
+            stale_keys.update(existing_keys - keys)
+
+            tokens = set(TokenFieldIndex.token_from_pk(x) for x in keys)
+            existing_tokens = set(TokenFieldIndex.token_from_pk(x) for x in existing_keys)
+            counter_deltas.update(
+                counters.document_frequency(x) for x in tokens - existing_tokens
+                if counters.has_document_frequency(x)
+            )
+            counter_deltas.subtract(
+                counters.document_frequency(x) for x in existing_tokens - tokens
+                if counters.has_document_frequency(x)
+            )
+
+            counter_deltas.update(
+                counters.field_token_count(TokenFieldIndex.field_name_from_pk(x))
+                for x in keys - existing_keys
+            )
+            counter_deltas.subtract(
+                counters.field_token_count(TokenFieldIndex.field_name_from_pk(x))
+                for x in existing_keys - keys
+            )
+
+            instance_id = field_data.get("instance_id")
+            instance_id = None if instance_id is None else str(instance_id)
+
+            if (
+                created or keys != existing_keys or
+                set(record.token_field_indexes_ids) != stored_keys or
+                (record.derived_token_options or {}) != derived_options or
+                record.instance_id != instance_id or
+                not self._data_matches(record, field_data)
+            ):
+                record.data = field_data
+                record.instance_id = instance_id
+                record.token_field_indexes_ids = stored_keys
+                record.derived_token_options = derived_options
+                records.append(record)
+
+        # Before the postings are written, so startswith searches
+        # never miss the documents by looking up their prefixes
+        self._mark_unprefixed_fields(unprefixed_fields)
+
+        self.storage.write(self, additions, stale_keys)
+
+        for record in records:
+            record.save()
+
+        counter_deltas[counters.DOCUMENT_COUNT] += len(added_document_ids)
+        counters.update_counters(self, counter_deltas, pending_update)
+
+        if records:
+            result_cache.bump_generation(self.id)
 
-                        if not token.strip():
-                            # Ignore whitespace tokens
-                            continue
+        return added_document_ids if was_list else added_document_ids[0]
 
-                        with transaction.atomic(independent=True):
-                            # FIXME: Update occurrances
-                            obj, _ = TokenFieldIndex.objects.get_or_create(
-                                record_id=document.id,
-                                token=token,
-                                index_stats=self.index,
-                                field_name=field.attname
-                            )
+    def _data_matches(self, record, field_data):
+        """
+            Returns True if the data stored on the record is the same
+            as field_data once it's been through the JSON serialization
+        """
+        return record.data == json.loads(json_dumps(field_data))
 
-                        record.token_field_indexes.add(obj)
-                record.save()
+    def _derived_token_options(self, document):
+        """
+            Returns a dictionary of {field_name: options} for the indexed
+            fields of the document which have tokens derived from their
+            data, see fields.derive_tokens()
+        """
+        result = {}
+        for field_name, field in document.get_fields().items():
+            if field_name != "id" and field.index:
+                options = field.derived_token_options()
+                if options:
+                    result[field.attname] = options
 
-        return added_document_ids if was_list else added_document_ids[0]
+        return result
 
-    def remove(self, document_or_documents):
+    def _tokenize_document(self, document):
+        """
+            Returns a dictionary of {field_name: set(tokens)} for all
+            indexed fields of the document. This doesn't include the
+            tokens derived from them, see fields.derive_tokens()
+        """
+        result = {}
+
+        for field_name, field in document.get_fields().items():
+            if field_name == "id":
+                continue
+
+            if not field.index:
+                # Some fields are just stored, not indexed
+                continue
+
+            # Get the field value, use the default if it's not set
+            value = getattr(document, field.attname, None)
+            value = field.default if value is None else value
+            value = field.normalize_value(value)
+
+            # Tokenize the value, this will effectively mean lower-casing
+            # removing punctuation etc. and returning a list of things
+            # to index
+            tokens = field.tokenize_value(value)
+
+            if tokens is None:
+                # Nothing to index
+                continue
+
+            cleaned_tokens = set()  # Remove duplicates
+            for token in set(tokens):
+                token = field.clean_token(token)
+                if token is None:
+                    continue
+
+                if not token.strip():
+                    # Ignore whitespace tokens
+                    continue
+
+                assert(WORD_DOCUMENT_JOIN_STRING not in token)  # Don't index this special symbol
+                cleaned_tokens.add(token)
+
+            range_token = field.range_token(value)
+            if range_token is not None:
+                # Index a token which can be searched for with a range query
+                cleaned_tokens.add(range_token)
+
+            facet_token = field.facet_token(value)
+            if facet_token is not None:
+                # Index the whole value so it can be counted
+                cleaned_tokens.add(facet_token)
+
+            result[field.attname] = cleaned_tokens
+
+        return result
+
+    def remove(self, document_or_documents, concurrent=False):
         """
             Removes a document, or documents, from the index. Document
             instances, or document IDs are accepted.
 
+            Documents are removed in batches. If concurrent is True, the
+            batches are removed concurrently (see concurrency.py).
+
             Returns the number of documents that were successfully removed
             from the index.
         """
@@ -160,23 +492,53 @@ class Index(object):
             else [document_or_documents]
         )
 
-        removed_count = 0
-
-        for doc_or_id in document_or_documents:
-            doc_id = doc_or_id.id if isinstance(doc_or_id, Document) else doc_or_id
+        # Each document is only removed (and counted) once
+        document_ids = list(dict.fromkeys(
+            x.id if isinstance(x, Document) else x for x in document_or_documents
+        ))
+
+        def remove_batch(batch):
+            records = [
+                x for x in DocumentRecord.objects.filter(pk__in=batch)
+                if x.index_stats_id == self.id
+            ]
+
+            counter_deltas = Counter()
+            for record in records:
+                keys = record.posting_keys()
+                tokens = set(TokenFieldIndex.token_from_pk(x) for x in keys)
+                counter_deltas.subtract(
+                    counters.document_frequency(x) for x in tokens if counters.has_document_frequency(x)
+                )
+                counter_deltas.subtract(
+                    counters.field_token_count(TokenFieldIndex.field_name_from_pk(x)) for x in keys
+                )
+
+            if records:
+                self.storage.delete_documents(self, records)
+                _delete_by_key(DocumentRecord, [x.pk for x in records])
+
+            return len(records), counter_deltas
+
+        batches = list(_chunks([x for x in document_ids if x is not None], _WRITE_BATCH_SIZE))
+
+        pending_update = counters.begin_update(self)
+        if concurrent:
+            results = map_concurrently(remove_batch, batches)
+        else:
+            results = [remove_batch(x) for x in batches]
 
-            try:
-                doc = DocumentRecord.objects.get(pk=doc_id)
-                removed_count += 1
-            except DocumentRecord.DoesNotExist:
-                continue
+        removed_count = 0
+        counter_deltas = Counter()
+        for count, deltas in results:
+            removed_count += count
+            counter_deltas.update(deltas)
 
-            TokenFieldIndex.objects.filter(
-                record_id=doc.pk,
-                index_stats_id=self.index.pk
-            ).delete()
+        counter_deltas[counters.DOCUMENT_COUNT] -= removed_count
+        counters.update_counters(self, counter_deltas, pending_update)
 
-            doc.delete()
+        if removed_count:
+            result_cache.bump_generation(self.id)
 
         return removed_count
 
@@ -192,49 +554,136 @@ class Index(object):
         use_startswith=False,
         match_stopwords=True,
         match_all=True,
-        order_by=None
+        order_by=None,
+        use_cache=False,
+        use_trigrams=False,
+        facets=None,
+        facet_counts=None,
+        facet_sample_size=None,
+        cursor=None,
+        next_cursor=None
     ):
         """
             Perform a search of the index.
             query_string: The query we're making using query syntax
             document_class: The `Document` document_class to return the results as
             limit: The max number of results to return
-            use_stemming: If true, this will query for variations of the token
+            use_stemming: If true, words are matched by their stem (e.g. "running" will
+                match "runs") in FuzzyTextFields
             use_startswith: If true, will return results where the beginning of searched tokens match
             match_stopwords: If true, stopwords included in the query will be matched.
                 This will be implicitly True if use_startswith is True
             match_all: If true, only return results where all tokens are found, otherwise act as though all terms
                 are separated by OR operators.
+            use_cache: If true, the ranking of the results is cached until documents are
+                added to or removed from the index
+            use_trigrams: If true, words are matched if they share enough trigrams with
+                the searched words (e.g. "gogle" will match "google"). This requires the
+                trigrams indexer on a FuzzyTextField.
+            facets: A list of names of AtomFields to count the values of, for all the
+                matching documents (not just the top `limit`)
+            facet_counts: A dictionary which is populated with {field_name: {value: count}}
+                for the facets, once the results are iterated
+            facet_sample_size: If set, facet counts are estimated from this many of the
+                matching documents. Estimated counts are cached, as if use_cache was True.
+            cursor: A cursor returned by a previous search with the same query and
+                options, the results then start after the last result of that search
+            next_cursor: A list, to which the cursor for the next page of results is
+                appended (if `limit` results were returned) once the results are iterated.
+                Cursors can't be used with order_by.
         """
-        from .query import build_document_queryset
+        from .models import DocumentRecord  # Prevent import too early
+        from .query import (
+            build_document_queryset,
+            count_facets,
+            decode_cursor,
+            encode_cursor,
+            get_query_plan,
+        )
+
+        facets = tuple(facets or ())
+        for field_name in facets:
+            field = document_class.get_fields().get(field_name)
+            if not isinstance(field, AtomField):
+                raise ValueError("%s is not an AtomField" % field_name)
 
         # If we're using startswith matching, we need to include stopwords
         # regardless of what the user asked for
         if use_startswith:
             match_stopwords = True
 
-        qs, ordered_ids = build_document_queryset(
-            query_string, self,
-            use_stemming=use_stemming,
-            use_startswith=use_startswith,
+        plan = get_query_plan(
+            query_string,
             match_stopwords=match_stopwords,
             match_all=match_all,
-        )[:limit]
+            use_startswith=use_startswith,
+            use_stemming=use_stemming,
+            use_trigrams=use_trigrams,
+        )
 
-        doc_instance = document_class()
+        if order_by and (cursor is not None or next_cursor is not None):
+            # Cursors hold a position in the ranking, not in the order_by field
+            raise ValueError("Cursors can't be used with order_by")
+
+        # A cursor can only be used with the same query plan
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, plan)
+
+        cache_options = dict(limit=limit, after=after)
+        if facets:
+            cache_options.update(facets=facets, facet_sample_size=facet_sample_size)
+
+        use_cache = use_cache or bool(facets and facet_sample_size)
+
+        cache_key = None
+        cached = None
+        if use_cache:
+            cache_key = result_cache.result_cache_key(self.id, plan.key, cache_options)
+            cached = result_cache.get_ranking(cache_key)
+
+        if cached is None:
+            # We need all the matching documents to count facets
+            matched_ids = [] if facets else None
+
+            qs, ranking = build_document_queryset(
+                query_string, self,
+                limit=limit,
+                matched_ids=matched_ids,
+                after=after,
+                plan=plan,
+                document_class=document_class,
+            )
+
+            counts = count_facets(self, matched_ids, facets, facet_sample_size) if facets else {}
+
+            if use_cache:
+                result_cache.set_ranking(cache_key, (ranking, counts) if facets else ranking)
+        else:
+            ranking, counts = cached if facets else (cached, {})
+            qs = DocumentRecord.objects.filter(pk__in=list(ranking))
+
+        if facet_counts is not None:
+            facet_counts.update(counts)
+
+        if next_cursor is not None and ranking and len(ranking) == limit:
+            last_id, (_, last_score) = max(ranking.items(), key=lambda x: x[1][0])
+            next_cursor.append(encode_cursor(plan, last_score, last_id))
 
         def get_field_value(field_name, record):
-            field = doc_instance.get_field(field_name)
+            field = document_class.get_field(field_name)
             return field.convert_from_index(record.data[field_name])
 
         if order_by:
-            # Explicit field ordering
-            qs = sorted(list(qs), key=lambda x: get_field_value(order_by, x))
+            # Explicit field ordering, which needs all the records
+            records = sorted(list(qs), key=lambda x: get_field_value(order_by, x))
         else:
-            # Use ranking
-            qs = sorted(list(qs), key=lambda x: ordered_ids.index(x.id))
+            # Use ranking, fetching the records as they're needed
+            records = self._iter_ranked_records(
+                sorted(ranking, key=lambda x: ranking[x][0])
+            )
 
-        for record in qs:
+        for record in records:
             data = {}
 
             for field_name in record.data:
@@ -242,7 +691,44 @@ class Index(object):
 
             yield document_class(_record=record, **data)
 
-    def document_count(self):
+    def _iter_ranked_records(self, document_ids):
+        """
+            Yields the DocumentRecords with the IDs in the same order,
+            fetching them in batches
+        """
         from .models import DocumentRecord  # Prevent import too early
 
-        return DocumentRecord.objects.filter(index_stats=self.index).count()
+        for batch in _chunks(document_ids, _READ_BATCH_SIZE):
+            records = {x.pk: x for x in DocumentRecord.objects.filter(pk__in=batch)}
+            for document_id in batch:
+                if document_id in records:
+                    yield records[document_id]
+
+    def document_count(self):
+        """
+            Returns the number of documents in the index. This may be
+            a few seconds out of date (see counters.CACHE_TIME)
+        """
+        return counters.get_counter(self, counters.DOCUMENT_COUNT)
+
+    def field_token_count(self, field_name):
+        """
+            Returns the number of tokens indexed in the field, across
+            all documents
+        """
+        return counters.get_counter(self, counters.field_token_count(field_name))
+
+    def document_frequency(self, token):
+        """
+            Returns the number of documents which contain the token
+        """
+        return counters.get_counter(self, counters.document_frequency(token))
+
+    def recount_statistics(self):
+        """
+            Counts the statistics of the index from its documents and
+            stores them in its counters, so they're used again if they
+            couldn't be trusted. Returns False if the index was written
+            to while it was being counted, see counters.recount_counters()
+        """
+        return counters.recount_counters(self)
@@ -1,4 +1,53 @@
+from functools import lru_cache
+
+from .constants import PHRASE_JOIN_STRING
+from .stemmer import stem
+from .tokens import trigram_tokens
+
+# The number of word -> stem results kept in memory. Stemming
+# is relatively slow, and the same words are stemmed repeatedly
+_STEM_CACHE_SIZE = 10000
+
+# Stems shorter than this aren't looked up when querying, as they
+# wouldn't have been indexed with the default FuzzyTextField settings
+DEFAULT_MIN_INDEX_LENGTH = 3
+
+
+@lru_cache(maxsize=_STEM_CACHE_SIZE)
+def stem_word(word):
+    """
+        Returns the stem of the word, caching recent results
+    """
+    if PHRASE_JOIN_STRING in word or not word.isalpha():
+        # Don't stem phrase shingles, numbers, acronyms etc.
+        return word
+
+    return stem(word)
 
 
 def stemming(word, min_index_length, **options):
-    raise NotImplementedError()
+    """
+        Returns the word, and its stem if that's different and at
+        least min_index_length long
+    """
+    result = [word]
+
+    stemmed = stem_word(word)
+    if stemmed != word and len(stemmed) >= min_index_length:
+        result.append(stemmed)
+
+    return result
+
+
+def trigrams(word, min_index_length, **options):
+    """
+        Returns the word, and its trigrams if the word is at least
+        min_index_length long. This allows for searching with
+        use_trigrams=True, which tolerates typos.
+    """
+    result = [word]
+
+    if len(word) >= min_index_length and PHRASE_JOIN_STRING not in word:
+        result.extend(trigram_tokens(word))
+
+    return result
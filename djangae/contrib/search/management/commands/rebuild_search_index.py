@@ -0,0 +1,121 @@
+from django.apps import apps
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from djangae.contrib.search.aliases import (
+    start_build,
+    swap_alias,
+)
+from djangae.contrib.search.model_document import (
+    _rebuild_index_batch,
+    _rebuild_index_finalize,
+    _registry,
+)
+from djangae.models import DeferIterationMarker
+from djangae.tasks.deferred import defer_iteration_with_finalize
+
+DEFAULT_SHARDS = 5
+
+# The number of instances indexed in each write
+DEFAULT_BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-indexes every instance of a searchable model, in deferred shards. "
+        "Instances are indexed directly, without calling Model.save()."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", nargs="?", help="The model to re-index, as app_label.ModelName")
+        parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS)
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument("--queue", default="default")
+        parser.add_argument(
+            "--index",
+            help=(
+                "Build a new index with this name (e.g. MyModelDocument@v2) to replace "
+                "the current one, rather than re-indexing the current index in place"
+            )
+        )
+        parser.add_argument(
+            "--swap", action="store_true",
+            help=(
+                "Swap in the index that is being built. With --index, the "
+                "swap happens once the new index is complete."
+            )
+        )
+        parser.add_argument(
+            "--status", action="store_true",
+            help="Display the progress of rebuilds, rather than starting one"
+        )
+
+    def handle(self, *args, **options):
+        if options["status"]:
+            self.display_status()
+            return
+
+        if not options["model"]:
+            raise CommandError("You must specify a model to re-index")
+
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if model not in _registry:
+            raise CommandError("%s is not registered for search" % model._meta.label)
+
+        model_document, _ = _registry[model]
+        alias = model_document.index_alias()
+
+        if options["swap"] and not options["index"]:
+            try:
+                previous = swap_alias(alias)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+            self.stdout.write("Swapped %s from %s, which will be dropped" % (alias, previous))
+            return
+
+        if options["index"]:
+            try:
+                start_build(alias, options["index"])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        defer_iteration_with_finalize(
+            model._default_manager.all(),
+            _rebuild_index_batch,
+            _rebuild_index_finalize,
+            _queue=options["queue"],
+            _shards=options["shards"],
+            _delete_marker=False,
+            _batch_size=options["batch_size"],
+            model=model,
+            index_name=options["index"],
+            swap=options["swap"],
+        )
+
+        self.stdout.write(
+            "Deferred re-indexing of %s, run with --status to check progress" % model._meta.label
+        )
+
+    def display_status(self):
+        markers = DeferIterationMarker.objects.filter(
+            callback_name=_rebuild_index_batch.__name__
+        )
+
+        # Sorted here, to avoid needing a composite index
+        for marker in sorted(markers, key=lambda x: x.created, reverse=True):
+            self.stdout.write(
+                "%s: %s/%s shards complete, %s instances indexed%s" % (
+                    marker.created,
+                    marker.shards_complete,
+                    marker.shard_count,
+                    marker.instances_processed,
+                    ", finalized" if marker.is_finalized else ""
+                )
+            )
@@ -0,0 +1,28 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+
+from djangae.contrib.search.index import Index
+from djangae.contrib.search.models import IndexStats
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts the statistics of a search index from its documents, so that its "
+        "counters are used again. Run it while the index isn't being written to."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("index", help="The name of the index to recount")
+
+    def handle(self, *args, **options):
+        name = options["index"]
+
+        if not IndexStats.objects.filter(pk=name).exists():
+            raise CommandError("There is no index named %s" % name)
+
+        if not Index(name=name).recount_statistics():
+            raise CommandError("%s was written to while it was being recounted, try again later" % name)
+
+        self.stdout.write("Recounted the statistics of %s" % name)
@@ -1,14 +1,29 @@
 import copy
+import itertools
+import logging
 from functools import wraps
 
 from django.core.exceptions import FieldDoesNotExist
 from django.db import models
 from django.db.models import Manager
+from django.utils import timezone
+from gcloudc.db import transaction
 
 from djangae.contrib import search
 from djangae.contrib.search import fields as search_fields
 
-from .index import Index
+from .concurrency import (
+    CONCURRENCY,
+    map_concurrently,
+)
+from .aliases import (
+    resolve_alias,
+    resolve_alias_for_writing,
+    swap_alias,
+)
+from .index import get_index
+
+logger = logging.getLogger(__name__)
 
 
 class ModelDocument(object):
@@ -36,14 +51,35 @@ class ModelDocument(object):
         return Meta()
 
     @classmethod
-    def index(cls):
+    def index_alias(cls):
+        """
+            The name of the index, which may be an alias of another
+            index (see aliases.py)
+        """
         meta = cls._meta()
         index_name = getattr(meta, "index", "") if meta else None
+        return index_name or cls.__name__
+
+    @classmethod
+    def get_index(cls, index_name):
+        meta = cls._meta()
+        storage = getattr(meta, "storage", None) if meta else None
+        return get_index(index_name, storage=storage)
 
-        if not index_name:
-            index_name = cls.__name__
+    @classmethod
+    def index(cls):
+        """
+            The index which is searched
+        """
+        return cls.get_index(resolve_alias(cls.index_alias()))
 
-        return Index(name=index_name)
+    @classmethod
+    def indexes_for_writing(cls):
+        """
+            The indexes which documents are written to, this includes
+            any index which is being built to replace index()
+        """
+        return [cls.get_index(x) for x in resolve_alias_for_writing(cls.index_alias())]
 
 
 def document_from_model_document(model, model_document):
@@ -113,8 +149,276 @@ def document_from_model_document(model, model_document):
     return Document
 
 
+# Maps registered models to a tuple of (model_document, document_class)
 _registry = {}
 
+# When indexing is deferred, this is the default number of seconds to wait
+# before indexing. Saves of the same instance during this time are coalesced
+# into a single indexing task.
+_DEFAULT_DEFER_INDEXING_COUNTDOWN = 5
+
+# If a marker is older than this, then the task it was created for has
+# probably been lost, and another can be deferred
+_DEFERRED_INDEXING_MARKER_TIMEOUT_SECONDS = 60 * 10
+
+# Ranked search results are fetched in batches of this many instances,
+# as they're iterated (the Datastore allows up to 1000 keys per get)
+_RESULT_BATCH_SIZE = 100
+
+# The existing records of instances being indexed are looked up with
+# IN queries, which the Datastore limits to 30 values
+_INSTANCE_LOOKUP_BATCH_SIZE = 30
+
+
+def _iter_ranked_instances(queryset, keys, concurrent=False):
+    """
+        Yields the instances in the queryset with the keys (an iterable),
+        in the same order as the keys. Keys and instances are fetched in
+        batches as they're needed, and if concurrent is True, several
+        batches of instances are fetched at a time.
+    """
+    keys = iter(keys)
+
+    def fetch(batch):
+        return {x.pk: x for x in queryset.filter(pk__in=batch)}
+
+    step = CONCURRENCY if concurrent else 1
+    while True:
+        batches = [list(itertools.islice(keys, _RESULT_BATCH_SIZE)) for _ in range(step)]
+        batches = [x for x in batches if x]
+        if not batches:
+            return
+
+        fetched = map_concurrently(fetch, batches)
+
+        for batch, instances in zip(batches, fetched):
+            # Instances which don't match the queryset are skipped
+            for pk in batch:
+                if pk in instances:
+                    yield instances[pk]
+
+
+def warmup_indexes():
+    """
+        Looks up the indexes of all the registered models, so that the
+        first save or search of each model in this process doesn't have
+        to. Call this when an instance starts (e.g. in a warmup request).
+    """
+    for model_document, _ in _registry.values():
+        model_document.indexes_for_writing()
+
+
+def _index_instances(model, instances, indexes=None):
+    """
+        Adds (or updates) the documents for the model instances in the
+        model document's indexes (see ModelDocument.indexes_for_writing),
+        in a single write to each
+    """
+    model_document, _ = _registry[model]
+
+    if indexes is None:
+        indexes = model_document.indexes_for_writing()
+
+    for index in indexes:
+        _index_instances_in(index, model, instances)
+
+
+def _legacy_records(index, instance_id):
+    """
+        Returns the records of the instance which were written before
+        DocumentRecord.instance_id was populated, so only have the
+        instance ID in their data. This queries the JSON data, so is
+        only done until the index has been rebuilt (which populates
+        instance_id on every record), see IndexStats.instance_ids_backfilled.
+    """
+    from djangae.contrib.search.models import DocumentRecord
+
+    if index.index.instance_ids_backfilled:
+        return []
+
+    return list(DocumentRecord.objects.filter(
+        index_stats_id=index.id,
+        data__instance_id=instance_id
+    ))
+
+
+def _index_instances_in(index, model, instances):
+    from djangae.contrib.search.models import DocumentRecord
+
+    model_document, document_class = _registry[model]
+
+    field_names = model_document._meta().all_fields
+
+    # If an instance has already been indexed, we pass the existing
+    # record through so that only the tokens that have changed
+    # are written or deleted
+    instance_ids = [str(x.pk) for x in instances]
+    records = {}
+    duplicates = []
+    for i in range(0, len(instance_ids), _INSTANCE_LOOKUP_BATCH_SIZE):
+        for record in DocumentRecord.objects.filter(
+            index_stats_id=index.id,
+            instance_id__in=instance_ids[i:i + _INSTANCE_LOOKUP_BATCH_SIZE]
+        ):
+            if record.instance_id in records:
+                duplicates.append(record.pk)
+            else:
+                records[record.instance_id] = record
+
+    for instance in instances:
+        if str(instance.pk) not in records:
+            legacy = _legacy_records(index, instance.pk)
+            if legacy:
+                records[str(instance.pk)] = legacy[0]
+                duplicates.extend(x.pk for x in legacy[1:])
+
+    if duplicates:
+        index.remove(duplicates)
+
+    documents = []
+    for instance in instances:
+        attrs = {
+            f: model._meta.get_field(f).value_from_object(instance)
+            for f in field_names
+        }
+
+        attrs["instance_id"] = instance.pk
+
+        documents.append(
+            document_class(_record=records.get(str(instance.pk)), **attrs)
+        )
+
+    index.add(documents)
+
+
+def _index_instance(instance):
+    """
+        Adds (or updates) the document for the model instance
+        in the model document's index
+    """
+    _index_instances(type(instance), [instance])
+
+
+def _rebuild_index_batch(instances, model, index_name=None, swap=False):
+    """
+        Callback of rebuild_search_index, indexes a batch of instances
+        directly, without going through Model.save(). If index_name is
+        set, the instances are only indexed in that index.
+    """
+    indexes = None
+    if index_name:
+        model_document, _ = _registry[model]
+        indexes = [model_document.get_index(index_name)]
+
+    _index_instances(model, instances, indexes=indexes)
+
+
+def _rebuild_index_finalize(model, index_name=None, swap=False):
+    model_document, document_class = _registry[model]
+
+    # Every instance has now been indexed (as the document class indexes
+    # it now), so every record of an instance has its instance_id, and
+    # the prefixes of any fields which index them
+    if index_name:
+        indexes = [model_document.get_index(index_name)]
+    else:
+        indexes = model_document.indexes_for_writing()
+
+    for index in indexes:
+        index.mark_instance_ids_backfilled()
+        index.mark_prefixes_indexed(document_class)
+
+    if swap:
+        swap_alias(model_document.index_alias())
+
+    logger.info(
+        "Finished rebuilding the search index %s of %s",
+        index_name or model_document.index_alias(), model._meta.label
+    )
+
+
+def _unindex_instance(model, instance_id):
+    """
+        Removes any documents for the model instance from
+        the model document's index
+    """
+    from djangae.contrib.search.models import DocumentRecord
+
+    model_document, _ = _registry[model]
+
+    for index in model_document.indexes_for_writing():
+        results = list(DocumentRecord.objects.filter(
+            index_stats_id=index.id,
+            instance_id=str(instance_id)
+        ).values_list("pk", flat=True))
+
+        if not results:
+            results = [x.pk for x in _legacy_records(index, instance_id)]
+
+        index.remove(results)
+
+
+def _deferred_index_instance(model, instance_id, marker_id):
+    """
+        Task which indexes the current state of the model instance. Deletes the
+        marker first so that saves which happen while we're indexing will
+        defer another task.
+    """
+    from djangae.contrib.search.models import DeferredIndexingMarker
+
+    DeferredIndexingMarker.objects.filter(pk=marker_id).delete()
+
+    try:
+        instance = model.objects.get(pk=instance_id)
+    except model.DoesNotExist:
+        # The instance was deleted before we got here
+        _unindex_instance(model, instance_id)
+        return
+
+    _index_instance(instance)
+
+
+def _defer_index_instance(instance):
+    """
+        Defers indexing of the instance, unless there is already
+        an outstanding task to do so.
+    """
+    from djangae.contrib.search.models import DeferredIndexingMarker
+    from djangae.tasks.deferred import defer
+
+    model = type(instance)
+    model_document, _ = _registry[model]
+    meta = model_document._meta()
+
+    countdown = getattr(meta, "defer_indexing_countdown", _DEFAULT_DEFER_INDEXING_COUNTDOWN)
+    marker_id = DeferredIndexingMarker.generate_pk(model, instance.pk)
+
+    @transaction.atomic(independent=True)
+    def trans():
+        marker = DeferredIndexingMarker.objects.filter(pk=marker_id).first()
+        if marker:
+            age = (timezone.now() - marker.timestamp).total_seconds()
+            if age < _DEFERRED_INDEXING_MARKER_TIMEOUT_SECONDS:
+                # There's already a task waiting to index this instance
+                return
+
+            # The marker is stale, take it over
+            marker.timestamp = timezone.now()
+            marker.save()
+        else:
+            DeferredIndexingMarker.objects.create(pk=marker_id)
+
+        defer(
+            _deferred_index_instance,
+            model,
+            instance.pk,
+            marker_id,
+            _countdown=countdown,
+            _transactional=True
+        )
+
+    trans()
+
 
 class SearchManagerBase(object):
     pass
@@ -129,31 +433,44 @@ def register(model, model_document):
         return
 
     document_class = document_from_model_document(model, model_document)
+    _registry[model] = (model_document, document_class)
+
+    def _iter_search(query, **options):
+        """
+            Yields the model instance_ids from the results of the specified
+            query, the documents are fetched in batches as they're needed
+        """
+
+        index = model_document.index()
+        for document in index.search(query, document_class=document_class, **options):
+            yield document.instance_id
 
     def _do_search(query, **options):
         """
             Return a list of model instance_ids from the results
             of the specified query
         """
-
-        index = model_document.index()
-        documents = index.search(query, document_class=document_class, **options)
-        return [x.instance_id for x in documents]
+        return list(_iter_search(query, **options))
 
     class SearchQueryset(models.QuerySet):
         def search(self, query, ordered_ids=None, **options):
+            # This returns a queryset, so needs all the keys up front. Use
+            # iter_search_and_rank() to fetch the results in batches.
             keys = _do_search(query, **options)
             if ordered_ids is not None:
                 ordered_ids.extend(keys)
             return self.filter(pk__in=keys)
 
-        def search_and_rank(self, query, **options):
-            keys = _do_search(query, **options)
+        def search_and_rank(self, query, concurrent=False, **options):
+            return list(self.iter_search_and_rank(query, concurrent=concurrent, **options))
 
-            return sorted(
-                self.filter(pk__in=keys),
-                key=lambda x: keys.index(x.pk)
-            )
+        def iter_search_and_rank(self, query, concurrent=False, **options):
+            """
+                Like search_and_rank(), but the instances are fetched in batches
+                as they're iterated, so only the batches which are used are loaded
+            """
+            keys = _iter_search(query, **options)
+            return _iter_ranked_instances(self, keys, concurrent=concurrent)
 
     class SearchManager(default_manager, SearchManagerBase):
         def get_queryset(self):
@@ -175,26 +492,24 @@ def register(model, model_document):
                 query=query, **options
             )
 
+        def iter_search_and_rank(self, query, **options):
+            return self.get_queryset().iter_search_and_rank(
+                query=query, **options
+            )
+
     # FIXME: Is this safe? I feel like it should be but 'objects' is
     # a ManagerDescriptor so this might not be doing what I think it
     # is.
     model.objects.__class__ = SearchManager
 
     def delete_decorator(func):
-        from djangae.contrib.search.models import DocumentRecord
-
         @wraps(func)
         def wrapped(self, *args, **kwargs):
             instance_id = self.pk
 
             func(self, *args, **kwargs)
 
-            results = DocumentRecord.objects.filter(
-                data__instance_id=instance_id
-            ).values_list("pk", flat=True)
-
-            for result in results:
-                model_document.index().remove(result)
+            _unindex_instance(model, instance_id)
 
         return wrapped
 
@@ -205,18 +520,10 @@ def register(model, model_document):
         def wrapped(self, *args, **kwargs):
             func(self, *args, **kwargs)
 
-            # Force un-indexing before re-index
-            delete_decorator(lambda self: None)(self)
-
-            attrs = {
-                f: model._meta.get_field(f).value_from_object(self)
-                for f in model_document._meta().all_fields
-            }
-
-            attrs["instance_id"] = self.pk
-
-            doc = document_class(**attrs)
-            model_document.index().add(doc)
+            if getattr(model_document._meta(), "defer_indexing", False):
+                _defer_index_instance(self)
+            else:
+                _index_instance(self)
         return wrapped
 
     model.save = save_decorator(model.save)
@@ -1,10 +1,15 @@
 from django.db import models
+from django.utils import timezone
 
 from gcloudc.db.models.fields.related import RelatedSetField
 from gcloudc.db.models.fields.json import JSONField
 
 from .document import Document
-from .constants import WORD_DOCUMENT_JOIN_STRING
+from .fields import derive_tokens
+from .constants import (
+    TOKEN_FIELD_INDEX_STORAGE,
+    WORD_DOCUMENT_JOIN_STRING,
+)
 
 
 class DocumentRecord(models.Model):
@@ -23,13 +28,54 @@ class DocumentRecord(models.Model):
 
     # This allows for up-to 10000 unique terms in a single
     # document. We need this data when deleting a document
-    # from the index
+    # from the index. These are the keys of the document's postings
+    # whichever storage the index uses, but TokenFieldIndex instances
+    # only exist for indexes using TokenFieldIndexStorage.
+    # Tokens derived from the data (e.g. the prefixes of words) aren't
+    # stored here, see posting_keys()
     token_field_indexes = RelatedSetField("TokenFieldIndex")
 
     # This is the data at the time the field was indexed so the doc
     # can be reconstructed on fetch
     data = JSONField()
 
+    # The options for deriving tokens for each field of the data, as
+    # {field_name: options}, see fields.derive_tokens()
+    derived_token_options = JSONField(default=dict)
+
+    # If the document has an instance_id field (e.g. it was generated
+    # from a ModelDocument) then the value is stored here, so records
+    # can be looked up by instance without querying the JSON data
+    instance_id = models.CharField(max_length=500, null=True, default=None)
+
+    def posting_keys(self):
+        """
+            Returns the set of the keys of all the document's postings,
+            including those derived from its data
+        """
+        keys = set(self.token_field_indexes_ids)
+
+        options = self.derived_token_options or {}
+        if not options:
+            return keys
+
+        field_tokens = {}
+        for key in keys:
+            field_tokens.setdefault(
+                TokenFieldIndex.field_name_from_pk(key), set()
+            ).add(TokenFieldIndex.token_from_pk(key))
+
+        for field_name, field_options in options.items():
+            tokens = derive_tokens(
+                self.data.get(field_name), field_tokens.get(field_name, ()), field_options
+            )
+            keys.update(
+                TokenFieldIndex.generate_pk(self.index_stats_id, x, field_name, self.pk)
+                for x in tokens
+            )
+
+        return keys
+
 
 class TokenFieldIndex(models.Model):
     # key should be of the format WWWW|XXXX|YYYY|ZZZZ where:
@@ -47,6 +93,16 @@ class TokenFieldIndex(models.Model):
     token = models.CharField(max_length=500)
     field_name = models.CharField(max_length=500)
 
+    @classmethod
+    def generate_pk(cls, index_id, token, field_name, document_id):
+        """
+            Keys are deterministic, so they can be calculated without
+            touching the database
+        """
+        return WORD_DOCUMENT_JOIN_STRING.join(
+            [str(x) for x in (index_id, token, field_name, document_id)]
+        )
+
     @classmethod
     def document_id_from_pk(cls, pk):
         """
@@ -57,6 +113,20 @@ class TokenFieldIndex(models.Model):
 
         return int(pk.split(WORD_DOCUMENT_JOIN_STRING)[-1])
 
+    @classmethod
+    def token_from_pk(cls, pk):
+        """
+            Given a PK in the right format, return the token
+        """
+        return pk.split(WORD_DOCUMENT_JOIN_STRING)[1]
+
+    @classmethod
+    def field_name_from_pk(cls, pk):
+        """
+            Given a PK in the right format, return the field name
+        """
+        return pk.split(WORD_DOCUMENT_JOIN_STRING)[2]
+
     @property
     def document_id(self):
         return self.record_id
@@ -71,8 +141,8 @@ class TokenFieldIndex(models.Model):
 
         orig_pk = self.pk
 
-        self.pk = WORD_DOCUMENT_JOIN_STRING.join(
-            [str(x) for x in (self.index_stats_id, self.token, self.field_name, self.document_id)]
+        self.pk = self.generate_pk(
+            self.index_stats_id, self.token, self.field_name, self.document_id
         )
 
         # Just check that we didn't *change* the PK
@@ -90,4 +160,140 @@ class IndexStats(models.Model):
     """
 
     name = models.SlugField(max_length=100, primary_key=True)
-    document_count = models.PositiveIntegerField(default=0)
+
+    # False if the statistics of the index may not match the sharded
+    # counters (see counters.py), because it was populated before they were
+    # kept, or an update of them failed. The statistics are then counted
+    # from the records and postings of the index instead, until they're
+    # recounted (see counters.recount_counters()).
+    counters_valid = models.BooleanField(default=False)
+
+    # True while the statistics are being recounted to replace the
+    # counters, see counters.recount_counters()
+    recounting = models.BooleanField(default=False)
+
+    # False for indexes created before DocumentRecord.instance_id was
+    # stored, until every record has it (i.e. the index has been rebuilt).
+    # Until then, records are also looked up by the instance_id in their data
+    instance_ids_backfilled = models.BooleanField(default=False)
+
+    # The names of the fields which have been indexed without the prefixes
+    # of their words (see TextField.index_prefixes), so startswith searches
+    # scan their tokens instead. None for indexes created before prefixes
+    # were indexed, where no field has them until the index is rebuilt
+    unprefixed_fields = JSONField(null=True, default=None)
+
+    # How postings are stored for this index, see postings.py
+    storage = models.CharField(max_length=100, default=TOKEN_FIELD_INDEX_STORAGE)
+
+
+class IndexAlias(models.Model):
+    """
+        A name which resolves to an index, so that a replacement index
+        can be built under another name and then swapped in. See aliases.py
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+
+    # The name of the index which is searched
+    index_name = models.CharField(max_length=100)
+
+    # The name of an index which is being built to replace it. While this
+    # is set, documents are written to both indexes
+    building_index_name = models.CharField(max_length=100, null=True, default=None)
+
+    updated = models.DateTimeField(auto_now=True)
+
+
+class PostingBlock(models.Model):
+    """
+        A block of the postings for a token in a field, used by
+        PostingBlockStorage. The key is of the format WWWW|XXXX|YYYY|ZZZZ
+        where ZZZZ is the zero-padded ID of the first document the block
+        was created for. A document ID belongs to the block with the
+        greatest ZZZZ less than or equal to it.
+    """
+
+    # The width that document IDs are zero-padded to in keys
+    # so that blocks sort numerically
+    DOCUMENT_ID_WIDTH = 20
+
+    id = models.CharField(primary_key=True, max_length=1500, default=None)
+
+    index_stats = models.ForeignKey("IndexStats", on_delete=models.CASCADE)
+    token = models.CharField(max_length=500)
+    field_name = models.CharField(max_length=500)
+
+    # The sorted document IDs, delta and varint encoded
+    data = models.BinaryField(default=b"")
+
+    @classmethod
+    def generate_pk(cls, index_id, token, field_name, first_document_id):
+        return WORD_DOCUMENT_JOIN_STRING.join([
+            str(index_id), token, field_name,
+            str(first_document_id).zfill(cls.DOCUMENT_ID_WIDTH)
+        ])
+
+    @classmethod
+    def first_document_id_from_pk(cls, pk):
+        return int(pk.split(WORD_DOCUMENT_JOIN_STRING)[-1])
+
+    @property
+    def document_ids(self):
+        from .postings import decode_document_ids
+        return decode_document_ids(self.data)
+
+    @document_ids.setter
+    def document_ids(self, value):
+        from .postings import encode_document_ids
+        self.data = encode_document_ids(sorted(value))
+
+
+class CounterShard(models.Model):
+    """
+        One shard of a counter of the statistics of an index, see
+        counters.py. The key is of the format WWWW|XXXX|YYYY where
+        WWWW is the index ID, XXXX is the counter name, and YYYY is
+        the shard number.
+    """
+
+    id = models.CharField(primary_key=True, max_length=1500, default=None)
+
+    index_stats = models.ForeignKey("IndexStats", on_delete=models.CASCADE)
+    name = models.CharField(max_length=500)
+
+    # Only the sum of the shards is meaningful, so
+    # a single shard may be negative
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def generate_pk(cls, index_id, name, shard):
+        return WORD_DOCUMENT_JOIN_STRING.join([str(index_id), name, str(shard)])
+
+
+class PendingCounterUpdate(models.Model):
+    """
+        Exists while the postings of an index are being written, until the
+        counters have been updated to match (see counters.py). One which is
+        left behind means the counters may not match the postings.
+    """
+
+    index_stats = models.ForeignKey("IndexStats", on_delete=models.CASCADE)
+    created = models.DateTimeField(default=timezone.now)
+
+
+class DeferredIndexingMarker(models.Model):
+    """
+        Exists while there is an outstanding deferred task to
+        index a model instance. While it exists, further saves of
+        the instance don't defer additional tasks.
+    """
+
+    id = models.CharField(primary_key=True, max_length=1500, default=None)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def generate_pk(cls, model, instance_id):
+        return WORD_DOCUMENT_JOIN_STRING.join(
+            [model._meta.label_lower, str(instance_id)]
+        )
@@ -0,0 +1,504 @@
+"""
+    Storage backends for the postings of an index. A posting is the
+    fact that a token appears in a field of a document.
+
+    Whichever backend is used, postings are identified by keys of the
+    format WWWW|XXXX|YYYY|ZZZZ (see TokenFieldIndex) which are stored
+    on (or derived from) the DocumentRecord, so documents can be diffed
+    and unindexed without querying the postings themselves.
+"""
+
+import bisect
+
+from gcloudc.db import transaction
+
+from djangae.utils import retry
+
+from .constants import (
+    POSTING_BLOCK_STORAGE,
+    TOKEN_FIELD_INDEX_STORAGE,
+    WORD_DOCUMENT_JOIN_STRING,
+)
+
+# The Datastore allows up to 500 entities to be written
+# in a single batch
+_WRITE_BATCH_SIZE = 500
+
+# Postings are fetched in pages of this size
+_POSTINGS_PAGE_SIZE = 1000
+
+# Blocks are split when they grow beyond this many document IDs, and
+# merged with the previous block when they shrink below the minimum
+_MAX_BLOCK_SIZE = 2000
+_MIN_BLOCK_SIZE = _MAX_BLOCK_SIZE // 4
+
+# Posting blocks are fetched this many at a time
+_BLOCKS_PER_PAGE = 10
+
+# Each posting list touched by a write is read and written inside a
+# transaction, this is the number of posting lists per transaction
+_POSTING_LISTS_PER_TRANSACTION = 25
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _key_range(index, token, field=None, startswith=False):
+    """
+        Returns the (start, end) keys for postings of the
+        token (or tokens starting with it, if startswith is True)
+    """
+    start = "%s%s%s" % (index.id, WORD_DOCUMENT_JOIN_STRING, token)
+    if not startswith:
+        start += WORD_DOCUMENT_JOIN_STRING
+
+        if field:
+            start += "%s%s" % (field, WORD_DOCUMENT_JOIN_STRING)
+
+    return start, "%s%s" % (start, chr(0x10FFFF))
+
+
+def _token_range(index, low, low_inclusive, high, high_inclusive):
+    """
+        Returns the (start, end) keys for postings of tokens between
+        low and high
+    """
+    def key(token, after):
+        # All the keys for the token sort between "index|token|" and "index|token|\U0010FFFF"
+        key = "%s%s%s%s" % (index.id, WORD_DOCUMENT_JOIN_STRING, token, WORD_DOCUMENT_JOIN_STRING)
+        return key + chr(0x10FFFF) if after else key
+
+    return key(low, not low_inclusive), key(high, high_inclusive)
+
+
+def encode_document_ids(document_ids):
+    """
+        Encodes a sorted list of positive integers as the deltas
+        between them, each delta stored as a varint.
+    """
+    result = bytearray()
+
+    previous = 0
+    for document_id in document_ids:
+        delta = document_id - previous
+        previous = document_id
+
+        while delta > 0x7F:
+            result.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        result.append(delta)
+
+    return bytes(result)
+
+
+def decode_document_ids(data):
+    """
+        Reverses encode_document_ids()
+    """
+    result = []
+
+    current = 0
+    delta = 0
+    shift = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            current += delta
+            result.append(current)
+            delta = 0
+            shift = 0
+
+    return result
+
+
+class TokenFieldIndexStorage(object):
+    """
+        Stores each posting as a separate TokenFieldIndex entity,
+        keyed by the posting key.
+    """
+
+    name = TOKEN_FIELD_INDEX_STORAGE
+
+    def write(self, index, additions, removals):
+        """
+            additions: a dictionary of {posting_key: (token, field_name, document_id)}
+            removals: an iterable of posting keys
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        # Only write the TokenFieldIndex instances that don't exist yet. This
+        # is a batch of key gets, followed by a batch of puts.
+        token_field_indexes = {
+            pk: TokenFieldIndex(
+                pk=pk,
+                record_id=document_id,
+                token=token,
+                index_stats=index.index,
+                field_name=field_name
+            )
+            for pk, (token, field_name, document_id) in additions.items()
+        }
+
+        for chunk in _chunks(list(token_field_indexes), _WRITE_BATCH_SIZE):
+            for pk in TokenFieldIndex.objects.filter(pk__in=chunk).values_list("pk", flat=True):
+                token_field_indexes.pop(pk)
+
+        TokenFieldIndex.objects.bulk_create(
+            list(token_field_indexes.values()),
+            batch_size=_WRITE_BATCH_SIZE
+        )
+
+        for chunk in _chunks(list(removals), _WRITE_BATCH_SIZE):
+            TokenFieldIndex.objects.filter(pk__in=chunk).delete()
+
+    def delete_document(self, index, record):
+        self.delete_documents(index, [record])
+
+    def delete_documents(self, index, records):
+        """
+            Deletes the postings of the records. The keys are stored
+            on the records, so this is only key deletes.
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        keys = [x for record in records for x in record.posting_keys()]
+
+        for chunk in _chunks(keys, _WRITE_BATCH_SIZE):
+            TokenFieldIndex.objects.filter(pk__in=chunk).delete()
+
+    def iter_posting_pages(self, index, field, token):
+        """
+            Yields pages of document IDs which contain the token in
+            the field (or in any field, if field is None)
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        start, end = _key_range(index, token, field)
+
+        last_key = None
+        while True:
+            qs = TokenFieldIndex.objects.filter(pk__lt=end)
+            qs = qs.filter(pk__gt=last_key) if last_key else qs.filter(pk__gte=start)
+
+            keys = list(qs.order_by("pk").values_list("pk", flat=True)[:_POSTINGS_PAGE_SIZE])
+            if keys:
+                yield [TokenFieldIndex.document_id_from_pk(x) for x in keys]
+
+            if len(keys) < _POSTINGS_PAGE_SIZE:
+                return
+
+            last_key = keys[-1]
+
+    def iter_range_posting_pages(self, index, low, low_inclusive, high, high_inclusive):
+        """
+            Yields pages of document IDs which contain a token between
+            low and high. Range tokens include the field name (see
+            range_token_prefix), so these are the postings of one field.
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        start, end = _token_range(index, low, low_inclusive, high, high_inclusive)
+
+        last_key = None
+        while True:
+            qs = TokenFieldIndex.objects.filter(pk__lt=end)
+            qs = qs.filter(pk__gt=last_key) if last_key else qs.filter(pk__gte=start)
+
+            keys = list(qs.order_by("pk").values_list("pk", flat=True)[:_POSTINGS_PAGE_SIZE])
+            if keys:
+                yield [TokenFieldIndex.document_id_from_pk(x) for x in keys]
+
+            if len(keys) < _POSTINGS_PAGE_SIZE:
+                return
+
+            last_key = keys[-1]
+
+    def startswith_postings(self, index, field, prefix, limit):
+        """
+            Returns a list of up to `limit` (document_id, token) tuples for
+            tokens starting with prefix in the field (or any field)
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        start, end = _key_range(index, prefix, startswith=True)
+
+        qs = TokenFieldIndex.objects.filter(pk__gte=start, pk__lt=end)
+        if field:
+            qs = qs.filter(field_name=field)
+
+        return [
+            (TokenFieldIndex.document_id_from_pk(x), TokenFieldIndex.token_from_pk(x))
+            for x in qs.values_list("pk", flat=True)[:limit]
+        ]
+
+    def count_field_postings(self, index, field):
+        """
+            Returns the number of postings in the field
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        return TokenFieldIndex.objects.filter(index_stats_id=index.id, field_name=field).count()
+
+
+class PostingBlockStorage(object):
+    """
+        Stores the postings for each (token, field) as blocks of sorted,
+        delta-encoded document IDs. This uses far fewer entities (and
+        far less key storage) than TokenFieldIndexStorage, at the cost of
+        contention when the same tokens are indexed concurrently.
+    """
+
+    name = POSTING_BLOCK_STORAGE
+
+    def write(self, index, additions, removals):
+        """
+            additions: a dictionary of {posting_key: (token, field_name, document_id)}
+            removals: an iterable of posting keys
+        """
+        from .models import TokenFieldIndex  # Prevent import too early
+
+        # Group the changes by posting list
+        changes = {}
+        for token, field_name, document_id in additions.values():
+            changes.setdefault((token, field_name), (set(), set()))[0].add(document_id)
+
+        for key in removals:
+            token = TokenFieldIndex.token_from_pk(key)
+            field_name = TokenFieldIndex.field_name_from_pk(key)
+            document_id = TokenFieldIndex.document_id_from_pk(key)
+            changes.setdefault((token, field_name), (set(), set()))[1].add(document_id)
+
+        posting_lists = sorted(changes)
+        for chunk in _chunks(posting_lists, _POSTING_LISTS_PER_TRANSACTION):
+            @transaction.atomic(independent=True)
+            def update():
+                for token, field_name in chunk:
+                    added, removed = changes[(token, field_name)]
+                    self._update_posting_list(index, token, field_name, added, removed)
+
+            retry(update)
+
+    def _update_posting_list(self, index, token, field_name, added, removed):
+        from .models import PostingBlock  # Prevent import too early
+
+        start, end = _key_range(index, token, field_name)
+
+        # Blocks are routed to by the document ID in their key, so
+        # we only need the keys to know which blocks to read
+        block_keys = list(
+            PostingBlock.objects.filter(
+                pk__gte=start, pk__lt=end
+            ).order_by("pk").values_list("pk", flat=True)
+        )
+        block_starts = [PostingBlock.first_document_id_from_pk(x) for x in block_keys]
+
+        def route(document_id):
+            # The block with the greatest start <= document_id, or the
+            # first block if there isn't one
+            return block_keys[max(bisect.bisect_right(block_starts, document_id) - 1, 0)]
+
+        touched = set()
+        if block_keys:
+            touched.update(route(x) for x in added | removed)
+
+            # We may need to merge the touched blocks into the ones before them
+            for key in list(touched):
+                i = block_keys.index(key)
+                if i > 0:
+                    touched.add(block_keys[i - 1])
+
+        blocks = {
+            x.pk: x for x in PostingBlock.objects.filter(pk__in=list(touched))
+        }
+
+        document_ids = {
+            key: set(block.document_ids) for key, block in blocks.items()
+        }
+
+        if not block_keys and added:
+            # Nothing indexed for this token/field yet, so start the
+            # posting list with a block that everything routes to
+            key = PostingBlock.generate_pk(index.id, token, field_name, 0)
+            block_keys.append(key)
+            block_starts.append(0)
+            document_ids[key] = set()
+
+        for document_id in added:
+            document_ids[route(document_id)].add(document_id)
+
+        for document_id in removed:
+            document_ids.get(route(document_id), set()).discard(document_id)
+
+        # A list of [key, document_ids, index of the source block]
+        final = []
+        to_delete = set()
+
+        for i, key in enumerate(block_keys):
+            if key not in document_ids:
+                continue
+
+            ids = sorted(document_ids[key])
+
+            if i > 0 and not ids:
+                # The first block is only deleted with the whole posting list
+                # so that there's always a block to route to
+                to_delete.add(key)
+                continue
+
+            if (
+                i > 0 and final and final[-1][2] == i - 1 and
+                len(ids) < _MIN_BLOCK_SIZE and
+                len(ids) + len(final[-1][1]) <= _MAX_BLOCK_SIZE
+            ):
+                # Merge into the previous block
+                final[-1][1] = sorted(final[-1][1] + ids)
+                to_delete.add(key)
+                continue
+
+            parts = 1
+            if len(ids) > _MAX_BLOCK_SIZE:
+                if (
+                    i > 0 and final and final[-1][2] == i - 1 and
+                    len(final[-1][1]) < _MIN_BLOCK_SIZE
+                ):
+                    # Split the small previous block along with this one,
+                    # rather than leaving it small
+                    to_delete.add(key)
+                    key, previous_ids, _ = final.pop()
+                    ids = previous_ids + ids
+
+                # Split large blocks into equal parts, leaving room for each part to grow
+                parts = -(-len(ids) // (_MAX_BLOCK_SIZE // 2))
+
+            for j in range(parts):
+                part = ids[len(ids) * j // parts:len(ids) * (j + 1) // parts]
+                part_key = key if j == 0 else PostingBlock.generate_pk(index.id, token, field_name, part[0])
+                final.append([part_key, part, i])
+
+        # A split can reuse the key of a block it replaces
+        to_delete.difference_update(x[0] for x in final)
+
+        untouched = [x for x in block_keys if x not in document_ids]
+        if not untouched and not any(x[1] for x in final):
+            # The whole posting list is empty
+            to_delete.update(x[0] for x in final)
+            final = []
+
+        for key, ids, _ in final:
+            block = blocks.get(key) or PostingBlock(
+                pk=key,
+                index_stats=index.index,
+                token=token,
+                field_name=field_name,
+            )
+            block.document_ids = ids
+            block.save()
+
+        PostingBlock.objects.filter(pk__in=[x for x in to_delete if x in blocks]).delete()
+
+    def delete_document(self, index, record):
+        self.delete_documents(index, [record])
+
+    def delete_documents(self, index, records):
+        """
+            Deletes the postings of the records. Each posting list
+            is only updated once, however many of the records it has.
+        """
+        self.write(
+            index, {}, [x for record in records for x in record.posting_keys()]
+        )
+
+    def iter_posting_pages(self, index, field, token):
+        """
+            Yields pages of document IDs which contain the token in
+            the field (or in any field, if field is None)
+        """
+        from .models import PostingBlock  # Prevent import too early
+
+        start, end = _key_range(index, token, field)
+
+        last_key = None
+        while True:
+            qs = PostingBlock.objects.filter(pk__lt=end)
+            qs = qs.filter(pk__gt=last_key) if last_key else qs.filter(pk__gte=start)
+
+            blocks = list(qs.order_by("pk")[:_BLOCKS_PER_PAGE])
+            for block in blocks:
+                yield block.document_ids
+
+            if len(blocks) < _BLOCKS_PER_PAGE:
+                return
+
+            last_key = blocks[-1].pk
+
+    def iter_range_posting_pages(self, index, low, low_inclusive, high, high_inclusive):
+        """
+            Yields pages of document IDs which contain a token between
+            low and high. Range tokens include the field name (see
+            range_token_prefix), so these are the postings of one field.
+        """
+        from .models import PostingBlock  # Prevent import too early
+
+        start, end = _token_range(index, low, low_inclusive, high, high_inclusive)
+
+        last_key = None
+        while True:
+            qs = PostingBlock.objects.filter(pk__lt=end)
+            qs = qs.filter(pk__gt=last_key) if last_key else qs.filter(pk__gte=start)
+
+            blocks = list(qs.order_by("pk")[:_BLOCKS_PER_PAGE])
+            for block in blocks:
+                yield block.document_ids
+
+            if len(blocks) < _BLOCKS_PER_PAGE:
+                return
+
+            last_key = blocks[-1].pk
+
+    def startswith_postings(self, index, field, prefix, limit):
+        """
+            Returns a list of up to `limit` (document_id, token) tuples for
+            tokens starting with prefix in the field (or any field)
+        """
+        from .models import PostingBlock  # Prevent import too early
+
+        start, end = _key_range(index, prefix, startswith=True)
+
+        qs = PostingBlock.objects.filter(pk__gte=start, pk__lt=end)
+        if field:
+            qs = qs.filter(field_name=field)
+
+        result = []
+        for block in qs:
+            result.extend((x, block.token) for x in block.document_ids)
+            if len(result) >= limit:
+                break
+
+        return result[:limit]
+
+    def count_field_postings(self, index, field):
+        """
+            Returns the number of postings in the field
+        """
+        from .models import PostingBlock  # Prevent import too early
+
+        return sum(
+            len(x.document_ids)
+            for x in PostingBlock.objects.filter(index_stats_id=index.id, field_name=field)
+        )
+
+
+_STORAGES = {
+    x.name: x for x in (TokenFieldIndexStorage, PostingBlockStorage)
+}
+
+
+def get_storage(name):
+    try:
+        return _STORAGES[name or TOKEN_FIELD_INDEX_STORAGE]()
+    except KeyError:
+        raise ValueError("Unknown posting storage: %s" % name)
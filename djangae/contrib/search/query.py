@@ -1,33 +1,90 @@
-from django.db.models import Q
+import base64
+import heapq
+import itertools
+import json
+from collections import (
+    Counter,
+    namedtuple,
+)
+from functools import lru_cache
+from hashlib import md5
+
+from django.utils import dateparse
 
 from .constants import (
+    DATE_RANGE_PREFIX,
+    FACET_TOKEN_MARKER,
+    MAX_PREFIX_LENGTH,
+    NUMBER_RANGE_PREFIX,
+    PREFIX_TOKEN_MARKER,
     STOP_WORDS,
 )
 
+from .concurrency import map_concurrently
+from .counters import (
+    document_frequency,
+    get_counters,
+)
+from .indexers import (
+    DEFAULT_MIN_INDEX_LENGTH,
+    stem_word,
+    stemming,
+)
 from .models import (
-    WORD_DOCUMENT_JOIN_STRING,
     DocumentRecord,
+    IndexStats,
     TokenFieldIndex,
 )
 
-from .tokens import tokenize_content
+from .tokens import (
+    date_range_token,
+    number_range_token,
+    prefix_token,
+    range_token_prefix,
+    shingle_phrase,
+    tokenize_content,
+    tokenize_phrase,
+    trigram_tokens,
+)
 
 
-# Searching for common tokens can result
-# in huge result sets - so this is a hard limit
+# Searching for common tokens with startswith matching
+# can result in huge result sets - so this is a hard limit
 # on that result set.
 #
-# Unfortunately, it's not possible to rank the token
-# queries to know which are more relevant so this limit
+# Unfortunately, prefix matches can't make use of the token
+# statistics to rank the token queries, so this limit
 # may result in some missing results in the final resultset.
-
-# FIXME: Come up with a solution to this. This may involve searching
-# the resulting documents for tokens that had been artificially limited at the
-# query phase (e.g. if a token query returns 5000 results, we then
-# do some additional work on documents returned by other tokens, but
-# not returned by the limited token query)
 _PER_TOKEN_HARD_QUERY_LIMIT = 5000
 
+# The number of DocumentRecords fetched in a single batch when checking
+# candidate documents for tokens we haven't fetched the postings of
+_RECORD_BATCH_SIZE = 1000
+
+# When searching with trigrams, the postings of the rarest trigrams of
+# a term are read until this many postings would be exceeded. Documents
+# must then contain at least this fraction of the trigrams that were read.
+_MAX_TRIGRAM_POSTINGS = 5000
+_MIN_TRIGRAM_SIMILARITY = 0.5
+
+# Facets are counted from the posting keys on the records of the matching
+# documents. If there are more than this many, they're counted from a
+# sample of this many of them instead.
+_MAX_RECORD_FACET_DOCUMENTS = 1000
+
+# The records of the documents with an indexed prefix are fetched to score
+# the tokens they matched, unless there are more than this many. Then the
+# tokens starting with the prefix are scanned instead.
+_MAX_PREFIX_RECORDS = 500
+
+# Parsed queries are cached in each process, this is the
+# number of query plans that are kept
+_QUERY_PLAN_CACHE_SIZE = 1000
+
+# Operators which can prefix a value in a field query to make
+# a range query, e.g. price:<100. Longest first.
+_RANGE_OPERATORS = (">=", "<=", ">", "<")
+
 
 def _tokenize_query_string(query_string, match_stopwords):
     """
@@ -89,8 +146,12 @@ def _tokenize_query_string(query_string, match_stopwords):
         branch_result = []
 
         for field, token in branch:
+            bounds = _parse_range(field, token) if field else None
+
             if token[0] == '"' and token[-1] == '"':
                 branch_result.append(("exact", field, token.strip('"')))
+            elif bounds:
+                branch_result.append(("range", field, bounds))
             else:
                 branch_result.append(("word", field, token))
 
@@ -103,7 +164,7 @@ def _tokenize_query_string(query_string, match_stopwords):
         start_length = len(branch_result)
         for i in range(start_length):
             kind, field, content = branch_result[i]
-            if kind == "exact":
+            if kind != "word":
                 continue
 
             # Split on punctuation, remove double-spaces
@@ -137,37 +198,141 @@ def _tokenize_query_string(query_string, match_stopwords):
     #     [("word", None, "pikachu")], [("word", "name", "charmander")],
     #     [("exact", "name", 'mew two')], [("exact", None, 'mr mime')]
     # ]
+    #
+    # Range queries (e.g. price:<100) are ("range", field, bounds) where bounds
+    # is a tuple, see _parse_range()
 
     return result
 
 
-def _append_exact_word_filters(filters, prefix, field, string):
-    start = "%s%s%s" % (prefix, string, WORD_DOCUMENT_JOIN_STRING)
-    end = "%s%s%s%s" % (prefix, string, WORD_DOCUMENT_JOIN_STRING, chr(0x10FFFF))
-
-    if not field:
-        filters |= Q(pk__gte=start, pk__lt=end)
+def _parse_range(field, content):
+    """
+        If content is a range query on a number or date (e.g. <100 or
+        >=2020-01-01) returns the bounds of the range tokens of the field
+        to search for as (low, low_inclusive, high, high_inclusive).
+        Otherwise returns None.
+    """
+    for operator in _RANGE_OPERATORS:
+        if content.startswith(operator):
+            break
     else:
-        filters |= Q(pk__gte=start, pk__lt=end, field_name=field)
+        return None
+
+    value = content[len(operator):]
 
-    return filters
+    try:
+        token = number_range_token(field, int(value))
+        prefix = range_token_prefix(NUMBER_RANGE_PREFIX, field)
+    except ValueError:
+        try:
+            value = dateparse.parse_date(value) or dateparse.parse_datetime(value)
+        except ValueError:
+            # Looked like a date, but wasn't valid
+            value = None
 
+        if value is None:
+            return None
 
-def _append_startswith_word_filters(filters, prefix, field, string):
-    start = "%s%s" % (prefix, string)
-    end = "%s%s%s" % (prefix, string, chr(0x10FFFF))
+        token = date_range_token(field, value)
+        prefix = range_token_prefix(DATE_RANGE_PREFIX, field)
 
-    if not field:
-        filters |= Q(pk__gte=start, pk__lt=end)
+    # Start with the range of all tokens of this kind in the field
+    low, low_inclusive = prefix, True
+    high, high_inclusive = prefix + chr(0x10FFFF), False
+
+    if operator.startswith(">"):
+        low, low_inclusive = token, operator == ">="
     else:
-        filters |= Q(pk__gte=start, pk__lt=end, field_name=field)
+        high, high_inclusive = token, operator == "<="
+
+    return (low, low_inclusive, high, high_inclusive)
+
+
+def _in_range(token, bounds):
+    low, low_inclusive, high, high_inclusive = bounds
+    return (
+        (token > low or (low_inclusive and token == low)) and
+        (token < high or (high_inclusive and token == high))
+    )
+
+
+def _iter_term_pages(index, field, kind, content):
+    """
+        Yields pages of the IDs of documents matching a word, stem or range term
+    """
+    if kind == "range":
+        # The range tokens are only those of the field
+        return index.storage.iter_range_posting_pages(index, *content)
+
+    if kind == "stem":
+        # Documents with either the word or its stem, a document
+        # may be in both
+        word, stemmed = content
+        return itertools.chain(
+            index.storage.iter_posting_pages(index, field, word),
+            index.storage.iter_posting_pages(index, field, stemmed),
+        )
 
-    return filters
+    return index.storage.iter_posting_pages(index, field, content)
 
 
-def _append_stemming_word_filters(filters, prefix, field, string):
-    # FIXME: Implement
-    return filters
+class QueryPlan(namedtuple("QueryPlan", ("key", "branches", "match_all", "use_startswith", "use_trigrams"))):
+    """
+        A parsed query. branches is a tuple of the branches to evaluate, each
+        a tuple of (kind, field, content) terms. key is the same for all the
+        plans of equivalent queries (with the same options), so it can be
+        used to identify the query when caching.
+    """
+    __slots__ = ()
+
+
+@lru_cache(maxsize=_QUERY_PLAN_CACHE_SIZE)
+def get_query_plan(
+    query_string,
+    match_stopwords=True,
+    match_all=True,
+    use_startswith=False,
+    use_stemming=False,
+    use_trigrams=False,
+):
+    """
+        Returns the QueryPlan for the query_string. Plans are immutable
+        so they're cached, and shared between searches.
+    """
+    options = dict(
+        match_stopwords=match_stopwords,
+        match_all=match_all,
+        use_startswith=use_startswith,
+        use_stemming=use_stemming,
+        use_trigrams=use_trigrams,
+    )
+
+    branches = _tokenize_query_string(query_string, match_stopwords=match_stopwords)
+
+    if not match_all:
+        # If match_all is false, we split the branches into a branch per token
+        branches = [[token] for branch in branches for token in branch]
+
+    # Trigrams are only indexed for words, so phrases are matched word by word
+    branches = _expand_phrases(branches, as_words=use_trigrams)
+
+    if use_stemming:
+        branches = _stem_terms(branches)
+
+    branches = tuple(tuple(branch) for branch in branches)
+
+    # The key is built from what's actually searched for, so that query
+    # strings which parse differently never share a key
+    key = repr((branches, sorted(options.items())))
+    key = md5(key.encode("utf-8")).hexdigest()
+
+    return QueryPlan(
+        key=key,
+        branches=branches,
+        match_all=match_all,
+        use_startswith=use_startswith,
+        use_trigrams=use_trigrams,
+    )
 
 
 def build_document_queryset(
@@ -176,84 +341,633 @@ def build_document_queryset(
     use_startswith=False,
     match_stopwords=True,
     match_all=True,
+    limit=None,
+    use_trigrams=False,
+    matched_ids=None,
+    after=None,
+    plan=None,
+    document_class=None,
 ):
 
     """
-        Returns a tuple of (queryset, doc_ids) where doc_ids is the ordered
-        set of document ids based on simple ranking rules.
+        Returns a tuple of (queryset, ranking) where the queryset returns the
+        top `limit` matching documents, and ranking is a dictionary of
+        {document_id: (rank, score)} for those documents based on simple
+        ranking rules.
+
+        If matched_ids is a list, it's populated with the IDs of all the
+        matching documents, not just the top `limit`.
+
+        If after is a (score, document_id) tuple, only the documents ranked
+        after that document are returned (see decode_cursor).
+
+        If plan is given, it's used instead of parsing the query_string
+        (and the parsing options are ignored).
+
+        If document_class is given, stems are only searched for in the
+        fields of the document class which index them.
     """
 
     assert(index.id)
 
-    tokenization = _tokenize_query_string(query_string, match_stopwords=match_stopwords)
+    if plan is None:
+        plan = get_query_plan(
+            query_string,
+            match_stopwords=match_stopwords,
+            match_all=match_all,
+            use_startswith=use_startswith,
+            use_stemming=use_stemming,
+            use_trigrams=use_trigrams,
+        )
+
+    tokenization = plan.branches
     if not tokenization:
-        return DocumentRecord.objects.none()
+        return DocumentRecord.objects.none(), {}
+
+    tokenization = _resolve_stem_terms(
+        tokenization, document_class, plan.use_startswith, plan.use_trigrams
+    )
+
+    if plan.use_trigrams:
+        doc_scores = _evaluate_trigram_branches(index, tokenization)
+    elif plan.use_startswith:
+        doc_scores = _evaluate_startswith_branches(
+            index, tokenization, plan.match_all, document_class=document_class
+        )
+    else:
+        # Documents outside the top results are pruned, unless we need all of them
+        doc_scores = _evaluate_exact_branches(
+            index, tokenization, limit if matched_ids is None else None,
+            after=after,
+        )
 
-    if not match_all:
-        # If match_all is false, we split the branches into a branch per token
-        split_branches = []
-        for branch in tokenization:
-            for token in branch:
-                split_branches.append([token])
-        tokenization = split_branches
+    if matched_ids is not None:
+        matched_ids.extend(doc_scores)
 
-    # We now need to gather document IDs, for each branch we need to
-    # look for matching tokens in a single query, then post-process them
-    # to only fetch documents that match all of them.
+    ranking = _rank_documents(doc_scores, limit, after)
+    results = DocumentRecord.objects.filter(pk__in=list(ranking))
+    return results, ranking
 
-    doc_scores = {}
-    for branch in tokenization:
-        tokens = set([x[-1] for x in branch])
 
-        # All queries need to prefix the index
-        prefix = "%s%s" % (str(index.id), WORD_DOCUMENT_JOIN_STRING)
-        filters = Q()
+def encode_cursor(plan, score, document_id):
+    """
+        Returns an opaque cursor for resuming a search (with the same
+        query plan) after the document with the given score
+    """
+    data = json.dumps([plan.key, score, document_id])
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
 
-        for kind, field, string in branch:
-            if kind == "word":
-                filters = _append_exact_word_filters(filters, prefix, field, string)
-                if use_startswith:
-                    filters = _append_startswith_word_filters(
-                        filters, prefix, field, string
-                    )
-
-                if use_stemming:
-                    filters = _append_stemming_word_filters(
-                        filters, prefix, field, string,
-                    )
+
+def decode_cursor(cursor, plan):
+    """
+        Returns the (score, document_id) of the last document before
+        the cursor. Raises a ValueError if the cursor is invalid, or is
+        for a different query plan.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        plan_key, score, document_id = json.loads(data)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+
+    if plan_key != plan.key:
+        raise ValueError("The cursor is for a different query")
+
+    return score, document_id
+
+
+def _expand_phrases(branches, as_words=False):
+    """
+        Replaces the exact (phrase) terms in the branches with a word term
+        for each shingle of the phrase, which are indexed for TextFields
+        with index_phrases=True. A phrase of a single word is just a word.
+
+        If as_words is True, phrases are replaced with a term for each word
+        instead.
+    """
+    result = []
+    for branch in branches:
+        expanded = []
+        for kind, field, content in branch:
+            if kind != "exact":
+                expanded.append((kind, field, content))
+                continue
+
+            words = tokenize_phrase(content)
+            if len(words) == 1 or as_words:
+                expanded.extend(("word", field, x) for x in words)
             else:
-                raise NotImplementedError("Need to implement exact matching")
+                expanded.extend(("word", field, x) for x in shingle_phrase(words))
+
+        if expanded:
+            result.append(expanded)
+
+    return result
+
+
+def _stem_terms(branches):
+    """
+        Replaces the word terms in the branches with ("stem", field, (word, stem))
+        terms, which match documents with either the word or its stem. Stems
+        are only indexed (alongside the words) for fields with the stemming
+        indexer, see _resolve_stem_terms.
+    """
+    result = []
+    for branch in branches:
+        stemmed_branch = []
+        for kind, field, content in branch:
+            if kind == "word":
+                stemmed = stem_word(content)
+                if stemmed != content:
+                    kind, content = "stem", (content, stemmed)
+            stemmed_branch.append((kind, field, content))
+        result.append(stemmed_branch)
+
+    return result
+
+
+def _stem_min_lengths(document_class):
+    """
+        Returns a dictionary of {field_name: min_index_length} for
+        the fields of the document class which index stems
+    """
+    return {
+        name: field.options["min_index_length"]
+        for name, field in document_class.get_fields().items()
+        if stemming in getattr(field, "indexers", ())
+    }
+
+
+def _resolve_stem_terms(branches, document_class, use_startswith, use_trigrams):
+    """
+        Returns the branches with the stem terms replaced by word terms
+        wherever the stem can't have been indexed: the field (or, for terms
+        without a field, every field) of the document class doesn't index
+        stems, or the stem is shorter than the field's min_index_length.
+
+        Startswith searches use the stem as the prefix when the word starts
+        with it (so the word still matches), and trigram searches use the
+        word, as words are matched by similarity anyway.
+    """
+    if not any(kind == "stem" for branch in branches for kind, _, _ in branch):
+        return branches
+
+    min_lengths = _stem_min_lengths(document_class) if document_class else None
+
+    def resolve(term):
+        kind, field, content = term
+        if kind != "stem":
+            return term
+
+        word, stemmed = content
+        if min_lengths is not None:
+            lengths = [
+                length for name, length in min_lengths.items()
+                if not field or name == field
+            ]
+            if not any(len(stemmed) >= x for x in lengths):
+                return ("word", field, word)
+
+        if use_trigrams:
+            return ("word", field, word)
+
+        if use_startswith:
+            return ("word", field, stemmed if word.startswith(stemmed) else word)
+
+        return term
+
+    return tuple(tuple(resolve(x) for x in branch) for branch in branches)
+
+
+def count_facets(index, document_ids, facets, sample_size=None):
+    """
+        Returns a dictionary of {field_name: {value: count}} of the values
+        of the facet fields in the documents, most common first. If
+        sample_size is given, and there are more documents than that,
+        the counts are estimated from an evenly spaced sample of them.
+        The sample is never more than _MAX_RECORD_FACET_DOCUMENTS.
+    """
+    document_ids = sorted(set(document_ids))
+
+    sample_size = min(sample_size or _MAX_RECORD_FACET_DOCUMENTS, _MAX_RECORD_FACET_DOCUMENTS)
+
+    scale = 1
+    if len(document_ids) > sample_size:
+        step = len(document_ids) / sample_size
+        sample = [document_ids[int(i * step)] for i in range(sample_size)]
+        scale = len(document_ids) / len(sample)
+        document_ids = sample
+
+    def is_facet_token(token):
+        # The marker on its own is the punctuation token, not a facet
+        return token.startswith(FACET_TOKEN_MARKER) and token != FACET_TOKEN_MARKER
 
-        keys = TokenFieldIndex.objects.filter(
-            filters
-        ).values_list("pk", flat=True)[:_PER_TOKEN_HARD_QUERY_LIMIT]
+    counts = {x: Counter() for x in facets}
+
+    for doc_tokens in _RecordTokens().get(document_ids).values():
+        for token, field_name in doc_tokens:
+            if field_name in counts and is_facet_token(token):
+                counts[field_name][token[1:]] += 1
+
+    return {
+        field_name: {
+            value: int(round(count * scale)) for value, count in counter.most_common()
+        }
+        for field_name, counter in counts.items()
+    }
+
+
+def _rank_documents(doc_scores, limit=None, after=None):
+    """
+        Given a dictionary of {document_id: score}, returns a dictionary
+        of {document_id: (rank, score)} for the `limit` highest scoring
+        documents. Ties are broken by document ID so ranking is deterministic.
+
+        If after is a (score, document_id) tuple, only documents ranked
+        after that document are included.
+    """
+
+    def key(item):
+        return (-item[1], item[0])
+
+    items = doc_scores.items()
+    if after is not None:
+        boundary = (-after[0], after[1])
+        items = [x for x in items if key(x) > boundary]
+
+    if limit is None:
+        ranked = sorted(items, key=key)
+    else:
+        # Only keep the top `limit` scores rather than sorting everything
+        ranked = heapq.nsmallest(limit, items, key=key)
+
+    return {
+        doc_id: (rank, score)
+        for rank, (doc_id, score) in enumerate(ranked)
+    }
+
+
+def _token_score(token):
+    return 0.25 if token in STOP_WORDS else 1.0  # 1/4 pt for stop words
+
+
+def _document_frequencies(index, tokens):
+    """
+        Returns a dictionary of {token: document_frequency} for the
+        tokens. Tokens which aren't indexed have a frequency of 0.
+    """
+    names = {document_frequency(x): x for x in tokens}
+
+    return {
+        names[name]: count
+        for name, count in get_counters(index, list(names)).items()
+    }
+
+
+class _RecordTokens(object):
+    """
+        Lazily fetches (in batches) and caches the (token, field_name)
+        pairs of DocumentRecords, so that documents can be checked for
+        tokens without fetching the postings for those tokens.
+
+        This can be shared between threads, although records may then
+        be fetched more than once.
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, document_ids):
+        missing = [x for x in document_ids if x not in self._cache]
+        for i in range(0, len(missing), _RECORD_BATCH_SIZE):
+            chunk = missing[i:i + _RECORD_BATCH_SIZE]
+
+            for record in DocumentRecord.objects.filter(pk__in=chunk):
+                self._cache[record.pk] = set(
+                    (TokenFieldIndex.token_from_pk(x), TokenFieldIndex.field_name_from_pk(x))
+                    for x in record.posting_keys()
+                )
+
+            for document_id in chunk:
+                self._cache.setdefault(document_id, set())
+
+        return {x: self._cache[x] for x in document_ids}
+
+
+def _branch_matches(branch, tokens):
+    """
+        Returns True if the (token, field_name) pairs of a document
+        satisfy all the terms in the branch
+    """
+    for kind, field, token in branch:
+        if kind == "range":
+            if not any(_in_range(x[0], token) for x in tokens if not field or x[1] == field):
+                return False
+        elif kind == "stem":
+            if not any(x[0] in token for x in tokens if not field or x[1] == field):
+                return False
+        elif field:
+            if (token, field) not in tokens:
+                return False
+        elif not any(x[0] == token for x in tokens):
+            return False
+    return True
+
+
+def _evaluate_exact_branches(index, branches, limit, after=None):
+    """
+        Returns a dictionary of {document_id: score} for documents matching
+        the branches. Each branch contributes a fixed score to every document
+        that matches all of its tokens, which allows for MaxScore-style pruning:
+
+        Branches are evaluated rarest-first, using the document frequency of
+        each token. Once no document which hasn't been seen yet could score
+        highly enough to make the top `limit` results, we stop reading postings
+        and only check the candidates that could still change the top results.
+
+        The scores of documents which can't make the top `limit` may be
+        incomplete.
+
+        If after is a (score, document_id) tuple, the top results are those
+        ranked after it, so only documents which must score lower than it
+        count towards the threshold.
+
+        Documents which could tie with the lowest of the top results are
+        never pruned. Ties are broken by document ID when ranking, but the
+        postings are read in key order, which isn't the same (e.g. "10"
+        sorts before "9").
+    """
+    tokens = set()
+    for branch in branches:
+        for kind, _, content in branch:
+            if kind == "word":
+                tokens.add(content)
+            elif kind == "stem":
+                tokens.update(content)
+
+    frequencies = _document_frequencies(index, tokens)
+
+    def frequency(term):
+        # Tokens which aren't indexed have a frequency of 0, so they're read
+        # first (which is cheap, as they have no postings). Ranges are
+        # treated as common.
+        kind, _, content = term
+        if kind == "word":
+            return frequencies.get(content, float("inf"))
+        elif kind == "stem":
+            # At most, every document with the word or its stem
+            return sum(frequencies.get(x, float("inf")) for x in content)
+        return float("inf")
+
+    # Remove duplicate terms, and order rarest-first
+    branches = [
+        sorted(set(branch), key=frequency)
+        for branch in branches
+    ]
+    branches.sort(key=lambda x: frequency(x[0]))
+
+    weights = [
+        # Stems are scored as the word that was searched for
+        sum(_token_score(x) for x in set(x[-1][0] if x[0] == "stem" else x[-1] for x in branch))
+        for branch in branches
+    ]
+
+    def start_pages(branch):
+        # Fetches the first page of postings for the rarest term of the branch
+        kind, field, token = branch[0]
+        pages = iter(_iter_term_pages(index, field, kind, token))
+        first = next(pages, None)
+        return pages if first is None else itertools.chain([first], pages)
+
+    # The first pages of the branches are fetched at the same time, in case
+    # they're needed. Further pages are only fetched if they could change
+    # the top results.
+    branch_pages = map_concurrently(start_pages, branches)
+
+    record_tokens = _RecordTokens()
+    doc_scores = {}
+
+    def threshold(bound):
+        # The lowest score which is currently in the top results. bound is
+        # the most that any score could still increase by.
+        if limit is None:
+            return None
+
+        scores = doc_scores.values()
+        if after is not None:
+            scores = [x for x in scores if x + bound < after[0]]
+
+        if len(scores) < limit:
+            return None
+        return heapq.nlargest(limit, scores)[-1]
+
+    def prunable(max_score, theta):
+        # True if a document which scores at most max_score can't make the top results
+        if theta is None:
+            return False
+        return max_score < theta
+
+    for i, branch in enumerate(branches):
+        weight = weights[i]
+
+        # The highest score a document could get if it had
+        # not matched any previous branch
+        upper_bound = sum(weights[i:])
+        remaining_bound = upper_bound - weight
+
+        seen = set()
+        exhausted = True
+
+        theta = threshold(upper_bound)
+        if not prunable(upper_bound, theta):
+            for page in branch_pages[i]:
+                matched = set(page) - seen
+                seen.update(matched)
+
+                if len(branch) > 1:
+                    # Check the remaining tokens on the records, rather
+                    # than reading the postings for more common tokens
+                    matched = [
+                        doc_id for doc_id, doc_tokens in record_tokens.get(list(matched)).items()
+                        if _branch_matches(branch[1:], doc_tokens)
+                    ]
+
+                for doc_id in matched:
+                    doc_scores[doc_id] = doc_scores.get(doc_id, 0) + weight
+
+                theta = threshold(upper_bound)
+                if prunable(upper_bound, theta):
+                    # No document we haven't seen could make the top results
+                    exhausted = False
+                    break
+        else:
+            exhausted = False
+
+        if exhausted:
+            continue
+
+        # Check the candidates which could still change the top results
+        # for this branch
+        candidates = [
+            doc_id for doc_id, score in doc_scores.items()
+            if doc_id not in seen and not prunable(score + weight + remaining_bound, theta)
+        ]
+
+        for doc_id, doc_tokens in record_tokens.get(candidates).items():
+            if _branch_matches(branch, doc_tokens):
+                doc_scores[doc_id] += weight
+
+    return doc_scores
+
+
+def _prefix_postings(index, field, prefix, record_tokens):
+    """
+        Returns a list of (document_id, token) tuples for tokens starting
+        with prefix in the field (or any field), using the indexed prefix.
+        The tokens are taken from the records so that matches can be scored
+        by the length of the matched token.
+
+        Returns None if more than _MAX_PREFIX_RECORDS documents have the
+        prefix, as fetching their records would cost more than scanning
+        the keys of their tokens.
+    """
+    document_ids = {}
+    for page in index.storage.iter_posting_pages(index, field, prefix_token(prefix)):
+        # The same document may have the prefix in multiple fields
+        document_ids.update(dict.fromkeys(page))
+        if len(document_ids) > _MAX_PREFIX_RECORDS:
+            return None
+
+    return [
+        (doc_id, token)
+        for doc_id, doc_tokens in record_tokens.get(list(document_ids)).items()
+        for token, field_name in doc_tokens
+        if token.startswith(prefix) and not token.startswith(PREFIX_TOKEN_MARKER) and
+        (not field or field_name == field)
+    ]
+
+
+def _unprefixed_fields(document_class, field, unprefixed_index_fields):
+    """
+        Returns a list of the fields which must be scanned for tokens
+        starting with a term in the field (or, if field is None, any field),
+        as their prefixes aren't indexed for every document of the index.
+        Returns None if the prefix can't be looked up in any of the fields.
+
+        unprefixed_index_fields is IndexStats.unprefixed_fields
+    """
+    if document_class is None or unprefixed_index_fields is None:
+        return None
+
+    fields = [
+        x for name, x in document_class.get_fields().items()
+        if name != "id" and x.index and (not field or x.attname == field)
+    ]
+
+    unprefixed = [
+        x.attname for x in fields
+        if not getattr(x, "index_prefixes", False) or x.attname in unprefixed_index_fields
+    ]
+
+    if len(unprefixed) == len(fields):
+        return None
+
+    return unprefixed
+
+
+def _evaluate_startswith_branches(index, branches, match_all, document_class=None):
+    """
+        Returns a dictionary of {document_id: score} for documents
+        with tokens that start with the tokens in the branches.
+    """
+    # Prefixes are looked up directly in the fields which index them
+    # (TextFields with index_prefixes=True), if they have been indexed for
+    # every document of the index and aren't longer than MAX_PREFIX_LENGTH.
+    # Tokens starting with the prefix are scanned in any other fields the
+    # term could match.
+    words = [
+        x for branch in branches for x in branch
+        if x[0] == "word" and len(x[-1]) <= MAX_PREFIX_LENGTH
+    ]
+
+    unprefixed_index_fields = None
+    if words and document_class is not None:
+        # Another process may have indexed documents without prefixes
+        unprefixed_index_fields = IndexStats.objects.filter(
+            pk=index.id
+        ).values_list("unprefixed_fields", flat=True).first()
+
+    prefix_terms = {}
+    for term in words:
+        scanned_fields = _unprefixed_fields(document_class, term[1], unprefixed_index_fields)
+        if scanned_fields is not None:
+            prefix_terms[term] = scanned_fields
+
+    record_tokens = _RecordTokens()
+
+    def fetch(term):
+        kind, field, string = term
+        if kind == "range":
+            document_ids = set()
+            for page in _iter_term_pages(index, field, kind, string):
+                document_ids.update(page)
+                if len(document_ids) >= _PER_TOKEN_HARD_QUERY_LIMIT:
+                    break
+            return document_ids
+
+        if term in prefix_terms:
+            postings = _prefix_postings(index, field, string, record_tokens)
+            if postings is not None:
+                for name in prefix_terms[term]:
+                    postings.extend(index.storage.startswith_postings(
+                        index, name, string, _PER_TOKEN_HARD_QUERY_LIMIT
+                    ))
+                return postings
+
+        return index.storage.startswith_postings(
+            index, field, string, _PER_TOKEN_HARD_QUERY_LIMIT
+        )
+
+    # The terms are independent, so are fetched concurrently
+    terms = list(dict.fromkeys(x for branch in branches for x in branch))
+    fetched = dict(zip(terms, map_concurrently(fetch, terms)))
+
+    doc_scores = {}
+    for branch in branches:
+        tokens = set([x[-1] for x in branch if x[0] == "word"])
 
         doc_results = {}
 
-        for pk in keys:
-            doc_id = TokenFieldIndex.document_id_from_pk(pk)
-            token = pk.split("|")[1]
-            doc_results.setdefault(doc_id, set()).add(token)
+        # Documents matching all the range terms in the branch
+        range_matches = None
+        range_count = 0
+
+        for term in branch:
+            if term[0] == "range":
+                document_ids = fetched[term]
+                range_matches = document_ids if range_matches is None else range_matches & document_ids
+                range_count += 1
+                continue
+
+            for doc_id, token in fetched[term]:
+                doc_results.setdefault(doc_id, set()).add(token)
 
         def calculate_score(searched, tokens):
             score = 0
             for token in tokens:
-                if token in STOP_WORDS:
-                    score += 0.25  # 1/4 pt for stop words
+                if token in STOP_WORDS or token in searched:
+                    score += _token_score(token)
                 else:
-                    if token in searched:
-                        score += 1.0  # 1 point for exact match
-                    else:
-                        potentials = []
-                        for searched_token in searched:
-                            if token.startswith(searched_token):
-                                potentials.append(searched_token)
+                    potentials = []
+                    for searched_token in searched:
+                        if token.startswith(searched_token):
+                            potentials.append(searched_token)
 
-                        # Find the closest match (which would be the shortest)
-                        best = sorted(potentials, key=lambda x: len(x))[0]
+                    # Find the closest match (which would be the shortest)
+                    best = sorted(potentials, key=lambda x: len(x))[0]
 
-                        # Just use a percentage of matched length
-                        score += len(best) / len(token)
+                    # Just use a percentage of matched length
+                    score += len(best) / len(token)
 
             return score
 
@@ -262,29 +976,132 @@ def build_document_queryset(
                 # Match all, means match all
                 return True
 
-            if use_startswith:
-                # We need to make sure that each searched token matched at least
-                # one found token
-                for stoken in searched:
-                    for ftoken in found:
-                        if ftoken.startswith(stoken):
-                            break
-                    else:
-                        # Went through all found tokens and couldn't
-                        # find one that matched the searched token
-                        return False
-                return True
+            # We need to make sure that each searched token matched at least
+            # one found token
+            for stoken in searched:
+                for ftoken in found:
+                    if ftoken.startswith(stoken):
+                        break
+                else:
+                    # Went through all found tokens and couldn't
+                    # find one that matched the searched token
+                    return False
+            return True
+
+        if range_matches is not None:
+            if tokens:
+                doc_results = {
+                    doc_id: found_tokens for doc_id, found_tokens in doc_results.items()
+                    if doc_id in range_matches
+                }
             else:
-                return len(searched) == len(found)
+                doc_results = {doc_id: set() for doc_id in range_matches}
 
         for doc_id, found_tokens in doc_results.items():
             if compare_tokens(tokens, found_tokens):
                 doc_scores[doc_id] = doc_scores.get(doc_id, 0) + calculate_score(
                     tokens, found_tokens
-                )
+                ) + range_count
 
-    document_ids = [
-        x[0] for x in sorted(doc_scores.items(), key=lambda x: -x[1])
-    ]
-    results = DocumentRecord.objects.filter(pk__in=document_ids)
-    return results, document_ids
+    return doc_scores
+
+
+def _trigram_similarities(index, field, term, frequencies):
+    """
+        Returns a dictionary of {document_id: similarity} for documents
+        containing a word in the field (or any field) similar to the term.
+        The similarity is the fraction of the trigrams of the term that
+        the word shares.
+    """
+    if len(term) < DEFAULT_MIN_INDEX_LENGTH:
+        # Trigrams aren't indexed for short words, so they must match exactly
+        return {
+            doc_id: 1.0
+            for page in index.storage.iter_posting_pages(index, field, term)
+            for doc_id in page
+        }
+
+    trigrams = trigram_tokens(term)
+
+    # Read the rarest trigrams first, and stop before reading too many postings
+    indexed = sorted((x for x in trigrams if frequencies.get(x)), key=frequencies.get)
+
+    selected = []
+    postings = 0
+    for trigram in indexed:
+        if selected and postings + frequencies[trigram] > _MAX_TRIGRAM_POSTINGS:
+            break
+
+        selected.append(trigram)
+        postings += frequencies[trigram]
+
+    # Trigrams that aren't indexed anywhere still count as not matching
+    total = len(selected) + len(trigrams) - len(indexed)
+
+    overlaps = Counter()
+    for trigram in selected:
+        document_ids = set()
+        for page in index.storage.iter_posting_pages(index, field, trigram):
+            document_ids.update(page)
+        overlaps.update(document_ids)
+
+    similarities = {
+        doc_id: count / total for doc_id, count in overlaps.items()
+    }
+
+    return {
+        doc_id: similarity for doc_id, similarity in similarities.items()
+        if similarity >= _MIN_TRIGRAM_SIMILARITY
+    }
+
+
+def _evaluate_trigram_branches(index, branches):
+    """
+        Returns a dictionary of {document_id: score} for documents with
+        words similar to all the terms of a branch, using the trigrams
+        indexed by the trigrams indexer. Documents score the sum of the
+        similarities of the terms.
+    """
+    frequencies = _document_frequencies(index, set(
+        trigram
+        for branch in branches
+        for kind, _, term in branch if kind == "word"
+        for trigram in trigram_tokens(term)
+    ))
+
+    def fetch(term):
+        kind, field, content = term
+        if kind == "range":
+            return {
+                doc_id: 1.0
+                for page in _iter_term_pages(index, field, kind, content)
+                for doc_id in page
+            }
+
+        return _trigram_similarities(index, field, content, frequencies)
+
+    # The terms are independent, so are fetched concurrently
+    terms = list(dict.fromkeys(x for branch in branches for x in branch))
+    similarities = dict(zip(terms, map_concurrently(fetch, terms)))
+
+    doc_scores = {}
+    for branch in branches:
+        branch_scores = None
+
+        for term in branch:
+            term_scores = similarities[term]
+
+            if branch_scores is None:
+                branch_scores = dict(term_scores)
+            else:
+                # Documents must match all the terms in the branch
+                branch_scores = {
+                    doc_id: score + term_scores[doc_id]
+                    for doc_id, score in branch_scores.items()
+                    if doc_id in term_scores
+                }
+
+        for doc_id, score in branch_scores.items():
+            doc_scores[doc_id] = doc_scores.get(doc_id, 0) + score
+
+    return doc_scores
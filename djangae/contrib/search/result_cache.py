@@ -0,0 +1,109 @@
+"""
+    A cache of search rankings, stored in the Django cache.
+
+    Each index has a generation number which is part of every cache key
+    for that index. Adding or removing documents bumps the generation so
+    that previously cached results are never read again (they'll just
+    expire).
+"""
+
+import threading
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+
+CACHE_TIME = getattr(settings, "DJANGAE_SEARCH_CACHE_TIME", 5 * 60)
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _generation_cache_key(index_id):
+    return "_SEARCH_GENERATION_{}".format(index_id)
+
+
+def _initial_generation():
+    # If the generation is evicted from the cache, it must not restart
+    # at a number that was used before, so start from the current time
+    return int(time.time() * 1000000)
+
+
+def _get_generation(index_id):
+    cache_key = _generation_cache_key(index_id)
+
+    generation = cache.get(cache_key)
+    if generation is None:
+        cache.add(cache_key, _initial_generation(), None)
+        generation = cache.get(cache_key)
+
+    return generation
+
+
+def bump_generation(index_id):
+    """
+        Invalidates all the cached results for the index
+    """
+    cache_key = _generation_cache_key(index_id)
+
+    try:
+        cache.incr(cache_key)
+    except ValueError:
+        # The key doesn't exist
+        cache.add(cache_key, _initial_generation(), None)
+
+
+def result_cache_key(index_id, plan_key, options):
+    """
+        Returns the cache key for the query plan (see QueryPlan.key) and
+        options in the current generation of the index. This should be
+        generated before the search is performed, so that if the index
+        changes during the search the results are stored under the old
+        generation.
+    """
+    generation = _get_generation(index_id)
+
+    if generation is None:
+        # The cache isn't storing anything
+        return None
+
+    key = repr((
+        index_id, generation, plan_key, sorted(options.items())
+    ))
+    return "_SEARCH_RESULT_{}".format(md5(key.encode("utf-8")).hexdigest())
+
+
+def _record(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_ranking(cache_key):
+    """
+        Returns the cached ranking, or None if it isn't cached
+    """
+    ranking = cache.get(cache_key) if cache_key else None
+
+    _record("misses" if ranking is None else "hits")
+    return ranking
+
+
+def set_ranking(cache_key, ranking):
+    if cache_key:
+        cache.set(cache_key, ranking, CACHE_TIME)
+
+
+def get_stats():
+    """
+        Returns a dictionary of the number of cache hits and misses
+        in this process
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
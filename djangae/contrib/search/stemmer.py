@@ -0,0 +1,177 @@
+"""
+    A pure Python implementation of the Porter stemming algorithm:
+    https://tartarus.org/martin/PorterStemmer/def.txt
+
+    Words are expected to be lower case.
+"""
+
+_VOWELS = frozenset("aeiou")
+
+_STEP_2_SUFFIXES = (
+    ("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"),
+    ("izer", "ize"), ("abli", "able"), ("alli", "al"), ("entli", "ent"),
+    ("eli", "e"), ("ousli", "ous"), ("ization", "ize"), ("ation", "ate"),
+    ("ator", "ate"), ("alism", "al"), ("iveness", "ive"), ("fulness", "ful"),
+    ("ousness", "ous"), ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble"),
+)
+
+_STEP_3_SUFFIXES = (
+    ("icate", "ic"), ("ative", ""), ("alize", "al"), ("iciti", "ic"),
+    ("ical", "ic"), ("ful", ""), ("ness", ""),
+)
+
+_STEP_4_SUFFIXES = (
+    "al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement",
+    "ment", "ent", "ion", "ou", "ism", "ate", "iti", "ous", "ive", "ize",
+)
+
+
+def _is_consonant(word, i):
+    c = word[i]
+    if c in _VOWELS:
+        return False
+
+    if c == "y":
+        # y is a consonant at the start of a word, or after a vowel
+        return i == 0 or not _is_consonant(word, i - 1)
+
+    return True
+
+
+def _measure(stem):
+    """
+        Returns m, where the stem is of the form [C](VC){m}[V]
+    """
+    m = 0
+    previous_vowel = False
+    for i in range(len(stem)):
+        vowel = not _is_consonant(stem, i)
+        if previous_vowel and not vowel:
+            m += 1
+        previous_vowel = vowel
+    return m
+
+
+def _contains_vowel(stem):
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_double_consonant(word):
+    return (
+        len(word) > 1 and word[-1] == word[-2] and _is_consonant(word, len(word) - 1)
+    )
+
+
+def _ends_cvc(word):
+    """
+        True if the word ends consonant-vowel-consonant, where the
+        last consonant isn't w, x or y (e.g. hop, but not snow)
+    """
+    return (
+        len(word) > 2 and
+        _is_consonant(word, len(word) - 3) and
+        not _is_consonant(word, len(word) - 2) and
+        _is_consonant(word, len(word) - 1) and
+        word[-1] not in "wxy"
+    )
+
+
+def _replace_suffix(word, suffixes, min_measure):
+    """
+        Replaces the first matching suffix, if the remaining stem
+        has a measure greater than min_measure
+    """
+    for suffix, replacement in suffixes:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if _measure(stem) > min_measure:
+                return stem + replacement
+            return word
+    return word
+
+
+def _step_1a(word):
+    if word.endswith("sses"):
+        return word[:-2]
+    if word.endswith("ies"):
+        return word[:-2]
+    if word.endswith("ss"):
+        return word
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def _step_1b(word):
+    if word.endswith("eed"):
+        stem = word[:-3]
+        return stem + "ee" if _measure(stem) > 0 else word
+
+    for suffix in ("ed", "ing"):
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if not _contains_vowel(stem):
+                return word
+
+            if stem.endswith(("at", "bl", "iz")):
+                return stem + "e"
+
+            if _ends_double_consonant(stem) and stem[-1] not in "lsz":
+                return stem[:-1]
+
+            if _measure(stem) == 1 and _ends_cvc(stem):
+                return stem + "e"
+
+            return stem
+
+    return word
+
+
+def _step_1c(word):
+    if word.endswith("y") and _contains_vowel(word[:-1]):
+        return word[:-1] + "i"
+    return word
+
+
+def _step_4(word):
+    for suffix in _STEP_4_SUFFIXES:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if _measure(stem) <= 1:
+                return word
+
+            if suffix == "ion" and not stem.endswith(("s", "t")):
+                return word
+
+            return stem
+    return word
+
+
+def _step_5(word):
+    if word.endswith("e"):
+        stem = word[:-1]
+        m = _measure(stem)
+        if m > 1 or (m == 1 and not _ends_cvc(stem)):
+            word = stem
+
+    if _measure(word) > 1 and _ends_double_consonant(word) and word.endswith("l"):
+        word = word[:-1]
+
+    return word
+
+
+def stem(word):
+    """
+        Returns the stem of the word, e.g. "running" -> "run"
+    """
+    if len(word) <= 2:
+        return word
+
+    word = _step_1a(word)
+    word = _step_1b(word)
+    word = _step_1c(word)
+    word = _replace_suffix(word, _STEP_2_SUFFIXES, 0)
+    word = _replace_suffix(word, _STEP_3_SUFFIXES, 0)
+    word = _step_4(word)
+    word = _step_5(word)
+    return word
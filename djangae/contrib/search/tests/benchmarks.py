@@ -0,0 +1,221 @@
+"""
+    Benchmarks for the tokenizer. These don't need the database so can
+    be run directly (with DJANGO_SETTINGS_MODULE set):
+
+        python -m djangae.contrib.search.tests.benchmarks
+
+    Each benchmark tokenizes generated documents of a realistic size and
+    checks that the output matches reference_tokenize_content, which is
+    the original (slow, but simple) implementation of tokenize_content.
+    Both are timed, and the exit status is non-zero if tokenize_content
+    is slower than the reference for any document size, or isn't at least
+    MIN_SPEEDUP times faster for the largest. The reference is quadratic
+    in the length of the document, so just being faster than it doesn't
+    rule out a regression. tokenize_content must also take about the same
+    time per word for large documents full of acronyms as for small ones
+    (see scaling()), which the tests check too.
+"""
+
+import random
+import sys
+import timeit
+
+from djangae.contrib.search.constants import (
+    PUNCTUATION,
+    WORD_DOCUMENT_JOIN_STRING,
+)
+from djangae.contrib.search.tokens import (
+    is_digit_or_single_char,
+    tokenize_content,
+)
+
+# (name, number of words) of the generated documents
+DOCUMENT_SIZES = (
+    ("title", 8),
+    ("paragraph", 150),
+    ("article", 2500),
+    ("book chapter", 25000),
+)
+
+# How many times faster than the reference tokenize_content must be for
+# the largest document (it's around 75x when measured)
+MIN_SPEEDUP = 20
+
+# (small, large) numbers of words of the documents compared by scaling()
+SCALING_SIZES = (2500, 25000)
+
+# How many times longer per word tokenize_content may take for the large
+# document than the small one. It's around 1x when measured, where the
+# reference takes around 8x
+MAX_SLOWDOWN = 3
+
+_WORDS = (
+    "the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "search",
+    "index", "Datastore", "query", "café", "naïve", "don't", "e-mail",
+)
+
+_SPECIALS = (
+    "I-B-M", "U.S.A", "2020-01-01", "1.2.3", "a-b", "100%", "(note)",
+    "name:value", "foo|bar", "x.y", "end.", "--", "\n", "\t",
+)
+
+
+def reference_tokenize_content(content):
+    """
+        The original implementation of tokenize_content(), which the
+        current implementation must match exactly
+    """
+
+    tokens = []
+    current = ""
+
+    STOP_CHARS = list(PUNCTUATION) + [" "]
+
+    for c in content:
+        if c in STOP_CHARS:
+            if current.strip():
+                tokens.append(current)
+
+            if c.strip() and c != WORD_DOCUMENT_JOIN_STRING:
+                tokens.append(c)
+
+            current = ""
+        else:
+            current += c
+    else:
+        if current.strip():
+            tokens.append(current)
+
+    new_tokens = []
+    tokens_to_append = []
+    indexes_to_remove = []
+
+    ACRONYM_TOKENS = (".", "-")
+    current_at = None
+    # Detect acronyms
+    acronym_run = 0
+    for i, token in enumerate(tokens):
+        if (
+            ((acronym_run and token == current_at) or (not acronym_run and token in ACRONYM_TOKENS)) and
+                i > 0 and tokens[i - 1] != token and is_digit_or_single_char(tokens[i - 1])
+        ):
+            acronym_run += 1
+            if acronym_run == 1:
+                current_at = token
+        else:
+            if acronym_run > 1 and token != current_at:
+                start = i - (2 * acronym_run)
+
+                original = "".join(tokens[start:start + (acronym_run * 2) + 1])
+                parts = [tokens[start + (x * 2)] for x in range(acronym_run + 1)]
+                acronym = "".join(parts)
+
+                # Add variations of the acronym
+                new_tokens.append(acronym)
+                new_tokens.append(".".join(parts))
+                new_tokens.append("-".join(parts))
+
+                # Remove the original characters
+                indexes_to_remove.extend(range(start, start + (acronym_run * 2) + 1))
+
+                if original in new_tokens:
+                    new_tokens.remove(original)
+
+                # Extend a single token made up of the whole original acronym
+                # rather than seperate chars
+                tokens_to_append.append(original)
+
+                acronym_run = 0
+            elif i > 0 and (tokens[i - 1] != current_at or not is_digit_or_single_char(token)):
+                acronym_run = 0
+
+    tokens = [x for i, x in enumerate(tokens) if i not in indexes_to_remove]
+    tokens.extend(tokens_to_append)
+    return tokens, new_tokens
+
+
+def generate_document(word_count, seed=0, special_rate=0.1):
+    """
+        Returns text of word_count words, mostly plain words with
+        punctuation, acronyms and dates mixed in (special_rate is
+        the fraction of words which are one of those)
+    """
+    rng = random.Random(seed)
+
+    words = []
+    for i in range(word_count):
+        if rng.random() < special_rate:
+            words.append(rng.choice(_SPECIALS))
+        else:
+            words.append(rng.choice(_WORDS))
+
+        if rng.random() < 0.05:
+            words.append(rng.choice(sorted(PUNCTUATION)))
+
+    return " ".join(words)
+
+
+def _time(function, document, repeat):
+    # The fastest of `repeat` runs, in seconds per call
+    number = max(1, 25000 // len(document.split()))
+    timings = timeit.repeat(lambda: function(document), number=number, repeat=repeat)
+    return min(timings) / number
+
+
+def run(repeat=5):
+    """
+        Returns a list of (name, word_count, seconds, reference_seconds) for
+        the fastest of `repeat` tokenizations of each document size, by
+        tokenize_content and reference_tokenize_content
+    """
+    results = []
+
+    for name, word_count in DOCUMENT_SIZES:
+        document = generate_document(word_count)
+
+        if tokenize_content(document) != reference_tokenize_content(document):
+            raise AssertionError("tokenize_content doesn't match the reference for the %s" % name)
+
+        results.append((
+            name,
+            word_count,
+            _time(tokenize_content, document, repeat),
+            _time(reference_tokenize_content, document, repeat),
+        ))
+
+    return results
+
+
+def scaling(function=tokenize_content, repeat=3):
+    """
+        Returns how many times longer per word the function takes to
+        tokenize a large document than a small one (see SCALING_SIZES),
+        when most of their words are acronyms or dates
+    """
+    small, large = [generate_document(x, special_rate=0.5) for x in SCALING_SIZES]
+
+    return (
+        (_time(function, large, repeat) / SCALING_SIZES[1]) /
+        (_time(function, small, repeat) / SCALING_SIZES[0])
+    )
+
+
+if __name__ == "__main__":
+    regressed = False
+    for name, word_count, seconds, reference_seconds in run():
+        speedup = reference_seconds / seconds
+        minimum = MIN_SPEEDUP if word_count == DOCUMENT_SIZES[-1][1] else 1
+        regressed = regressed or speedup < minimum
+
+        print("%-15s %6d words %10.3f ms (reference %10.3f ms, %.1fx)" % (
+            name, word_count, seconds * 1000, reference_seconds * 1000, speedup
+        ))
+
+    slowdown = scaling()
+    regressed = regressed or slowdown > MAX_SLOWDOWN
+
+    print("%d words take %.1fx as long per word as %d words" % (
+        SCALING_SIZES[1], slowdown, SCALING_SIZES[0]
+    ))
+
+    sys.exit(1 if regressed else 0)
@@ -8,3 +8,7 @@ class SearchableModel1(models.Model):
 
 class SearchableModel2(models.Model):
     sid = models.CharField(primary_key=True, max_length=10)
+
+
+class SearchableModel3(models.Model):
+    name = models.CharField(max_length=128)
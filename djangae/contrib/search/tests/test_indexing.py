@@ -1,9 +1,35 @@
+from datetime import timedelta
 from unittest import skip
 
-from djangae.contrib.search import fields, IntegrityError
+from django.utils import timezone
+
+from djangae.contrib import sleuth
+from djangae.contrib.search import counters, fields, indexers, IntegrityError
 from djangae.contrib.search.document import Document
-from djangae.contrib.search.index import Index
-from djangae.contrib.search.models import TokenFieldIndex
+from djangae.contrib.search.index import (
+    Index,
+    drop_index,
+    get_index,
+    invalidate_index,
+)
+from djangae.contrib.search.constants import POSTING_BLOCK_STORAGE
+from djangae.contrib.search.models import (
+    CounterShard,
+    DocumentRecord,
+    IndexStats,
+    PendingCounterUpdate,
+    PostingBlock,
+    TokenFieldIndex,
+)
+from djangae.contrib.search.postings import (
+    decode_document_ids,
+    encode_document_ids,
+)
+from djangae.contrib.search.tests import benchmarks
+from djangae.contrib.search.tests.benchmarks import (
+    generate_document,
+    reference_tokenize_content,
+)
 from djangae.contrib.search.tokens import tokenize_content
 from djangae.test import TestCase
 
@@ -28,6 +54,54 @@ class DocumentTests(TestCase):
         doc2 = DocTwo()
         self.assertEqual(3, len(doc2.get_fields()))
 
+    def test_field_schema_inherited(self):
+        class DocOne(Document):
+            text = fields.TextField()
+            atom = fields.AtomField(default="atom")
+
+        class DocTwo(DocOne):
+            text = fields.TextField(default="text")
+            number = fields.NumberField()
+
+        self.assertEqual(list(DocTwo.get_fields()), ["atom", "id", "number", "text"])
+        self.assertEqual(DocTwo.get_field("text").attname, "text")
+        self.assertIsNot(DocTwo.get_field("text"), DocOne.get_field("text"))
+
+        doc = DocTwo(number=1)
+        self.assertEqual(doc.text, "text")
+        self.assertEqual(doc.atom, "atom")
+        self.assertEqual(doc.number, 1)
+        self.assertIsNone(doc.id)
+
+        self.assertIsNone(DocOne().text)
+
+        self.assertRaises(ValueError, DocTwo, unknown=1)
+
+        # Fields are still readable on the class
+        self.assertIs(DocTwo.text, DocTwo.get_field("text"))
+        self.assertIs(DocTwo.atom, DocOne.atom)
+
+        # get_fields() can still be called on documents
+        self.assertEqual(doc.get_fields(), DocTwo.get_fields())
+
+    def test_field_schema_multiple_inheritance(self):
+        class NameDoc(Document):
+            name = fields.TextField()
+
+        class PriceDoc(Document):
+            price = fields.NumberField(default=0)
+
+        class ProductDoc(NameDoc, PriceDoc):
+            pass
+
+        self.assertEqual(list(ProductDoc.get_fields()), ["id", "name", "price"])
+
+        doc = ProductDoc(name="Cheese", price=3)
+        self.assertEqual(doc.name, "Cheese")
+        self.assertEqual(doc.price, 3)
+        self.assertEqual(ProductDoc().price, 0)
+        self.assertIs(ProductDoc.name, NameDoc.name)
+
 
 class IndexingTests(TestCase):
     @skip("Atom fields not implemented")
@@ -100,14 +174,13 @@ class IndexingTests(TestCase):
             [x.id for x in results]
         )
 
-        # FIXME: Uncomment when exact matching is implemented
-        # results = [x for x in index.search('"cheese" OR pickle', document_class=Doc)]
+        results = [x for x in index.search('"cheese" OR pickle', document_class=Doc)]
 
-        # # Both documents should have come back
-        # self.assertCountEqual(
-        #   [doc.id, doc2.id],
-        #   [x.id for x in results]
-        # )
+        # Both documents should have come back
+        self.assertCountEqual(
+            [doc.id, doc2.id],
+            [x.id for x in results]
+        )
 
     def test_removing_document(self):
 
@@ -188,6 +261,466 @@ class IndexingTests(TestCase):
         self.assertFalse([x for x in i1.search("text:Three", Doc)])
         self.assertFalse([x for x in i1.search("text:3", Doc)])
 
+    def test_removing_documents_in_batches(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        i0 = Index(name="index1")
+        i1 = Index(name="index2")
+
+        docs = [Doc(text="cheese %s" % i) for i in range(5)]
+        i0.add(docs)
+        other = i1.add(Doc(text="cheese"))
+
+        with sleuth.switch("djangae.contrib.search.index._WRITE_BATCH_SIZE", 2):
+            # Duplicates, unknown IDs and documents in other indexes aren't counted
+            removed = i0.remove(docs[:3] + [docs[0].id, other, 999999], concurrent=True)
+
+        self.assertEqual(removed, 3)
+        self.assertEqual(i0.document_count(), 2)
+        self.assertEqual(i0.document_frequency("cheese"), 2)
+        self.assertEqual(i1.document_count(), 1)
+
+        self.assertCountEqual(i0.search("cheese", Doc), docs[3:])
+        self.assertEqual(TokenFieldIndex.objects.filter(index_stats_id=i0.id).count(), 4)
+
+        self.assertEqual(i0.remove(docs[3:]), 2)
+        self.assertEqual(TokenFieldIndex.objects.filter(index_stats_id=i0.id).count(), 0)
+
+    def test_statistics_counted_for_old_indexes(self):
+        """
+            Indexes populated before their statistics were kept in
+            counters have them counted from their records and postings
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        self.assertTrue(index.index.counters_valid)
+        index.add([Doc(text="cheese %s" % i) for i in range(5)])
+
+        IndexStats.objects.filter(pk="index1").update(counters_valid=False)
+        CounterShard.objects.filter(index_stats_id="index1").delete()
+
+        index = Index(name="index1")
+        self.assertEqual(index.document_count(), 5)
+        self.assertEqual(index.document_frequency("cheese"), 5)
+        self.assertEqual(index.field_token_count("text"), 10)
+
+        # The counters aren't written to
+        index.add(Doc(text="cheese"))
+        self.assertFalse(CounterShard.objects.filter(index_stats_id="index1").exists())
+        self.assertEqual(index.document_count(), 6)
+        self.assertEqual(index.document_frequency("cheese"), 6)
+
+    def test_failed_counter_update_invalidates_counters(self):
+        """
+            If the counters can't be updated after the postings have been
+            written, they're counted from then on rather than drifting
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        index.add(Doc(text="cheese"))
+
+        def fail(func):
+            raise ValueError("Contention")
+
+        with sleuth.switch("djangae.contrib.search.counters.retry", fail):
+            index.add(Doc(text="cheese pickle"))
+
+        self.assertFalse(index.index.counters_valid)
+        self.assertFalse(IndexStats.objects.get(pk="index1").counters_valid)
+
+        self.assertEqual(index.document_count(), 2)
+        self.assertEqual(index.document_frequency("cheese"), 2)
+        self.assertEqual(index.document_frequency("pickle"), 1)
+
+        # Other handles of the index see that the counters are invalid
+        other = Index(name="index1")
+        other.index.counters_valid = True
+        self.assertEqual(other.document_frequency("onion"), 0)
+        self.assertFalse(other.index.counters_valid)
+
+    def test_range_and_facet_tokens_not_counted(self):
+        class Doc(Document):
+            price = fields.NumberField()
+            category = fields.AtomField()
+
+        index = Index(name="index1")
+        index.add(Doc(price=5, category="Shoes"))
+
+        names = CounterShard.objects.filter(index_stats_id="index1").values_list("name", flat=True)
+        self.assertCountEqual(
+            set(names),
+            [
+                counters.DOCUMENT_COUNT,
+                counters.field_token_count("price"),
+                counters.field_token_count("category"),
+                counters.document_frequency("5"),
+                counters.document_frequency("shoes"),
+            ]
+        )
+
+    def test_derived_tokens_not_counted(self):
+        """
+            Document frequencies aren't kept for prefixes, trigrams and
+            phrase shingles, they're counted from the postings instead
+        """
+        class Doc(Document):
+            text = fields.TextField(index_prefixes=True, index_phrases=True)
+            name = fields.FuzzyTextField(indexers=[indexers.trigrams])
+
+        index = Index(name="index1")
+        index.add([Doc(text="cheese pickle", name="Google"), Doc(text="cheese", name="Gogle")])
+
+        names = CounterShard.objects.filter(index_stats_id="index1").values_list("name", flat=True)
+        self.assertCountEqual(
+            set(names),
+            [
+                counters.DOCUMENT_COUNT,
+                counters.field_token_count("text"),
+                counters.field_token_count("name"),
+                counters.document_frequency("cheese"),
+                counters.document_frequency("pickle"),
+                counters.document_frequency("google"),
+                counters.document_frequency("gogle"),
+            ]
+        )
+
+        self.assertEqual(index.document_frequency("^chee"), 2)
+        self.assertEqual(index.document_frequency("cheese pickle"), 1)
+        self.assertEqual(index.document_frequency("~goo"), 1)
+        self.assertFalse(PendingCounterUpdate.objects.exists())
+
+    def test_abandoned_counter_update_invalidates_counters(self):
+        """
+            If a write never updated the counters (e.g. the process
+            died), they're counted from then on rather than drifting
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        index.add(Doc(text="cheese"))
+
+        # A recent update may still be in progress
+        PendingCounterUpdate.objects.create(index_stats_id="index1")
+        self.assertEqual(index.document_frequency("cheese"), 1)
+        self.assertTrue(index.index.counters_valid)
+
+        PendingCounterUpdate.objects.create(
+            index_stats_id="index1", created=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(index.document_frequency("pickle"), 0)
+        self.assertFalse(index.index.counters_valid)
+        self.assertFalse(IndexStats.objects.get(pk="index1").counters_valid)
+
+    def test_recount_statistics(self):
+        """
+            The counters of an index which couldn't be trusted can be
+            recounted, and are then used (and updated) again
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        index.add([Doc(text="cheese %s" % i) for i in range(5)])
+
+        IndexStats.objects.filter(pk="index1").update(counters_valid=False)
+        CounterShard.objects.filter(index_stats_id="index1").delete()
+        index.add(Doc(text="cheese pickle"))
+
+        self.assertTrue(index.recount_statistics())
+        self.assertTrue(IndexStats.objects.get(pk="index1").counters_valid)
+
+        index = Index(name="index1")
+        self.assertEqual(index.document_count(), 6)
+        self.assertEqual(index.document_frequency("cheese"), 6)
+        self.assertEqual(index.field_token_count("text"), 12)
+
+        index.add(Doc(text="pickle"))
+        self.assertEqual(index.document_frequency("pickle"), 2)
+        self.assertEqual(
+            sum(CounterShard.objects.filter(
+                index_stats_id="index1", name=counters.document_frequency("pickle")
+            ).values_list("count", flat=True)),
+            2
+        )
+        self.assertFalse(PendingCounterUpdate.objects.exists())
+
+    def test_recount_statistics_while_written_to(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        index.add(Doc(text="cheese"))
+        IndexStats.objects.filter(pk="index1").update(counters_valid=False)
+
+        count_records = counters._count_records
+
+        def count_and_write(index):
+            result = count_records(index)
+            Index(name="index1").add(Doc(text="pickle"))
+            return result
+
+        # The write wasn't counted, so the counters can't be used
+        with sleuth.switch("djangae.contrib.search.counters._count_records", count_and_write):
+            self.assertFalse(index.recount_statistics())
+
+        self.assertFalse(IndexStats.objects.get(pk="index1").counters_valid)
+        self.assertFalse(PendingCounterUpdate.objects.exists())
+        self.assertEqual(index.document_frequency("pickle"), 1)
+
+        # Writes in progress must finish before a recount starts
+        PendingCounterUpdate.objects.create(index_stats_id="index1")
+        self.assertFalse(index.recount_statistics())
+        self.assertFalse(IndexStats.objects.get(pk="index1").recounting)
+
+        PendingCounterUpdate.objects.all().delete()
+        self.assertTrue(index.recount_statistics())
+        self.assertEqual(index.document_count(), 2)
+
+    def test_removing_many_documents(self):
+        """
+            Removing more documents than the Datastore allows in
+            a single IN query shouldn't fail
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+
+        docs = [Doc(text="cheese %s" % i) for i in range(150)]
+        index.add(docs)
+
+        self.assertEqual(index.remove(docs), 150)
+        self.assertEqual(index.document_count(), 0)
+        self.assertFalse(DocumentRecord.objects.filter(index_stats_id=index.id).exists())
+        self.assertFalse(TokenFieldIndex.objects.filter(index_stats_id=index.id).exists())
+
+    def test_drop_index(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        i0 = Index(name="index1")
+        i1 = Index(name="index2")
+
+        i0.add([Doc(text="cheese %s" % i) for i in range(5)])
+        i1.add(Doc(text="cheese"))
+
+        with sleuth.switch("djangae.contrib.search.index._WRITE_BATCH_SIZE", 2):
+            # Deleting stops after the number of batches
+            self.assertFalse(drop_index("index1", batches=1))
+            self.assertTrue(IndexStats.objects.filter(pk="index1").exists())
+
+            self.assertTrue(drop_index("index1"))
+
+        for model in (TokenFieldIndex, DocumentRecord, CounterShard, PendingCounterUpdate):
+            self.assertFalse(model.objects.filter(index_stats_id="index1").exists())
+
+        self.assertFalse(IndexStats.objects.filter(pk="index1").exists())
+
+        # Other indexes are untouched
+        self.assertEqual(i1.document_count(), 1)
+        self.assertEqual(len(list(i1.search("cheese", Doc))), 1)
+
+    def test_drop_large_index(self):
+        """
+            Dropping an index deletes more documents in each batch than
+            the Datastore allows in a single IN query
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="index1")
+        index.add([Doc(text="cheese %s" % i) for i in range(150)])
+
+        self.assertTrue(drop_index("index1"))
+        self.assertFalse(DocumentRecord.objects.filter(index_stats_id="index1").exists())
+        self.assertFalse(TokenFieldIndex.objects.filter(index_stats_id="index1").exists())
+        self.assertFalse(IndexStats.objects.filter(pk="index1").exists())
+
+    def test_indexing_many_tokens(self):
+        """
+            Token indexes are written in batches, make sure that
+            documents with more tokens than a single batch are fully
+            indexed, and that re-indexing doesn't duplicate anything
+        """
+
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        words = ["word%s" % i for i in range(1200)]
+        doc = Doc(text=" ".join(words))
+        index.add(doc)
+
+        self.assertEqual(TokenFieldIndex.objects.count(), len(words))
+        self.assertEqual(len(doc._record.token_field_indexes_ids), len(words))
+
+        index.add(doc)
+        self.assertEqual(TokenFieldIndex.objects.count(), len(words))
+
+        results = list(index.search("word1199", Doc))
+        self.assertEqual([doc], results)
+
+    def test_derived_tokens_not_stored(self):
+        """
+            Tokens derived from the data of a document (e.g. the prefixes
+            of its words) aren't stored on its record, so a large document
+            doesn't outgrow it. They're derived again when it's unindexed.
+        """
+        class Doc(Document):
+            text = fields.TextField(index_prefixes=True)
+
+        index = Index(name="test")
+
+        words = ["word%s" % i for i in range(1200)]
+        doc = Doc(text=" ".join(words))
+        index.add(doc)
+
+        self.assertEqual(len(doc._record.token_field_indexes_ids), len(words))
+        self.assertEqual(
+            doc._record.posting_keys(),
+            set(TokenFieldIndex.objects.values_list("pk", flat=True))
+        )
+        self.assertGreater(TokenFieldIndex.objects.count(), len(words))
+        self.assertEqual([doc], list(index.search("word119", Doc, use_startswith=True)))
+
+        # Postings for the prefixes of words which were removed are deleted
+        doc.text = "cheese"
+        index.add(doc)
+        self.assertEqual(TokenFieldIndex.objects.count(), len("cheese") + 1)
+        self.assertFalse(list(index.search("word119", Doc, use_startswith=True)))
+
+        record = DocumentRecord.objects.get(pk=doc.id)
+        self.assertEqual(len(record.token_field_indexes_ids), 1)
+        self.assertEqual(record.derived_token_options, {"text": {"prefixes": True}})
+
+        index.remove(doc)
+        self.assertEqual(TokenFieldIndex.objects.count(), 0)
+        self.assertEqual(index.document_frequency("^chee"), 0)
+
+    def test_trigrams_not_stored(self):
+        class Doc(Document):
+            text = fields.FuzzyTextField(indexers=[indexers.trigrams])
+
+        index = Index(name="test")
+
+        doc = Doc(text="Potato Company")
+        index.add(doc)
+
+        record = DocumentRecord.objects.get(pk=doc.id)
+        self.assertEqual(len(record.token_field_indexes_ids), 2)
+        self.assertEqual(record.derived_token_options, {"text": {"trigrams": 3}})
+        self.assertEqual(
+            record.posting_keys(),
+            set(TokenFieldIndex.objects.values_list("pk", flat=True))
+        )
+        self.assertEqual([doc], list(index.search("potatoe", Doc, use_trigrams=True)))
+
+        index.remove(doc)
+        self.assertEqual(TokenFieldIndex.objects.count(), 0)
+
+    def test_phrase_shingles_not_stored(self):
+        class Doc(Document):
+            text = fields.TextField(index_phrases=True)
+
+        index = Index(name="test")
+
+        doc = Doc(text="The Tallest. BUILDING")
+        index.add(doc)
+
+        record = DocumentRecord.objects.get(pk=doc.id)
+        self.assertEqual(len(record.token_field_indexes_ids), 3)
+        self.assertEqual(record.derived_token_options, {"text": {"phrases": True}})
+        self.assertEqual(
+            record.posting_keys(),
+            set(TokenFieldIndex.objects.values_list("pk", flat=True))
+        )
+        self.assertEqual([doc], list(index.search('"tallest building"', Doc)))
+        self.assertEqual([doc], list(index.search('"Tallest Building"', Doc)))
+
+        doc.text = "The building"
+        index.add(doc)
+        self.assertFalse(list(index.search('"tallest building"', Doc)))
+
+        index.remove(doc)
+        self.assertEqual(TokenFieldIndex.objects.count(), 0)
+
+    def test_document_frequencies_maintained(self):
+        class Doc(Document):
+            text = fields.TextField()
+            other_text = fields.TextField()
+
+        index = Index(name="test")
+        frequency = index.document_frequency
+
+        doc1 = Doc(text="cheese", other_text="cheese pickle")
+        doc2 = Doc(text="cheese")
+        index.add([doc1, doc2])
+
+        # Each document only counts once, regardless of the number of fields
+        self.assertEqual(frequency("cheese"), 2)
+        self.assertEqual(frequency("pickle"), 1)
+
+        doc1.other_text = "onion"
+        index.add(doc1)
+
+        self.assertEqual(frequency("cheese"), 2)
+        self.assertEqual(frequency("pickle"), 0)
+        self.assertEqual(frequency("onion"), 1)
+
+        index.remove(doc2)
+        self.assertEqual(frequency("cheese"), 1)
+
+    def test_field_token_counts_maintained(self):
+        class Doc(Document):
+            text = fields.TextField()
+            other_text = fields.TextField()
+
+        index = Index(name="test")
+
+        doc1 = Doc(text="cheese", other_text="cheese pickle")
+        doc2 = Doc(text="cheese onion")
+        index.add([doc1, doc2])
+
+        self.assertEqual(index.field_token_count("text"), 3)
+        self.assertEqual(index.field_token_count("other_text"), 2)
+
+        doc1.other_text = "pickle"
+        index.add(doc1)
+        self.assertEqual(index.field_token_count("other_text"), 1)
+
+        index.remove(doc2)
+        self.assertEqual(index.field_token_count("text"), 1)
+        self.assertEqual(index.document_count(), 1)
+
+    def test_counters_sharded(self):
+        """
+            Each write to the index updates a single shard of each
+            counter, and reading a counter sums all the shards
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        with sleuth.switch("djangae.contrib.search.counters._choose_shard", lambda: 0):
+            index.add(Doc(text="cheese"))
+
+        with sleuth.switch("djangae.contrib.search.counters._choose_shard", lambda: 1):
+            index.add(Doc(text="cheese"))
+
+        self.assertEqual(
+            CounterShard.objects.filter(name=counters.DOCUMENT_COUNT).count(), 2
+        )
+        self.assertEqual(index.document_count(), 2)
+        self.assertEqual(index.document_frequency("cheese"), 2)
+
     def test_pipe_not_indexed(self):
         """
             The | symbols is used for TokenFieldIndex key generation
@@ -241,6 +774,28 @@ class IndexingTests(TestCase):
             ["This", "is", "a", "date", "2020-01-01", "20200101", "2020.01.01", ]
         )
 
+    def test_tokenization_matches_reference(self):
+        """
+            The tokenizer is optimised, but must give exactly the
+            same results as the original implementation
+        """
+        texts = [
+            "", " ", "\n", "a-", "-a", "A.B.", "1-2-3.4", "I-B-M-", "a--b",
+            "I.B-M", "1.2.3 and 2020-01-01", "tab\tseparated|piped  text",
+        ] + [generate_document(200, seed=i) for i in range(10)] + [
+            generate_document(1000, seed=i, special_rate=0.5) for i in range(3)
+        ]
+
+        for text in texts:
+            self.assertEqual(tokenize_content(text), reference_tokenize_content(text))
+
+    def test_tokenization_scales_linearly(self):
+        """
+            Tokenizing a large document full of acronyms mustn't take
+            much longer per word than a small one
+        """
+        self.assertLess(benchmarks.scaling(), benchmarks.MAX_SLOWDOWN)
+
     def test_null_validation(self):
         """
             If a field is marked as null=False, and someone tries to index
@@ -298,3 +853,117 @@ class IndexingTests(TestCase):
 
         # Startswith matching overrides matching of stopwords (as other tokens may start with the stop word)
         self.assertTrue(list(index.search("about", Doc, use_startswith=True, match_stopwords=False)))
+
+
+class IndexRegistryTests(TestCase):
+    def tearDown(self):
+        invalidate_index()
+        super().tearDown()
+
+    def test_index_handles_shared(self):
+        index = get_index("test")
+        self.assertIs(get_index("test"), index)
+        self.assertIsNot(get_index("other"), index)
+
+        with self.assertRaises(ValueError):
+            get_index("test", storage=POSTING_BLOCK_STORAGE)
+
+        invalidate_index("test")
+        self.assertIsNot(get_index("test"), index)
+        self.assertEqual(get_index("test").id, index.id)
+
+
+class PostingBlockStorageTests(TestCase):
+    def test_document_id_encoding(self):
+        document_ids = [1, 2, 127, 128, 300, 16384, 5629499534213120]
+        data = encode_document_ids(document_ids)
+
+        self.assertEqual(decode_document_ids(data), document_ids)
+        self.assertEqual(decode_document_ids(b""), [])
+
+    def test_storage_mismatch_raises(self):
+        Index(name="test", storage=POSTING_BLOCK_STORAGE)
+
+        self.assertEqual(Index(name="test").storage.name, POSTING_BLOCK_STORAGE)
+        self.assertRaises(ValueError, Index, name="test", storage="token_field_index")
+        self.assertRaises(ValueError, Index, name="other", storage="unknown")
+
+        # The index isn't created with the unknown storage
+        self.assertFalse(IndexStats.objects.filter(pk="other").exists())
+        self.assertEqual(Index(name="other").storage.name, "token_field_index")
+
+    def test_indexing_and_removing(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test", storage=POSTING_BLOCK_STORAGE)
+
+        doc1 = Doc(text="cheese pickle")
+        doc2 = Doc(text="cheese onion")
+        index.add([doc1, doc2])
+
+        # No TokenFieldIndex instances, one block per token
+        self.assertEqual(TokenFieldIndex.objects.count(), 0)
+        self.assertEqual(PostingBlock.objects.count(), 3)
+
+        self.assertCountEqual([doc1, doc2], list(index.search("cheese", Doc)))
+        self.assertEqual([doc1], list(index.search("text:pickle", Doc)))
+        self.assertEqual([doc2], list(index.search("oni", Doc, use_startswith=True)))
+
+        doc1.text = "cheese"
+        index.add(doc1)
+        self.assertFalse(list(index.search("pickle", Doc)))
+        self.assertEqual(PostingBlock.objects.count(), 2)
+
+        self.assertTrue(index.remove(doc1))
+        self.assertTrue(index.remove(doc2))
+        self.assertEqual(PostingBlock.objects.count(), 0)
+        self.assertFalse(list(index.search("cheese", Doc)))
+
+    def test_blocks_split(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test", storage=POSTING_BLOCK_STORAGE)
+
+        docs = [Doc(text="cheese") for i in range(2500)]
+        index.add(docs)
+
+        self.assertTrue(PostingBlock.objects.count() > 1)
+
+        results = list(index.search("cheese", Doc, limit=None))
+        self.assertEqual(len(results), len(docs))
+
+    def test_blocks_split_evenly(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test", storage=POSTING_BLOCK_STORAGE)
+
+        def block_sizes():
+            return [len(x.document_ids) for x in PostingBlock.objects.order_by("pk")]
+
+        with sleuth.switch("djangae.contrib.search.postings._MAX_BLOCK_SIZE", 10):
+            with sleuth.switch("djangae.contrib.search.postings._MIN_BLOCK_SIZE", 2):
+                docs = [Doc(id=i, text="cheese") for i in range(1, 22)]
+                index.add(docs)
+
+                # No small block is left over from the split
+                self.assertEqual(block_sizes(), [4, 4, 4, 4, 5])
+
+                # Several blocks are fetched at a time
+                with sleuth.switch("djangae.contrib.search.postings._BLOCKS_PER_PAGE", 2):
+                    results = list(index.search("cheese", Doc, limit=None))
+                    self.assertCountEqual(results, docs)
+
+                index.remove(docs)
+                index.add([Doc(id=i, text="cheese") for i in range(1, 12)])
+                self.assertEqual(block_sizes(), [3, 4, 4])
+
+                # The first block shrinks below the minimum, so it is
+                # split along with the next block when that grows
+                index.remove(list(range(2, 9)))
+                self.assertEqual(block_sizes(), [1, 3])
+
+                index.add([Doc(id=i, text="cheese") for i in range(20, 30)])
+                self.assertEqual(block_sizes(), [4, 5, 5])
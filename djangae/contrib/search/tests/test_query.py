@@ -2,14 +2,26 @@ from datetime import (
     datetime,
     timedelta,
 )
+import threading
 from unittest import skip
 
+from gcloudc.db import transaction
+
+from djangae.contrib import sleuth
 from djangae.contrib.search import (
     Document,
     Index,
     fields,
+    indexers,
+)
+from djangae.contrib.search import result_cache
+from djangae.contrib.search.concurrency import map_concurrently
+from djangae.contrib.search.models import IndexStats
+from djangae.contrib.search.query import (
+    _parse_range,
+    _tokenize_query_string,
+    get_query_plan,
 )
-from djangae.contrib.search.query import _tokenize_query_string
 from djangae.test import TestCase
 
 
@@ -22,6 +34,10 @@ class FuzzyDocument(Document):
     company_name = fields.FuzzyTextField()
 
 
+class TrigramDocument(Document):
+    company_name = fields.FuzzyTextField(indexers=[indexers.trigrams])
+
+
 class QueryTests(TestCase):
     def test_tokenization_breaks_at_punctuation(self):
         q = "hi, there is a 100% chance this works [honest]"
@@ -33,7 +49,24 @@ class QueryTests(TestCase):
         self.assertEqual(kinds, {"word"})  # All tokens should be recognised as "word" tokens
         self.assertCountEqual(tokens, ["hi", ",", "100", "%", "chance", "works", "[", "honest", "]"])
 
-    @skip("Implement stemming and fix this test")
+    def test_query_plans_cached(self):
+        plan = get_query_plan("pikachu OR name:charmander")
+        self.assertIs(get_query_plan("pikachu OR name:charmander"), plan)
+
+        self.assertEqual(
+            plan.branches,
+            ((("word", None, "pikachu"),), (("word", "name", "charmander"),))
+        )
+
+        # Equivalent queries have the same key, different options don't
+        self.assertEqual(get_query_plan(" Pikachu  OR name:charmander").key, plan.key)
+        self.assertNotEqual(get_query_plan("pikachu OR name:charmander", match_all=False).key, plan.key)
+
+        # Queries which parse differently never share a key
+        self.assertNotEqual(get_query_plan("foo\tbar").key, get_query_plan("foo bar").key)
+        self.assertNotEqual(get_query_plan('"foo\xa0bar"').key, get_query_plan('"foo bar"').key)
+
+    @skip("FuzzyTextField doesn't match prefixes without use_startswith, see test_stemmed_startswith_matching")
     def test_fuzzy_matching(self):
         index = Index(name="test")
 
@@ -56,6 +89,104 @@ class QueryTests(TestCase):
         results = [x.company_name for x in index.search("pota", document_class=FuzzyDocument)]
         self.assertCountEqual(results, ["Potato"])
 
+    def test_stemmed_matching(self):
+        index = Index(name="test")
+
+        doc1 = FuzzyDocument(company_name="Running Shoes")
+        doc2 = FuzzyDocument(company_name="Runs Limited")
+        doc3 = FuzzyDocument(company_name="Runner")
+        doc4 = CompanyDocument(company_name="Running Shoes")
+
+        index.add([doc1, doc2, doc3, doc4])
+
+        results = list(index.search("run", FuzzyDocument, use_stemming=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+        results = list(index.search("running shoe", FuzzyDocument, use_stemming=True))
+        self.assertEqual(results, [doc1])
+
+        # Without stemming, only the words themselves match
+        results = list(index.search("running", FuzzyDocument))
+        self.assertCountEqual(results, [doc1, doc4])
+
+        results = list(index.search("run", FuzzyDocument))
+        self.assertFalse(results)
+
+    def test_stemmed_matching_unstemmed_fields(self):
+        """
+            Stems are only indexed for fields with the stemming indexer,
+            so other fields must still match the words themselves
+        """
+        class LongStemDocument(Document):
+            company_name = fields.FuzzyTextField(min_index_length=5)
+
+        index = Index(name="test")
+
+        doc1 = CompanyDocument(company_name="Running Shoes")
+        doc2 = LongStemDocument(company_name="Running Shoes")
+        doc3 = LongStemDocument(company_name="Runs Limited")
+
+        index.add([doc1, doc2, doc3])
+
+        results = list(index.search("running", CompanyDocument, use_stemming=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+        results = list(index.search("company_name:running", CompanyDocument, use_stemming=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+        # The stem "run" is too short to have been indexed in LongStemDocument,
+        # so only the word itself is searched for
+        results = list(index.search("running", LongStemDocument, use_stemming=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+    def test_stemmed_startswith_matching(self):
+        index = Index(name="test")
+
+        doc1 = FuzzyDocument(company_name="Running Shoes")
+        doc2 = FuzzyDocument(company_name="Runs Limited")
+        doc3 = FuzzyDocument(company_name="Runner")
+        doc4 = FuzzyDocument(company_name="Rugby")
+
+        index.add([doc1, doc2, doc3, doc4])
+
+        # The stem is used as the prefix, so other forms of the word match
+        results = list(index.search("running", FuzzyDocument, use_startswith=True, use_stemming=True))
+        self.assertCountEqual(results, [doc1, doc2, doc3])
+
+        results = list(index.search("running", FuzzyDocument, use_startswith=True))
+        self.assertEqual(results, [doc1])
+
+        # "runner" is its own stem, so only words starting with it match
+        results = list(index.search("runner", FuzzyDocument, use_startswith=True, use_stemming=True))
+        self.assertEqual(results, [doc3])
+
+    def test_trigram_matching(self):
+        index = Index(name="test")
+
+        doc1 = TrigramDocument(company_name="Google")
+        doc2 = TrigramDocument(company_name="Potato Company")
+        doc3 = TrigramDocument(company_name="Facebook")
+
+        index.add([doc1, doc2, doc3])
+
+        results = list(index.search("gogle", TrigramDocument, use_trigrams=True))
+        self.assertEqual(results, [doc1])
+
+        results = list(index.search("facebok OR google", TrigramDocument, use_trigrams=True))
+        self.assertCountEqual(results, [doc1, doc3])
+
+        # The exact match ranks higher
+        self.assertEqual(results[0], doc1)
+
+        results = list(index.search("potatoe compny", TrigramDocument, use_trigrams=True))
+        self.assertEqual(results, [doc2])
+
+        results = list(index.search("potatoe facebok", TrigramDocument, use_trigrams=True))
+        self.assertFalse(results)
+
+        results = list(index.search("gogle", TrigramDocument))
+        self.assertFalse(results)
+
     def test_startswith_matching(self):
         index = Index(name="test")
 
@@ -78,6 +209,138 @@ class QueryTests(TestCase):
         results = [x.company_name for x in index.search("pota", document_class=CompanyDocument, use_startswith=True)]
         self.assertCountEqual(results, ["Potato"])
 
+    def test_indexed_prefix_matching(self):
+        class Doc(Document):
+            name = fields.TextField(index_prefixes=True)
+            other_name = fields.TextField(index_prefixes=True)
+
+        index = Index(name="test")
+        doc1 = Doc(name="Potato", other_name="Google")
+        doc2 = Doc(name="Potential Company", other_name="Gopher")
+        doc3 = Doc(name="Pot")
+        index.add([doc1, doc2, doc3])
+
+        results = list(index.search("pot", Doc, use_startswith=True))
+        self.assertCountEqual(results, [doc1, doc2, doc3])
+
+        # Closer matches rank higher
+        self.assertEqual(results[0], doc3)
+
+        results = list(index.search("pota", Doc, use_startswith=True))
+        self.assertEqual(results, [doc1])
+
+        results = list(index.search("pot go", Doc, use_startswith=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+        results = list(index.search("name:go", Doc, use_startswith=True))
+        self.assertFalse(results)
+
+        results = list(index.search("other_name:goo", Doc, use_startswith=True))
+        self.assertEqual(results, [doc1])
+
+        # Prefixes aren't matched by normal searches
+        self.assertFalse(list(index.search("pota", Doc)))
+
+    def test_startswith_mixed_prefix_fields(self):
+        """
+            Fields without index_prefixes must still be matched when
+            other fields of the document index prefixes
+        """
+        class Doc(Document):
+            name = fields.TextField(index_prefixes=True)
+            description = fields.TextField()
+
+        index = Index(name="test")
+        doc1 = Doc(name="Potato", description="Vegetable")
+        doc2 = Doc(name="Carrot", description="Potential vegetable")
+        index.add([doc1, doc2])
+
+        results = list(index.search("pot", Doc, use_startswith=True))
+        self.assertCountEqual(results, [doc1, doc2])
+
+        results = list(index.search("name:pot", Doc, use_startswith=True))
+        self.assertEqual(results, [doc1])
+
+        results = list(index.search("description:pot", Doc, use_startswith=True))
+        self.assertEqual(results, [doc2])
+
+    def test_startswith_prefix_lookup_with_other_fields(self):
+        """
+            Fields which don't index prefixes are scanned, while the
+            prefixes of the others are still looked up
+        """
+        class Doc(Document):
+            name = fields.TextField(index_prefixes=True)
+            category = fields.AtomField()
+            price = fields.NumberField()
+
+        index = Index(name="test")
+        doc1 = Doc(name="Potato", category="vegetable", price=1)
+        doc2 = Doc(name="Carrot", category="pottery", price=2)
+        index.add([doc1, doc2])
+
+        with sleuth.watch("djangae.contrib.search.query._prefix_postings") as prefix_postings:
+            results = list(index.search("pot", Doc, use_startswith=True))
+            self.assertTrue(prefix_postings.called)
+
+        self.assertCountEqual(results, [doc1, doc2])
+
+        # Prefixes shared by too many documents are scanned instead
+        with sleuth.switch("djangae.contrib.search.query._MAX_PREFIX_RECORDS", 0):
+            results = list(index.search("pot", Doc, use_startswith=True))
+            self.assertCountEqual(results, [doc1, doc2])
+
+    def test_startswith_prefixes_indexed_later(self):
+        """
+            Documents indexed before a field indexed prefixes are still
+            matched, until the index is marked as having their prefixes
+        """
+        class OldDoc(Document):
+            name = fields.TextField()
+
+        class Doc(Document):
+            name = fields.TextField(index_prefixes=True)
+
+        index = Index(name="test")
+        doc1 = OldDoc(name="Potato")
+        index.add(doc1)
+
+        doc2 = Doc(name="Potential")
+        index.add(doc2)
+
+        with sleuth.watch("djangae.contrib.search.query._prefix_postings") as prefix_postings:
+            results = list(index.search("pot", Doc, use_startswith=True))
+            self.assertFalse(prefix_postings.called)
+
+        self.assertCountEqual([x.id for x in results], [doc1.id, doc2.id])
+
+        # Once every document is indexed with prefixes, they're looked up
+        index.add(Doc(id=doc1.id, name="Potato"))
+        index.mark_prefixes_indexed(Doc)
+
+        with sleuth.watch("djangae.contrib.search.query._prefix_postings") as prefix_postings:
+            results = list(index.search("pot", Doc, use_startswith=True))
+            self.assertTrue(prefix_postings.called)
+
+        self.assertCountEqual([x.id for x in results], [doc1.id, doc2.id])
+
+    def test_startswith_prefixes_not_looked_up_for_old_indexes(self):
+        class Doc(Document):
+            name = fields.TextField(index_prefixes=True)
+
+        index = Index(name="test")
+        doc = Doc(name="Potato")
+        index.add(doc)
+
+        # Indexes created before prefixes were indexed have no marker
+        IndexStats.objects.filter(pk=index.id).update(unprefixed_fields=None)
+
+        with sleuth.watch("djangae.contrib.search.query._prefix_postings") as prefix_postings:
+            results = list(index.search("pot", Doc, use_startswith=True))
+            self.assertFalse(prefix_postings.called)
+
+        self.assertEqual(results, [doc])
+
     def test_startswith_with_multiple_results_per_token(self):
         """
             The problem here is that doing startswith matches can return multiple
@@ -173,6 +436,103 @@ class QueryTests(TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].datefield, date)
 
+    def test_number_range_querying(self):
+        class Doc(Document):
+            name = fields.TextField()
+            price = fields.NumberField()
+            stock = fields.NumberField()
+
+        index = Index(name="test")
+
+        doc1 = index.add(Doc(name="cheap", price=-5, stock=1000))
+        doc2 = index.add(Doc(name="cheap", price=99, stock=1000))
+        doc3 = index.add(Doc(name="expensive", price=100, stock=0))
+        doc4 = index.add(Doc(name="expensive", price=2341920, stock=0))
+
+        def search(query):
+            return [x.id for x in index.search(query, document_class=Doc)]
+
+        self.assertCountEqual(search("price:<100"), [doc1, doc2])
+        self.assertCountEqual(search("price:<=100"), [doc1, doc2, doc3])
+        self.assertCountEqual(search("price:>100"), [doc4])
+        self.assertCountEqual(search("price:>=-5"), [doc1, doc2, doc3, doc4])
+        self.assertCountEqual(search("price:>0 price:<1000"), [doc2, doc3])
+        self.assertCountEqual(search("expensive price:<1000"), [doc3])
+        self.assertCountEqual(search("price:<0 OR price:>1000"), [doc1, doc4])
+        self.assertCountEqual(search("name:cheap price:>0"), [doc2])
+        self.assertFalse(search("name:price:<100"))
+
+        # Only the values of the searched field are scanned
+        self.assertCountEqual(search("stock:<100"), [doc3, doc4])
+        pages = index.storage.iter_range_posting_pages(index, *_parse_range("price", "<100"))
+        self.assertCountEqual([x for page in pages for x in page], [doc1, doc2])
+
+        results = index.search("exp price:>100", document_class=Doc, use_startswith=True)
+        self.assertCountEqual([x.id for x in results], [doc4])
+
+    def test_datefield_range_querying(self):
+        class Doc(Document):
+            datefield = fields.DateField()
+
+        date = datetime(year=2020, month=1, day=1, hour=6, minute=15)
+
+        index = Index(name="test")
+        doc1 = index.add(Doc(datefield=date - timedelta(days=400)))
+        doc2 = index.add(Doc(datefield=date))
+        doc3 = index.add(Doc(datefield=date + timedelta(days=1)))
+
+        def search(query):
+            return [x.id for x in index.search(query, document_class=Doc)]
+
+        self.assertCountEqual(search("datefield:>=2020-01-01"), [doc2, doc3])
+        self.assertCountEqual(search("datefield:>2020-01-01"), [doc3])
+        self.assertCountEqual(search("datefield:<2020-01-01"), [doc1])
+        self.assertCountEqual(search("datefield:<=2020-01-01T00:00:00"), [doc1, doc2])
+
+    def test_facet_counts(self):
+        class Doc(Document):
+            text = fields.TextField()
+            category = fields.AtomField()
+
+        index = Index(name="test")
+        index.add([
+            Doc(text="red shoes", category="Shoes"),
+            Doc(text="blue shoes", category="Shoes"),
+            Doc(text="red hat", category="Hats"),
+            Doc(text="green scarf", category="Scarves"),
+        ])
+
+        facet_counts = {}
+        results = list(index.search("red", Doc, facets=["category"], facet_counts=facet_counts))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(facet_counts, {"category": {"shoes": 1, "hats": 1}})
+
+        # Counts are for all the matches, not just the top `limit`
+        facet_counts = {}
+        list(index.search("red OR shoes", Doc, limit=1, facets=["category"], facet_counts=facet_counts))
+        self.assertEqual(facet_counts, {"category": {"shoes": 2, "hats": 1}})
+
+        # Sampled counts are scaled to the number of matches
+        facet_counts = {}
+        list(index.search(
+            "shoes", Doc, facets=["category"], facet_counts=facet_counts, facet_sample_size=1
+        ))
+        self.assertEqual(facet_counts, {"category": {"shoes": 2}})
+
+        # Large numbers of matches are always sampled
+        facet_counts = {}
+        with sleuth.switch("djangae.contrib.search.query._MAX_RECORD_FACET_DOCUMENTS", 2):
+            with sleuth.watch("djangae.contrib.search.query._RecordTokens.get") as get_tokens:
+                list(index.search(
+                    "red OR shoes OR scarf", Doc, facets=["category"], facet_counts=facet_counts
+                ))
+                self.assertEqual(len(get_tokens.calls[-1].args[1]), 2)
+
+        self.assertEqual(sum(facet_counts["category"].values()), 4)
+
+        with self.assertRaises(ValueError):
+            list(index.search("red", Doc, facets=["text"]))
+
     def test_match_all_flag(self):
 
         class Doc(Document):
@@ -253,6 +613,36 @@ class QueryTests(TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].id, doc2)
 
+    def test_phrase_queries(self):
+        class Doc(Document):
+            text = fields.TextField(index_phrases=True)
+            other_text = fields.TextField(index_phrases=True)
+
+        index = Index(name="test")
+        doc1 = Doc(text="The tallest building in the world", other_text="Tower")
+        doc2 = Doc(text="The world's tallest, and oldest, building", other_text="building tallest")
+        doc3 = Doc(text="A tall building", other_text="The tallest. Building")
+        index.add([doc1, doc2, doc3])
+
+        results = list(index.search('"tallest building"', Doc))
+        self.assertCountEqual(results, [doc1, doc3])
+
+        results = list(index.search('text:"tallest building"', Doc))
+        self.assertEqual(results, [doc1])
+
+        results = list(index.search('"in the world" OR tower', Doc))
+        self.assertEqual(results, [doc1])
+
+        results = list(index.search('"building tallest" OR text:"tall building"', Doc))
+        self.assertCountEqual(results, [doc2, doc3])
+
+        results = list(index.search('"and oldest" tallest', Doc))
+        self.assertEqual(results, [doc2])
+
+        # A phrase of a single word is just a word
+        results = list(index.search('"tower"', Doc))
+        self.assertEqual(results, [doc1])
+
 
 class SearchRankingTests(TestCase):
 
@@ -314,3 +704,175 @@ class SearchRankingTests(TestCase):
         ]
 
         self.assertEqual(results, expected_order)
+
+    def test_limit_keeps_highest_ranked(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        doc1 = Doc(text="live")
+        doc2 = Doc(text="live forever")
+        doc3 = Doc(text="live forever young")
+        index.add([doc1, doc2, doc3])
+
+        results = list(index.search("live forever young", Doc, match_all=False, limit=2))
+        self.assertEqual(results, [doc3, doc2])
+
+        results = list(index.search("live forever young", Doc, match_all=False, limit=1))
+        self.assertEqual(results, [doc3])
+
+    def test_limited_results_pruned_correctly(self):
+        """
+            When a limit is specified, evaluation stops reading the postings
+            of common tokens once the top results can't change. Make sure
+            that the documents matching the most branches still win.
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        common = [Doc(text="common") for i in range(20)]
+        both = Doc(text="common rare")
+        rare = Doc(text="rare")
+        index.add(common + [both, rare])
+
+        results = list(index.search("common OR rare", Doc, limit=1))
+        self.assertEqual(results, [both])
+
+        results = list(index.search("common OR rare", Doc, limit=2))
+        self.assertEqual(results[0], both)
+        self.assertEqual(len(results), 2)
+
+        results = list(index.search("rare common", Doc, limit=5))
+        self.assertEqual(results, [both])
+
+        results = list(index.search("common", Doc))
+        self.assertEqual(len(results), 21)
+
+    def test_tied_results_not_pruned(self):
+        """
+            Ties are ranked by document ID, but postings are read in key
+            order ("10" before "9"), so a document which ties with the
+            lowest of the top results can't be pruned.
+        """
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        doc9 = Doc(id=9, text="common")
+        doc10 = Doc(id=10, text="common")
+        index.add([doc10, doc9])
+
+        results = list(index.search("common", Doc, limit=1))
+        self.assertEqual(results, [doc9])
+
+        results = list(index.search("common OR rare", Doc, limit=1))
+        self.assertEqual(results, [doc9])
+
+        self.assertEqual(list(index.search("common", Doc))[:1], results)
+
+    def test_concurrent_branches_ranked_deterministically(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+        index.add([
+            Doc(text="apple banana"),
+            Doc(text="banana cherry damson"),
+            Doc(text="cherry"),
+            Doc(text="damson elderberry apple"),
+            Doc(text="elderberry"),
+        ])
+
+        query = "apple OR banana OR cherry OR damson OR elderberry"
+        for options in ({"limit": 3}, {"use_startswith": True}, {"match_all": False}):
+            results = list(index.search(query, Doc, **options))
+
+            with sleuth.switch("djangae.contrib.search.concurrency.CONCURRENCY", 1):
+                self.assertEqual(list(index.search(query, Doc, **options)), results)
+
+    def test_no_concurrency_in_transactions(self):
+        # Transactions are per-thread, so everything must run in this one
+        with transaction.atomic():
+            threads = map_concurrently(lambda x: threading.get_ident(), range(5))
+
+        self.assertEqual(set(threads), {threading.get_ident()})
+
+    def test_cursor_paging(self):
+        class Doc(Document):
+            text = fields.TextField()
+
+        index = Index(name="test")
+
+        docs = [Doc(text="common") for i in range(7)] + [Doc(text="common rare") for i in range(3)]
+        index.add(docs)
+
+        expected = list(index.search("common OR rare", Doc))
+
+        results = []
+        cursor = None
+        while True:
+            next_cursor = []
+            page = list(index.search("common OR rare", Doc, limit=3, cursor=cursor, next_cursor=next_cursor))
+            results.extend(page)
+
+            if not next_cursor:
+                break
+            cursor = next_cursor[0]
+
+        self.assertEqual(results, expected)
+        self.assertEqual(len(results), 10)
+
+        # The cursor can't be used for another query
+        with self.assertRaises(ValueError):
+            list(index.search("common", Doc, cursor=cursor))
+
+        with self.assertRaises(ValueError):
+            list(index.search("common OR rare", Doc, cursor="nonsense"))
+
+        # Cursors hold the position in the ranking, so can't page explicitly ordered results
+        with self.assertRaises(ValueError):
+            list(index.search("common OR rare", Doc, order_by="id", next_cursor=[]))
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        result_cache.reset_stats()
+
+    def test_results_cached_until_index_changes(self):
+        index = Index(name="test")
+
+        doc1 = CompanyDocument(company_name="Google")
+        index.add(doc1)
+
+        results = list(index.search("google", CompanyDocument, use_cache=True))
+        self.assertEqual(results, [doc1])
+        self.assertEqual(result_cache.get_stats(), {"hits": 0, "misses": 1})
+
+        # Equivalent queries hit the cache
+        results = list(index.search("  Google ", CompanyDocument, use_cache=True))
+        self.assertEqual(results, [doc1])
+        self.assertEqual(result_cache.get_stats(), {"hits": 1, "misses": 1})
+
+        # Different options don't
+        list(index.search("google", CompanyDocument, use_cache=True, limit=1))
+        self.assertEqual(result_cache.get_stats(), {"hits": 1, "misses": 2})
+
+        # Adding a document invalidates the cache
+        doc2 = CompanyDocument(company_name="Google Cloud")
+        index.add(doc2)
+
+        results = list(index.search("google", CompanyDocument, use_cache=True))
+        self.assertCountEqual(results, [doc1, doc2])
+        self.assertEqual(result_cache.get_stats(), {"hits": 1, "misses": 3})
+
+        # ...and so does removing one
+        index.remove(doc1)
+
+        results = list(index.search("google", CompanyDocument, use_cache=True))
+        self.assertEqual(results, [doc2])
+        self.assertEqual(result_cache.get_stats(), {"hits": 1, "misses": 4})
@@ -1,12 +1,30 @@
-from djangae.contrib import search
-from djangae.contrib.search import fields
-from djangae.contrib.search.model_document import document_from_model_document
-from djangae.contrib.search.models import TokenFieldIndex
+from django.core.management import call_command
+
+from djangae.contrib import (
+    search,
+    sleuth,
+)
+from djangae.contrib.search import (
+    aliases,
+    fields,
+)
+from djangae.contrib.search.model_document import (
+    _legacy_records,
+    document_from_model_document,
+)
+from djangae.contrib.search.models import (
+    DeferredIndexingMarker,
+    DocumentRecord,
+    IndexStats,
+    TokenFieldIndex,
+)
+from djangae.models import DeferIterationMarker
 from djangae.test import TestCase
 
 from .models import (
     SearchableModel1,
     SearchableModel2,
+    SearchableModel3,
 )
 
 
@@ -27,6 +45,14 @@ class CharFieldPK(search.ModelDocument):
         )
 
 
+class DeferredModelDocument(search.ModelDocument):
+    class Meta:
+        fields = (
+            "name",
+        )
+        defer_indexing = True
+
+
 class SearchableTest(TestCase):
     def setUp(self):
         # Ensure that the model has been registered
@@ -103,6 +129,60 @@ class SearchableTest(TestCase):
         results = SearchableModel1.objects.search("jimmy")
         self.assertFalse([x for x in results])
 
+    def test_records_store_instance_id(self):
+        idx = SearchableModelDocument.index()
+
+        record = DocumentRecord.objects.get(index_stats_id=idx.id, instance_id=str(self.i1.pk))
+        self.assertEqual(record.data["instance_id"], self.i1.pk)
+
+        i1 = SearchableModel2.objects.create(sid="test")
+        record = DocumentRecord.objects.get(instance_id="test")
+        self.assertEqual(record.data["instance_id"], i1.pk)
+
+        i1.delete()
+        self.assertFalse(DocumentRecord.objects.filter(instance_id="test").exists())
+
+    def test_records_without_instance_id(self):
+        """
+            Records written before instance_id was stored are still
+            found by the instance ID in their data, until the index
+            has been rebuilt
+        """
+        idx = SearchableModelDocument.index()
+        self.assertTrue(idx.index.instance_ids_backfilled)
+
+        IndexStats.objects.filter(pk=idx.id).update(instance_ids_backfilled=False)
+        idx.index.instance_ids_backfilled = False
+
+        DocumentRecord.objects.filter(
+            index_stats_id=idx.id, instance_id__in=[str(self.i1.pk), str(self.i2.pk)]
+        ).update(instance_id=None)
+
+        self.i1.name = "Luke Skywalker"
+        self.i1.save()
+
+        record = DocumentRecord.objects.get(index_stats_id=idx.id, data__instance_id=self.i1.pk)
+        self.assertEqual(record.instance_id, str(self.i1.pk))
+        self.assertCountEqual(SearchableModel1.objects.search("skywalker"), [self.i1])
+
+        self.i2.delete()
+        self.assertFalse(
+            DocumentRecord.objects.filter(index_stats_id=idx.id, data__instance_id=self.i2.pk).exists()
+        )
+        self.assertFalse(list(SearchableModel1.objects.search("jimmy")))
+
+        call_command("rebuild_search_index", SearchableModel1._meta.label)
+        self.process_task_queues()
+
+        self.assertTrue(idx.index.instance_ids_backfilled)
+        self.assertTrue(IndexStats.objects.get(pk=idx.id).instance_ids_backfilled)
+
+        # Records are now only looked up by instance_id
+        DocumentRecord.objects.filter(
+            index_stats_id=idx.id, instance_id=str(self.i3.pk)
+        ).update(instance_id=None)
+        self.assertEqual(_legacy_records(idx, self.i3.pk), [])
+
     def test_update(self):
         results = SearchableModel1.objects.search("jimmy")
         self.assertTrue([x for x in results])
@@ -116,6 +196,32 @@ class SearchableTest(TestCase):
         results = SearchableModel1.objects.search("bob")
         self.assertTrue([x for x in results])
 
+    def test_update_only_writes_changes(self):
+        """
+            Saving an instance shouldn't rewrite the index unless
+            the indexed fields have changed
+        """
+        keys = set(TokenFieldIndex.objects.values_list("pk", flat=True))
+
+        with sleuth.watch("djangae.contrib.search.models.DocumentRecord.save") as record_save:
+            self.i5.save()
+            self.assertFalse(record_save.called)
+
+        self.assertEqual(keys, set(TokenFieldIndex.objects.values_list("pk", flat=True)))
+
+        self.i5.name = "Alton Towers"
+        self.i5.save()
+
+        new_keys = set(TokenFieldIndex.objects.values_list("pk", flat=True))
+        self.assertEqual(len(keys - new_keys), 1)  # "powers"
+        self.assertEqual(len(new_keys - keys), 1)  # "towers"
+
+        results = SearchableModel1.objects.search("towers")
+        self.assertCountEqual(results, [self.i5])
+
+        results = SearchableModel1.objects.search("powers")
+        self.assertFalse([x for x in results])
+
     def test_searching_stopwords(self):
         SearchableModel1.objects.create(name="About you")
 
@@ -155,3 +261,144 @@ class SearchableTest(TestCase):
         )
 
         self.assertEqual([i2, i3, i1], results)
+
+    def test_ranked_results_fetched_in_batches(self):
+        i1 = SearchableModel1.objects.create(name="testing")
+        i2 = SearchableModel1.objects.create(name="test")
+        i3 = SearchableModel1.objects.create(name="testy")
+
+        with sleuth.switch("djangae.contrib.search.model_document._RESULT_BATCH_SIZE", 1):
+            for concurrent in (False, True):
+                results = SearchableModel1.objects.iter_search_and_rank(
+                    "test", use_startswith=True, concurrent=concurrent
+                )
+
+                self.assertEqual(next(results), i2)
+                self.assertEqual(list(results), [i3, i1])
+
+        # The index's documents are also fetched in batches
+        with sleuth.switch("djangae.contrib.search.index._READ_BATCH_SIZE", 1):
+            with sleuth.watch("djangae.contrib.search.index.Index._iter_ranked_records") as records:
+                results = SearchableModel1.objects.iter_search_and_rank("test", use_startswith=True)
+                self.assertEqual(next(results), i2)
+                self.assertTrue(records.called)
+
+    def test_search_with_cursor(self):
+        ordered_ids = []
+        next_cursor = []
+        results = SearchableModel1.objects.search(
+            "luke OR jimmy OR paolo", limit=2, ordered_ids=ordered_ids, next_cursor=next_cursor
+        )
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(next_cursor), 1)
+
+        more_ids = []
+        results = SearchableModel1.objects.search(
+            "luke OR jimmy OR paolo", limit=2, ordered_ids=more_ids, cursor=next_cursor[0]
+        )
+        self.assertEqual(len(results), 1)
+        self.assertCountEqual(
+            ordered_ids + more_ids, [self.i1.pk, self.i2.pk, self.i3.pk]
+        )
+
+    def test_rebuild_search_index(self):
+        idx = SearchableModelDocument.index()
+        idx.remove(list(
+            DocumentRecord.objects.filter(index_stats_id=idx.id).values_list("pk", flat=True)
+        ))
+
+        self.assertFalse(list(SearchableModel1.objects.search("luke")))
+
+        with sleuth.watch("django.db.models.Model.save") as save:
+            call_command("rebuild_search_index", SearchableModel1._meta.label, batch_size=2)
+            self.process_task_queues()
+
+            # Instances are indexed directly, not by saving them
+            self.assertFalse([x for x in save.calls if isinstance(x.args[0], SearchableModel1)])
+
+        self.assertCountEqual(SearchableModel1.objects.search("luke"), [self.i1])
+        self.assertEqual(idx.document_count(), len(self.instances))
+
+        marker = DeferIterationMarker.objects.get()
+        self.assertEqual(marker.instances_processed, len(self.instances))
+        self.assertTrue(marker.is_finalized)
+
+        # Rebuilding again updates the existing documents
+        call_command("rebuild_search_index", SearchableModel1._meta.label)
+        self.process_task_queues()
+        self.assertEqual(
+            DocumentRecord.objects.filter(index_stats_id=idx.id).count(), len(self.instances)
+        )
+
+    def test_rebuild_into_new_index(self):
+        # Alias resolutions are cached by the process
+        self.addCleanup(aliases._aliases.clear)
+
+        call_command(
+            "rebuild_search_index", SearchableModel1._meta.label, index="index1@v2"
+        )
+        self.process_task_queues()
+
+        # The new index is complete, but isn't searched yet
+        new_index = SearchableModelDocument.get_index("index1@v2")
+        self.assertEqual(new_index.document_count(), len(self.instances))
+        self.assertEqual(SearchableModelDocument.index().name, "index1")
+
+        # While it's being built, saves are written to both indexes
+        instance = SearchableModel1.objects.create(name="Bob")
+        self.assertEqual(new_index.document_count(), len(self.instances) + 1)
+        self.assertCountEqual(SearchableModel1.objects.search("bob"), [instance])
+
+        call_command("rebuild_search_index", SearchableModel1._meta.label, swap=True)
+        self.assertEqual(SearchableModelDocument.index().name, "index1@v2")
+        self.assertCountEqual(SearchableModel1.objects.search("luke"), [self.i1])
+
+        # The previous index is dropped in the background
+        self.process_task_queues()
+        self.assertFalse(IndexStats.objects.filter(pk="index1").exists())
+        self.assertFalse(DocumentRecord.objects.filter(index_stats_id="index1").exists())
+
+        self.assertCountEqual(SearchableModel1.objects.search("bob"), [instance])
+
+        # Deletes are only written to the index that's searched
+        instance.delete()
+        self.assertEqual(new_index.document_count(), len(self.instances))
+
+
+class DeferredIndexingTest(TestCase):
+    def setUp(self):
+        search.register(SearchableModel3, DeferredModelDocument)
+        super().setUp()
+
+    def test_indexing_deferred(self):
+        instance = SearchableModel3.objects.create(name="Luke")
+
+        # Not indexed yet
+        self.assertFalse(list(SearchableModel3.objects.search("luke")))
+        self.assertNumTasksEquals(1)
+
+        self.process_task_queues()
+
+        self.assertCountEqual(SearchableModel3.objects.search("luke"), [instance])
+        self.assertFalse(DeferredIndexingMarker.objects.exists())
+
+    def test_saves_coalesced(self):
+        instance = SearchableModel3.objects.create(name="Luke")
+        instance.name = "Jimmy"
+        instance.save()
+        instance.name = "Paolo"
+        instance.save()
+
+        # Only a single task should have been deferred
+        self.assertNumTasksEquals(1)
+
+        self.process_task_queues()
+
+        # The latest state of the instance should have been indexed
+        self.assertFalse(list(SearchableModel3.objects.search("luke")))
+        self.assertFalse(list(SearchableModel3.objects.search("jimmy")))
+        self.assertCountEqual(SearchableModel3.objects.search("paolo"), [instance])
+
+        # Saving again should defer a new task
+        instance.save()
+        self.assertNumTasksEquals(1)
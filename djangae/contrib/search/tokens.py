@@ -1,8 +1,41 @@
+import re
+from collections import deque
+
 from .constants import (
+    DATE_RANGE_PREFIX,
+    FACET_TOKEN_MARKER,
+    MAX_PREFIX_LENGTH,
+    NUMBER_RANGE_PREFIX,
+    PHRASE_JOIN_STRING,
+    PREFIX_TOKEN_MARKER,
     PUNCTUATION,
+    RANGE_FIELD_SEPARATOR,
+    TRIGRAM_PADDING,
+    TRIGRAM_TOKEN_MARKER,
     WORD_DOCUMENT_JOIN_STRING,
 )
 
+# Characters which separate tokens. Apart from spaces and the join
+# string, they are also tokens themselves
+_STOP_CHARS = frozenset(PUNCTUATION) | {" "}
+_STOP_CHAR_TOKENS = _STOP_CHARS - {" ", WORD_DOCUMENT_JOIN_STRING}
+
+# Matches runs of characters between stop characters, or a single stop
+# character that is a token. Anything else (spaces and the join string)
+# isn't matched, so is skipped over.
+_TOKEN_REGEX = re.compile("[^%s]+|[%s]" % (
+    re.escape("".join(sorted(_STOP_CHARS))),
+    re.escape("".join(sorted(_STOP_CHAR_TOKENS))),
+))
+
+_ACRONYM_TOKENS = frozenset((".", "-"))
+
+# Numbers are offset by this so that they're positive, and then zero padded
+# to the width of the largest number. Numbers outside of the range of a
+# 64-bit integer are indexed as the nearest number in the range.
+_NUMBER_OFFSET = 2 ** 63
+_NUMBER_WIDTH = len(str(2 ** 64 - 1))
+
 
 def is_digit_or_single_char(token):
     """
@@ -23,37 +56,23 @@ def tokenize_content(content):
         https://cloud.google.com/appengine/docs/standard/python/search#special-treatment
     """
 
-    tokens = []
-    current = ""
-
-    STOP_CHARS = list(PUNCTUATION) + [" "]
-
-    for c in content:
-        if c in STOP_CHARS:
-            if current.strip():
-                tokens.append(current)
-
-            if c.strip() and c != WORD_DOCUMENT_JOIN_STRING:
-                tokens.append(c)
-
-            current = ""
-        else:
-            current += c
-    else:
-        if current.strip():
-            tokens.append(current)
+    # Runs of whitespace other than spaces (e.g. newlines) aren't tokens
+    tokens = [x for x in _TOKEN_REGEX.findall(content) if not x.isspace()]
 
     new_tokens = []
     tokens_to_append = []
-    indexes_to_remove = []
+    indexes_to_remove = set()
+
+    # The indexes of each token in new_tokens, so the first of them can
+    # be removed without searching (and shifting) the list
+    new_token_indexes = {}
 
-    ACRONYM_TOKENS = (".", "-")
     current_at = None
     # Detect acronyms
     acronym_run = 0
     for i, token in enumerate(tokens):
         if (
-            ((acronym_run and token == current_at) or (not acronym_run and token in ACRONYM_TOKENS)) and
+            ((acronym_run and token == current_at) or (not acronym_run and token in _ACRONYM_TOKENS)) and
                 i > 0 and tokens[i - 1] != token and is_digit_or_single_char(tokens[i - 1])
         ):
             acronym_run += 1
@@ -68,15 +87,17 @@ def tokenize_content(content):
                 acronym = "".join(parts)
 
                 # Add variations of the acronym
-                new_tokens.append(acronym)
-                new_tokens.append(".".join(parts))
-                new_tokens.append("-".join(parts))
+                for variation in (acronym, ".".join(parts), "-".join(parts)):
+                    new_token_indexes.setdefault(variation, deque()).append(len(new_tokens))
+                    new_tokens.append(variation)
 
                 # Remove the original characters
-                indexes_to_remove.extend(range(start, start + (acronym_run * 2) + 1))
+                indexes_to_remove.update(range(start, start + (acronym_run * 2) + 1))
 
-                if original in new_tokens:
-                    new_tokens.remove(original)
+                indexes = new_token_indexes.get(original)
+                if indexes:
+                    # Removed tokens are skipped once we're done
+                    new_tokens[indexes.popleft()] = None
 
                 # Extend a single token made up of the whole original acronym
                 # rather than seperate chars
@@ -86,6 +107,96 @@ def tokenize_content(content):
             elif i > 0 and (tokens[i - 1] != current_at or not is_digit_or_single_char(token)):
                 acronym_run = 0
 
-    tokens = [x for i, x in enumerate(tokens) if i not in indexes_to_remove]
+    if indexes_to_remove:
+        tokens = [x for i, x in enumerate(tokens) if i not in indexes_to_remove]
+
     tokens.extend(tokens_to_append)
+
+    new_tokens = [x for x in new_tokens if x is not None]
+
     return tokens, new_tokens
+
+
+def tokenize_phrase(content):
+    """
+        Returns the words of the content in order, ignoring punctuation.
+        Unlike tokenize_content() no acronym detection is done, as the
+        order of the words must be preserved.
+    """
+    return [
+        x for x in _TOKEN_REGEX.findall(content)
+        if x not in _STOP_CHAR_TOKENS and not x.isspace()
+    ]
+
+
+def shingle_phrase(words):
+    """
+        Returns a token for each pair of adjacent words. A document
+        contains a phrase if it contains all the shingles of the phrase.
+    """
+    return [PHRASE_JOIN_STRING.join(x) for x in zip(words, words[1:])]
+
+
+def prefix_token(prefix):
+    """
+        Returns the token which is indexed for words starting with prefix
+    """
+    return PREFIX_TOKEN_MARKER + prefix
+
+
+def edge_ngrams(token):
+    """
+        Returns the prefix tokens for each prefix of the token, up
+        to MAX_PREFIX_LENGTH long. Punctuation isn't prefixed.
+    """
+    if token in _STOP_CHAR_TOKENS or token.startswith(TRIGRAM_TOKEN_MARKER):
+        return []
+
+    return [
+        prefix_token(token[:i])
+        for i in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1)
+    ]
+
+
+def trigram_tokens(word):
+    """
+        Returns the tokens for the distinct trigrams of the word
+    """
+    padded = TRIGRAM_PADDING + word + TRIGRAM_PADDING
+    return list(dict.fromkeys(
+        TRIGRAM_TOKEN_MARKER + padded[i:i + 3] for i in range(len(padded) - 2)
+    ))
+
+
+def range_token_prefix(prefix, field_name):
+    """
+        Returns the start of all the range tokens of the field, given
+        the kind of value (NUMBER_RANGE_PREFIX or DATE_RANGE_PREFIX)
+    """
+    return prefix + field_name + RANGE_FIELD_SEPARATOR
+
+
+def number_range_token(field_name, value):
+    """
+        Returns a token for the integer in the field which sorts in numeric order
+    """
+    value = min(max(value + _NUMBER_OFFSET, 0), 2 ** 64 - 1)
+    return range_token_prefix(NUMBER_RANGE_PREFIX, field_name) + str(value).zfill(_NUMBER_WIDTH)
+
+
+def date_range_token(field_name, value):
+    """
+        Returns a token for the date (or datetime) in the field which sorts in date order
+    """
+    return range_token_prefix(DATE_RANGE_PREFIX, field_name) + "%04d-%02d-%02d" % (
+        value.year, value.month, value.day
+    )
+
+
+def facet_token(value):
+    """
+        Returns the token for the whole value of a field, or None if
+        the value is empty
+    """
+    value = value.replace(WORD_DOCUMENT_JOIN_STRING, "").strip()
+    return FACET_TOKEN_MARKER + value if value else None
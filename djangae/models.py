@@ -17,6 +17,14 @@ class DeferIterationMarker(models.Model):
 
     delete_on_completion = models.BooleanField(default=True)
 
+    # The number of instances the callback has been run for, this is
+    # updated as each shard finishes (or is redeferred)
+    instances_processed = models.PositiveIntegerField(default=0)
+
+    # Set to True once the finalize function has run. This is only useful
+    # if the marker isn't deleted on completion.
+    is_finalized = models.BooleanField(default=False)
+
     created = models.DateTimeField(auto_now_add=True)
     callback_name = models.CharField(max_length=100)
     finalize_name = models.CharField(max_length=100)
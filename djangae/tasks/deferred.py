@@ -350,7 +350,46 @@ class TimeoutException(Exception):
     pass
 
 
-def _process_shard(marker_id, shard_number, model, query, callback, finalize, args, kwargs):
+def _record_progress(marker_id, instances_processed):
+    """
+        Adds to the number of instances processed on the marker
+    """
+    if not instances_processed:
+        return
+
+    @transaction.atomic()
+    def update():
+        try:
+            marker = DeferIterationMarker.objects.get(pk=marker_id)
+        except DeferIterationMarker.DoesNotExist:
+            return
+
+        marker.instances_processed += instances_processed
+        marker.save()
+
+    retry(update, _attempts=6)
+
+
+def _run_finalize(marker_id, finalize, args, kwargs):
+    finalize(*args, **kwargs)
+
+    @transaction.atomic()
+    def mark_finalized():
+        try:
+            marker = DeferIterationMarker.objects.get(pk=marker_id)
+        except DeferIterationMarker.DoesNotExist:
+            # The marker was deleted on completion
+            return
+
+        marker.is_finalized = True
+        marker.save()
+
+    retry(mark_finalized, _attempts=6)
+
+
+def _process_shard(
+    marker_id, shard_number, model, query, callback, finalize, args, kwargs, batch_size=None
+):
     args = args or tuple()
 
     # Set an index of the shard in the environment, which is useful for callbacks
@@ -375,39 +414,62 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
             _process_shard, marker_id, shard_number, model, query, callback, finalize,
             args=args,
             kwargs=kwargs,
+            batch_size=batch_size,
             _queue=queue,
             _countdown=1
         )
         return
 
     first_iteration = True
+    instances_processed = 0
+
+    def run_callback(item):
+        nonlocal first_iteration, instances_processed
+
+        callback_start = datetime.now()
+        callback(item, *args, **kwargs)
+        callback_end = datetime.now()
+
+        callback_time = (callback_end - callback_start).total_seconds()
+
+        first_iteration = False
+        instances_processed += len(item) if batch_size else 1
+
+        if callback_time > _CALLBACK_TIME_LIMIT_IN_SECONDS:
+            logging.warning(
+                "Detected slow callback function (>%ss) during iteration, this could result in failed tasks",
+                callback_time
+            )
 
     try:
         qs = model.objects.all()
         qs.query = query
 
+        # The first instance which hasn't been processed yet
         last_pk = None
+
+        # If batch_size is set, the callback is passed lists of instances
+        batch = []
+
         for instance in qs.order_by("pk"):
-            last_pk = instance.pk
+            if not batch:
+                last_pk = instance.pk
 
             shard_time = (datetime.now() - start_time).total_seconds()
             if shard_time > _DEFERRED_SHARD_TIME_LIMIT_IN_SECONDS:
                 raise TimeoutException()
 
-            callback_start = datetime.now()
-            callback(instance, *args, **kwargs)
-            callback_end = datetime.now()
-
-            callback_time = (callback_end - callback_start).total_seconds()
-
-            first_iteration = False
-
-            if callback_time > _CALLBACK_TIME_LIMIT_IN_SECONDS:
-                logging.warning(
-                    "Detected slow callback function (>%ss) during iteration, this could result in failed tasks",
-                    callback_time
-                )
+            if batch_size:
+                batch.append(instance)
+                if len(batch) >= batch_size:
+                    run_callback(batch)
+                    batch = []
+            else:
+                run_callback(instance)
         else:
+            if batch:
+                run_callback(batch)
+
             @transaction.atomic(xg=True)
             def mark_shard_complete():
                 try:
@@ -420,6 +482,7 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
                     return
 
                 marker.shards_complete += 1
+                marker.instances_processed += instances_processed
                 marker.save()
 
                 if marker.shards_complete == marker.shard_count:
@@ -428,11 +491,13 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
                         marker.delete()
 
                     defer(
+                        _run_finalize,
+                        marker_id,
                         finalize,
-                        *args,
+                        args,
+                        kwargs,
                         _transactional=True,
                         _queue=queue,
-                        **kwargs
                     )
 
             retry(mark_shard_complete, _attempts=6)
@@ -457,10 +522,13 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
         if last_pk:
             qs = qs.filter(pk__gte=last_pk)
 
+        _record_progress(marker_id, instances_processed)
+
         defer(
             _process_shard, marker_id, shard_number, qs.model, qs.query, callback, finalize,
             args=args,
             kwargs=kwargs,
+            batch_size=batch_size,
             _queue=queue,
             _countdown=1
         )
@@ -469,7 +537,7 @@ def _process_shard(marker_id, shard_number, model, query, callback, finalize, ar
 
 
 def _generate_shards(
-    model, query, callback, finalize, args, kwargs, shards, delete_marker
+    model, query, callback, finalize, args, kwargs, shards, delete_marker, batch_size=None
 ):
 
     queryset = model.objects.all()
@@ -518,6 +586,7 @@ def _generate_shards(
                 qs.model, qs.query, callback, finalize,
                 args=args,
                 kwargs=kwargs,
+                batch_size=batch_size,
                 _queue=queue,
                 _transactional=True
             )
@@ -531,7 +600,16 @@ def _generate_shards(
 
 def defer_iteration_with_finalize(
         queryset, callback, finalize, _queue='default', _shards=5,
-        _delete_marker=True, _transactional=False, *args, **kwargs):
+        _delete_marker=True, _transactional=False, _batch_size=None, *args, **kwargs):
+    """
+        Runs callback(instance, *args, **kwargs) for each instance in the queryset,
+        in shards of deferred tasks, and then finalize(*args, **kwargs) once all
+        the shards are complete.
+
+        If _batch_size is set, the callback is passed lists of up to that many
+        instances instead. Progress is recorded on the DeferIterationMarker,
+        pass _delete_marker=False to keep it once everything has finished.
+    """
 
     defer(
         _generate_shards,
@@ -543,6 +621,7 @@ def defer_iteration_with_finalize(
         kwargs=kwargs,
         delete_marker=_delete_marker,
         shards=_shards,
+        batch_size=_batch_size,
         _queue=_queue,
         _transactional=_transactional
     )
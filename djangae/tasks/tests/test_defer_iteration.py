@@ -1,5 +1,6 @@
 from django.db import models
 from django.utils import timezone
+from djangae.models import DeferIterationMarker
 from djangae.tasks.deferred import (
     defer_iteration_with_finalize,
     get_deferred_shard_index,
@@ -74,6 +75,17 @@ def noop(*args, **kwargs):
     pass
 
 
+batch_sizes = []
+
+
+def batch_callback(instances):
+    batch_sizes.append(len(instances))
+
+    for instance in instances:
+        instance.touched = True
+        instance.save()
+
+
 class DeferIterationTestCase(TestCase):
     def test_passing_args_and_kwargs(self):
         [DeferIterationTestModel.objects.create() for i in range(25)]
@@ -162,3 +174,29 @@ class DeferIterationTestCase(TestCase):
         for instance in instances:
             self.assertTrue(instance.pk > last_id)
             last_id = instance.pk
+
+    def test_batches(self):
+        [DeferIterationTestModel.objects.create() for i in range(25)]
+
+        batch_sizes.clear()
+
+        defer_iteration_with_finalize(
+            DeferIterationTestModel.objects.all(),
+            batch_callback,
+            finalize,
+            _shards=_SHARD_COUNT,
+            _batch_size=2,
+            _delete_marker=False
+        )
+
+        self.process_task_queues()
+
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(touched=True).count())
+        self.assertEqual(25, DeferIterationTestModel.objects.filter(finalized=True).count())
+        self.assertEqual(25, sum(batch_sizes))
+        self.assertTrue(all(x <= 2 for x in batch_sizes))
+
+        marker = DeferIterationMarker.objects.get()
+        self.assertEqual(marker.shards_complete, marker.shard_count)
+        self.assertEqual(marker.instances_processed, 25)
+        self.assertTrue(marker.is_finalized)